@@ -1,17 +1,27 @@
 import logging
+import os
 
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
+from pyramid.httpexceptions import HTTPLengthRequired
+from pyramid.httpexceptions import HTTPRequestEntityTooLarge
 from pyramid.session import SignedCookieSessionFactory
 import couchdb.client
 import couchdb.http
 
 from .config import GodhandConfiguration
+from .groups import ChangesFollower
+from .groups import GroupCache
+from .groups import find_groups
+from .imaging import ImageProcessor
+from .imaging import use_forkserver
+from .renditions import RenditionCache
+from .sandbox import Limits
+from .tokens import BearerTokenAuthenticationPolicy
 from .models import init_views
-from .models import Subscription
-from .utils import owner_group
-from .utils import subscription_group
+from .models.utils import DocumentMap
 from .utils import wait_for_couchdb
 
 
@@ -26,18 +36,55 @@ def setup_godhand_config(config):
         auth_secret=settings.get('auth_secret'),
         root_email=settings.get('root_email'),
         token_secret=settings.get('token_secret'),
+        queue_uploads=settings.get('queue_uploads'),
+        single_revision_ingest=settings.get('single_revision_ingest'),
+        upload_workers=settings.get('upload_workers'),
+        upload_max_inflight_bytes=settings.get('upload_max_inflight_bytes'),
+        image_workers=settings.get('image_workers'),
+        cover_widths=settings.get('cover_widths'),
+        tmp_dir=settings.get('tmp_dir'),
+        rendition_cache_max_bytes=settings.get('rendition_cache_max_bytes'),
+        dedupe_pages=settings.get('dedupe_pages'),
+        max_upload_size=settings.get('max_upload_size'),
+        sandbox_extraction=settings.get('sandbox_extraction'),
+        extract_max_memory=settings.get('extract_max_memory'),
+        extract_max_cpu_seconds=settings.get('extract_max_cpu_seconds'),
+        extract_max_members=settings.get('extract_max_members'),
+        extract_max_page_bytes=settings.get('extract_max_page_bytes'),
+        extract_max_bytes=settings.get('extract_max_bytes'),
+        max_image_pixels=settings.get('max_image_pixels'),
+        ingest_metrics=settings.get('ingest_metrics'),
+        offload_prefix=settings.get('offload_prefix'),
+        offload_header=settings.get('offload_header'),
+        signed_url_ttl=settings.get('signed_url_ttl'),
+        group_cache_ttl=settings.get('group_cache_ttl'),
+        group_cache_follow_changes=settings.get(
+            'group_cache_follow_changes'),
+        bearer_token_ttl=settings.get('bearer_token_ttl'),
+        google_token_uri=settings.get('google_token_uri'),
+        google_certs_uri=settings.get('google_certs_uri'),
+        google_connect_timeout=settings.get('google_connect_timeout'),
+        google_read_timeout=settings.get('google_read_timeout'),
     )
     config.registry['godhand:cfg'] = cfg
+    config.registry['godhand:images'] = ImageProcessor(
+        cfg.image_workers, Limits.from_config(cfg))
+    config.registry['godhand:renditions'] = RenditionCache(
+        os.path.join(cfg.tmp_dir, 'renditions'),
+        cfg.rendition_cache_max_bytes)
 
 
 def main(global_config, **settings):
+    use_forkserver()
     logging.getLogger('PIL.PngImagePlugin').setLevel('INFO')
     logging.getLogger('PIL.Image').setLevel('INFO')
 
     config = Configurator(settings=settings)
     config.include('cornice')
     setup_godhand_config(config)
+    config.add_subscriber(limit_request_body, NewRequest)
     setup_db(config)
+    config.add_request_method(godhand_docs, 'godhand_docs', reify=True)
     config.include('godhand.auth')
     setup_acl(config)
     config.scan('.views')
@@ -61,19 +108,45 @@ def setup_db(config):
     init_views(db)
 
 
+def godhand_docs(request):
+    return DocumentMap(request.registry['godhand:db'])
+
+
+def limit_request_body(event):
+    """ Refuse bodies over ``max_upload_size`` before any of it is read.
+
+    Bodies that are accepted are spooled to disk by WebOb while parsing, so
+    the limit bounds temp disk rather than memory. Chunked bodies have no
+    length to check upfront and are refused.
+    """
+    request = event.request
+    max_size = request.registry['godhand:cfg'].max_upload_size
+    if not max_size:
+        return
+    if request.content_length is None:
+        if 'chunked' in request.headers.get('Transfer-Encoding', ''):
+            raise HTTPLengthRequired()
+    elif request.content_length > max_size:
+        raise HTTPRequestEntityTooLarge(
+            'Request body is larger than {} bytes.'.format(max_size))
+
+
 def groupfinder(userid, request):
-    subscriptions = Subscription.query(
-        request.registry['godhand:db'], subscriber_id=userid)
-    return [
-        owner_group(userid)
-    ] + [
-        subscription_group(x.publisher_id) for x in subscriptions
-    ]
+    return request.registry['godhand:groups'].get(
+        userid, lambda: find_groups(request.registry['godhand:db'], userid))
 
 
 def setup_acl(config):
-    secret = config.registry['godhand:cfg'].auth_secret
+    cfg = config.registry['godhand:cfg']
+    groups = config.registry['godhand:groups'] = GroupCache(
+        cfg.group_cache_ttl)
+    if cfg.group_cache_ttl and cfg.group_cache_follow_changes:
+        ChangesFollower(config.registry['godhand:db'], groups).start()
+    secret = cfg.auth_secret
     config.set_authorization_policy(ACLAuthorizationPolicy())
-    config.set_authentication_policy(AuthTktAuthenticationPolicy(
-        secret, callback=groupfinder, hashalg='sha512'))
+    policy = AuthTktAuthenticationPolicy(
+        secret, callback=groupfinder, hashalg='sha512')
+    if cfg.bearer_token_ttl:
+        policy = BearerTokenAuthenticationPolicy(cfg.token_secret, policy)
+    config.set_authentication_policy(policy)
     config.set_session_factory(SignedCookieSessionFactory(secret))
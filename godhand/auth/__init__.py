@@ -8,11 +8,13 @@ import couchdb.client
 import couchdb.http
 
 from godhand import setup_godhand_config
+from .google import GoogleOAuth2
 
 
 def includeme(config):
     cfg = config.registry['godhand:cfg']
     setup_db(config, cfg.couchdb_url, cfg.root_email)
+    config.registry['godhand:google'] = GoogleOAuth2.from_config(cfg)
     config.scan('.views')
     config.add_route(
         'google-oauth2', 'https://accounts.google.com/o/oauth2/v2/auth')
@@ -0,0 +1,67 @@
+""" godhand.auth.google
+
+Outbound calls to Google's OAuth endpoints.
+
+Every request thread shares one pooled session. Each call has a connect
+and a read timeout, so a slow Google cannot hold a worker thread
+indefinitely. The certificates that sign id tokens are cached for as long
+as their ``Cache-Control: max-age`` allows.
+
+"""
+from threading import Lock
+import re
+import time
+
+from oauth2client import crypt
+import requests
+import requests.adapters
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+class GoogleOAuth2(object):
+    def __init__(self, token_uri, certs_uri, timeout, pool_size=10):
+        self.token_uri = token_uri
+        self.certs_uri = certs_uri
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._certs = None
+        self._certs_expire = 0
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, cfg):
+        return cls(
+            cfg.google_token_uri, cfg.google_certs_uri,
+            (cfg.google_connect_timeout, cfg.google_read_timeout),
+        )
+
+    def exchange_code(self, **data):
+        """ The response of the token endpoint to ``data``.
+        """
+        return self.session.post(
+            self.token_uri, data=data, timeout=self.timeout)
+
+    def certs(self):
+        """ The certificates id tokens are signed with.
+
+        Only one thread fetches them when they expire, the others wait for
+        its result.
+        """
+        with self._lock:
+            if self._certs is None or self._certs_expire <= time.monotonic():
+                r = self.session.get(self.certs_uri, timeout=self.timeout)
+                r.raise_for_status()
+                certs = r.json()
+                match = MAX_AGE.search(r.headers.get('Cache-Control', ''))
+                self._certs_expire = time.monotonic() + (
+                    int(match.group(1)) if match else 0)
+                self._certs = certs
+            return self._certs
+
+    def verify_id_token(self, id_token, audience):
+        return crypt.verify_signed_jwt_with_certs(
+            id_token, self.certs(), audience)
@@ -6,6 +6,12 @@ from couchdb.mapping import TextField
 
 
 class AntiForgeryToken(Document):
+    """ OAuth state stored by logins before the state was signed instead.
+
+    No longer created; ``godhand-cli purge-oauth-tokens`` deletes them.
+    """
+    PREFIX = 'token:'
+
     class_ = TextField('@class', default='AntiForgeryToken')
     added = DateTimeField(default=datetime.now)
     callback_url = TextField()
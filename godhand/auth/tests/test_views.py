@@ -8,6 +8,7 @@ import couchdb.http
 import mock
 
 from godhand.tests.utils import get_couchdb_url
+from godhand.tests.utils import GoogleStandIn
 
 
 class AuthApiTest(unittest.TestCase):
@@ -22,6 +23,9 @@ class AuthApiTest(unittest.TestCase):
 
     def setUp(self):
         from godhand.auth import main
+        self.google = GoogleStandIn()
+        self.addCleanup(self.google.cleanUp)
+        self.google.setUp()
         self.api = TestApp(main(
             {},
             couchdb_url=self.couchdb_url,
@@ -32,6 +36,7 @@ class AuthApiTest(unittest.TestCase):
             auth_secret='my-auth-secret',
             token_secret='my-token-secret',
             root_email=self.root_email,
+            **self.google.settings
         ))
         self.authdb = couchdb.client.Server(self.couchdb_url)['auth']
         self.addCleanup(self._cleanDb)
@@ -57,33 +62,25 @@ class AuthApiTest(unittest.TestCase):
             query['redirect_uri'], ['http://localhost/oauth2-callback'])
         state = query['state'][0]
         assert state
-        with mock.patch('godhand.auth.views.client') as client:
-            with mock.patch('godhand.auth.views.requests') as requests:
-                requests.post.return_value.status_code = 200
-                requests.post.return_value.json.return_value = {
-                    'id_token': 'myidtoken',
-                }
-                client.verify_id_token.return_value = {
-                    'email_verified': True, 'email': email,
-                }
-
-                response = self.api.get(
-                    '/oauth2-callback',
-                    params={'state': state, 'code': 'mycode'},
-                )
-                assert response.headers['location'] == 'http://success'
-
-                requests.post.assert_called_once_with(
-                    'https://www.googleapis.com/oauth2/v4/token',
-                    data={
-                        'code': 'mycode',
-                        'state': state,
-                        'client_id': self.client_id,
-                        'client_secret': self.client_secret,
-                        'redirect_uri': 'http://localhost/oauth2-callback',
-                        'grant_type': 'authorization_code',
-                    },
-                )
+        with mock.patch('godhand.auth.google.crypt') as crypt:
+            crypt.verify_signed_jwt_with_certs.return_value = {
+                'email_verified': True, 'email': email,
+            }
+            response = self.api.get(
+                '/oauth2-callback',
+                params={'state': state, 'code': 'mycode'},
+            )
+            assert response.headers['location'] == 'http://success'
+            crypt.verify_signed_jwt_with_certs.assert_called_once_with(
+                'myidtoken', {}, self.client_id)
+        self.assertEquals({
+            'code': 'mycode',
+            'state': state,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'redirect_uri': 'http://localhost/oauth2-callback',
+            'grant_type': 'authorization_code',
+        }, self.google.token_requests[-1])
 
 
 class TestLoggedOut(AuthApiTest):
@@ -91,49 +88,67 @@ class TestLoggedOut(AuthApiTest):
         self.oauth2_login('myemail@company.com')
 
     def test_bad_anti_forgery_token(self):
-        with mock.patch('godhand.auth.views.client') as client:
-            with mock.patch('godhand.auth.views.requests') as requests:
-                requests.post.return_value.status_code = 200
-                requests.post.return_value.json.return_value = {
-                    'id_token': 'myidtoken',
-                }
-                client.verify_id_token.return_value = {
-                    'email_verified': True, 'email': 'myemail@company.com',
-                }
-
-                self.api.get(
-                    '/oauth2-callback',
-                    params={'state': 'lolhacks', 'code': 'mycode'}, status=401,
-                )
+        self.api.get(
+            '/oauth2-callback',
+            params={'state': 'lolhacks', 'code': 'mycode'}, status=401,
+        )
+        self.assertEquals([], self.google.token_requests)
+
+    def test_state_is_not_stored(self):
+        self.oauth2_login('myemail@company.com')
+        ids = [x.id for x in self.authdb.view('_all_docs')]
+        assert not [x for x in ids if x.startswith('token:')], ids
+
+    def init_state(self):
+        response = self.api.get('/oauth2-init', params={
+            'callback_url': 'http://success',
+            'error_callback_url': 'http://error',
+        }, status=302)
+        url = urlparse(response.headers['location'])
+        self.assertEquals(url.hostname, 'accounts.google.com')
+        self.assertEquals(url.path, '/o/oauth2/v2/auth')
+        return parse_qs(url.query)['state'][0]
+
+    def test_expired_state(self):
+        state = self.init_state()
+        with mock.patch('godhand.signing.time.time') as time:
+            time.return_value = int(state.split('.')[1]) + 601
+            self.api.get(
+                '/oauth2-callback',
+                params={'state': state, 'code': 'mycode'}, status=401,
+            )
+        self.assertEquals([], self.google.token_requests)
 
     def test_bad_code(self):
-        with mock.patch('godhand.auth.views.requests') as requests:
-            response = self.api.get(
-                '/oauth2-init', params={
-                    'callback_url': 'http://success',
-                    'error_callback_url': 'http://error',
-                }, status=302)
-            url = urlparse(response.headers['location'])
-            self.assertEquals(url.hostname, 'accounts.google.com')
-            self.assertEquals(url.path, '/o/oauth2/v2/auth')
-            query = parse_qs(url.query)
-            state = query['state'][0]
-            requests.post.return_value.status_code = 400
+        state = self.init_state()
+        self.google.token_status = 400
+        response = self.api.get(
+            '/oauth2-callback',
+            params={'state': state, 'code': 'mycode'},
+            status=303
+        )
+        assert response.headers['location'] == 'http://error'
+        self.assertEquals('mycode', self.google.token_requests[0]['code'])
+
+    def test_slow_token_endpoint(self):
+        state = self.init_state()
+        self.google.delay = 0.5
+        google = self.api.app.registry['godhand:google']
+        with mock.patch.object(google, 'timeout', (1, 0.1)):
             response = self.api.get(
                 '/oauth2-callback',
                 params={'state': state, 'code': 'mycode'},
                 status=303
             )
-            assert response.headers['location'] == 'http://error'
-
-            requests.post.assert_called_once_with(
-                'https://www.googleapis.com/oauth2/v4/token',
-                data={
-                    'code': 'mycode',
-                    'state': state,
-                    'client_id': self.client_id,
-                    'client_secret': self.client_secret,
-                    'redirect_uri': 'http://localhost/oauth2-callback',
-                    'grant_type': 'authorization_code',
-                },
-            )
+        assert response.headers['location'] == 'http://error'
+
+    def test_certs_are_cached(self):
+        self.oauth2_login('myemail@company.com')
+        self.oauth2_login('myemail@company.com')
+        self.assertEquals(1, self.google.certs_requests)
+
+        self.google.certs_max_age = 0
+        self.api.app.registry['godhand:google']._certs_expire = 0
+        self.oauth2_login('myemail@company.com')
+        self.oauth2_login('myemail@company.com')
+        self.assertEquals(3, self.google.certs_requests)
@@ -1,8 +1,7 @@
-import hashlib
+import logging
 import os
 
 from cornice import Service
-from oauth2client import client
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPUnauthorized
 from pyramid.httpexceptions import HTTPSeeOther
@@ -11,8 +10,10 @@ from pyramid.security import remember
 import colander as co
 import requests
 
-from .models import AntiForgeryToken
+from .. import signing
 
+LOG = logging.getLogger('godhand')
+STATE_MAX_AGE = 600
 
 logout = Service(
     name='logout',
@@ -40,8 +41,17 @@ def user_logout(request):
     return response
 
 
-def create_anti_forgery_token():
-    return 'token:' + hashlib.sha256(os.urandom(1024)).hexdigest()
+def create_oauth2_state(secret, callback_url, error_callback_url):
+    """ Signed, timestamped OAuth ``state`` carrying the callback urls.
+
+    It is checked by signature and age alone, so nothing is stored per
+    login. A replayed state is useless without a fresh code from Google.
+    """
+    return signing.dumps(secret, {
+        'callback_url': callback_url,
+        'error_callback_url': error_callback_url,
+        'nonce': os.urandom(8).hex(),
+    })
 
 
 class InitOauth2Schema(co.MappingSchema):
@@ -57,12 +67,11 @@ def init_oauth2(request):
     """
     v = request.validated
     email = request.unauthenticated_userid or ''
-    token = AntiForgeryToken(id=create_anti_forgery_token(), **v)
-    token.store(request.registry['godhand:authdb'])
     cfg = request.registry['godhand:cfg']
     query = {
         'client_id': cfg.google_client_id,
-        'state': token.id,
+        'state': create_oauth2_state(
+            cfg.auth_secret, v['callback_url'], v['error_callback_url']),
         'application_name': cfg.google_client_appname,
         'scope': 'openid email',
         'redirect_uri': request.route_url('oauth2-callback'),
@@ -81,35 +90,35 @@ class VerifyOAuthTokenSchema(co.MappingSchema):
 def verify_oauth2_token(request):
     """ OAuth provider should redirect user to this endpoint.
     """
-    authdb = request.registry['godhand:authdb']
     cfg = request.registry['godhand:cfg']
-    # validate anti-forgery token
-    token = AntiForgeryToken.load(authdb, request.validated['state'])
-    if token is None:
+    # validate anti-forgery state
+    state = signing.loads(
+        cfg.auth_secret, request.validated['state'], STATE_MAX_AGE)
+    if state is None:
         raise HTTPUnauthorized(
             'Callback must be initialized from /oauth2-init')
-    else:
-        authdb.delete(token)
+    google = request.registry['godhand:google']
     # validate code sent by client with google
-    r = requests.post(
-        'https://www.googleapis.com/oauth2/v4/token',
-        data={
-            'code': request.validated['code'],
-            'state': request.validated['state'],
-            'client_id': cfg.google_client_id,
-            'client_secret': cfg.google_client_secret,
-            'redirect_uri': request.route_url('oauth2-callback'),
-            'grant_type': 'authorization_code',
-        },
-    )
-    if r.status_code != 200:
-        raise HTTPSeeOther(token.error_callback_url)
-    info = r.json()
-    login_info = client.verify_id_token(info['id_token'], cfg.google_client_id)
+    try:
+        r = google.exchange_code(
+            code=request.validated['code'],
+            state=request.validated['state'],
+            client_id=cfg.google_client_id,
+            client_secret=cfg.google_client_secret,
+            redirect_uri=request.route_url('oauth2-callback'),
+            grant_type='authorization_code',
+        )
+        if r.status_code != 200:
+            raise HTTPSeeOther(state['error_callback_url'])
+        login_info = google.verify_id_token(
+            r.json()['id_token'], cfg.google_client_id)
+    except (requests.RequestException, KeyError, ValueError):
+        LOG.exception('Could not verify OAuth code with Google.')
+        raise HTTPSeeOther(state['error_callback_url'])
     if login_info['email_verified'] and login_info['email']:
         # if all is good, sign the cookie and send back to client
         response = request.response
         response.headers.extend(remember(request, login_info['email']))
-        return HTTPFound(token.callback_url, headers=response.headers)
+        return HTTPFound(state['callback_url'], headers=response.headers)
     else:
-        raise HTTPSeeOther(token.error_callback_url)
+        raise HTTPSeeOther(state['error_callback_url'])
@@ -0,0 +1,128 @@
+""" godhand.benchmark
+
+Ingest benchmark. Archives generated by :mod:`godhand.fakevolumes` are run
+through :mod:`godhand.bookextractor` and :meth:`Volume.from_archieve` against
+a scratch database, and the results are written as JSON so runs can be
+compared across releases.
+
+Every case reports the wall time of each stage, pages/s for the full ingest,
+the peak resident memory of this process and its image workers, and the
+temp-disk high-water mark. Both peaks are sampled, and the disk figure is
+the growth in use of the filesystem holding the temp directory, so run the
+benchmark on an otherwise idle machine.
+
+"""
+from datetime import datetime
+import itertools
+import os
+import platform
+import time
+
+from . import bookextractor
+from .fakevolumes import CbtFile
+from .fakevolumes import CbzFile
+from .metrics import ResourceSampler
+from .models.metrics import IngestMetrics
+from .models.volume import Volume
+from .models.volume import iter_probed_pages
+
+ARCHIVES = {
+    'cbt': CbtFile,
+    'cbz': CbzFile,
+}
+DEFAULT_FORMATS = ('cbt', 'cbz')
+DEFAULT_PAGE_COUNTS = (20, 100)
+DEFAULT_PAGE_SIZES = ((800, 1200), (1600, 2400))
+
+
+def iter_cases(
+        formats=DEFAULT_FORMATS, page_counts=DEFAULT_PAGE_COUNTS,
+        page_sizes=DEFAULT_PAGE_SIZES, page_format='jpeg'):
+    for fmt, n_pages, size in itertools.product(
+            formats, page_counts, page_sizes):
+        yield {
+            'format': fmt,
+            'pages': n_pages,
+            'page_size': list(size),
+            'page_format': page_format,
+        }
+
+
+def run(db, cases, images, repeat=1, **ingest_kws):
+    """ Run every case ``repeat`` times and return the results.
+
+    ``ingest_kws`` are passed on to :meth:`Volume.from_archieve`.
+    """
+    results = {
+        'started': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'image_workers': images.workers,
+        'settings': {
+            k: v for k, v in sorted(ingest_kws.items())
+            if isinstance(v, (int, float, bool, str, list, tuple))
+        },
+        'cases': [],
+    }
+    for case in cases:
+        archive = ARCHIVES[case['format']](
+            n_pages=case['pages'],
+            page_size=tuple(case['page_size']),
+            page_format=case['page_format'],
+        )
+        with archive.packaged() as f:
+            archive_bytes = os.fstat(f.fileno()).st_size
+            for n in range(repeat):
+                result = run_case(
+                    db, f, 'bench{}'.format(archive.ext), images, **ingest_kws)
+                result.update(case, run=n, archive_bytes=archive_bytes)
+                results['cases'].append(result)
+    return results
+
+
+def run_case(db, f, filename, images, **ingest_kws):
+    """ Time the stages of ingesting the archive ``f``.
+
+    ``extract`` only reads every page out of the archive, ``probe`` also
+    reads each page's dimensions and ``ingest`` is the complete
+    :meth:`Volume.from_archieve`, including its own extraction and probing.
+    ``ingest_stages`` breaks the ingest down as recorded by
+    :class:`IngestMetrics`.
+    """
+    stages = {}
+    with ResourceSampler() as sampler:
+        f.seek(0)
+        started = time.time()
+        with bookextractor.from_filename(filename)(f).iter_pages() as pages:
+            for _, page in pages:
+                with page:
+                    page.read()
+        stages['extract'] = time.time() - started
+
+        f.seek(0)
+        started = time.time()
+        ext = bookextractor.from_filename(filename)(f)
+        with ext.iter_pages() as pages:
+            for x in iter_probed_pages(pages, images):
+                x[1].close()
+        stages['probe'] = time.time() - started
+
+        f.seek(0)
+        started = time.time()
+        volume = Volume.from_archieve(
+            db, 'benchmark', filename, f, images=images, **ingest_kws)
+        stages['ingest'] = time.time() - started
+    n_pages = len(volume.pages)
+    metrics = IngestMetrics.for_volume(db, volume.id)
+    if metrics is not None:
+        db.delete(metrics)
+    volume.delete(db)
+    return {
+        'pages_ingested': n_pages,
+        'stages': stages,
+        'ingest_stages': dict(metrics.stages) if metrics else None,
+        'pages_per_second': n_pages / max(stages['ingest'], 1e-6),
+        'peak_rss_bytes': sampler.peak_rss,
+        'temp_disk_bytes': sampler.peak_disk,
+    }
@@ -1,6 +1,8 @@
 from contextlib import contextmanager
+from shutil import copyfileobj
 from shutil import rmtree
 from tempfile import NamedTemporaryFile
+from tempfile import SpooledTemporaryFile
 from tempfile import mkdtemp
 import os
 import re
@@ -8,8 +10,13 @@ import subprocess
 import tarfile
 import zipfile
 
+from .utils import file_size
+
 ext_regex = re.compile('^.*\.(jpg|jpeg|gif|png|tiff)$', re.IGNORECASE)
 
+#: Pages smaller than this are buffered in memory, larger ones on disk.
+PAGE_SPOOL_SIZE = 8 * 1024 * 1024
+
 
 def from_mimetype(mimetype):
     if mimetype == 'application/x-cbt':
@@ -39,23 +46,47 @@ def filename_to_mimetype(filename):
         return 'images/{}'.format(ext)
 
 
+def is_hidden(relpath):
+    return any(x.startswith('.') for x in relpath.split('/'))
+
+
+def spooled_page(f):
+    """ Copy a page stream into a seekable, size-bounded spool file.
+    """
+    page = SpooledTemporaryFile(max_size=PAGE_SPOOL_SIZE)
+    copyfileobj(f, page)
+    page.seek(0)
+    return page
+
+
 class BookExtractor(object):
     def __init__(self, f):
         """ Create a BookExtractor object.
 
         :param f: File pointer to book.
-        :param path: Path to directory to extract to.
         """
         self.f = f
 
     def extract(self, tmp):
         raise NotImplementedError()
 
+    def count_pages(self):
+        """ Number of candidate pages, or ``None`` if unknown before reading.
+        """
+        return None
+
     @contextmanager
     def iter_pages(self):
+        """ Iterate over ``(relpath, fileobj)`` for every page of the book.
+
+        Each ``fileobj`` is seekable and owned by the caller, who is
+        responsible for closing it.
+        """
         tmp = mkdtemp()
-        yield self._iter_pages(tmp)
-        rmtree(tmp)
+        try:
+            yield self._iter_pages(tmp)
+        finally:
+            rmtree(tmp)
 
     def _iter_pages(self, tmp):
         self.extract(tmp)
@@ -63,25 +94,189 @@ class BookExtractor(object):
             files = filter(lambda x: not x.startswith('.'), files)
             for page in files:
                 page = os.path.join(root, page)
-                yield os.path.relpath(page, tmp), page
+                yield os.path.relpath(page, tmp), open(page, 'rb')
 
 
 class CbtBookExtractor(BookExtractor):
+    """ Reads pages straight off the tar stream without extracting to disk.
+    """
     def extract(self, tmp):
         with tarfile.open(fileobj=self.f) as ar:
             ar.extractall(tmp)
 
+    @contextmanager
+    def iter_pages(self):
+        with tarfile.open(fileobj=self.f, mode='r|*') as ar:
+            yield self._iter_stream(ar)
+
+    def _iter_stream(self, ar):
+        for member in ar:
+            if not member.isfile() or is_hidden(member.name):
+                continue
+            yield (
+                os.path.normpath(member.name),
+                spooled_page(ar.extractfile(member)),
+            )
+
 
 class CbzBookExtractor(BookExtractor):
+    """ Reads pages from the zip central directory one member at a time.
+    """
     def extract(self, tmp):
         with zipfile.ZipFile(self.f) as ar:
             ar.extractall(tmp)
 
+    def count_pages(self):
+        with zipfile.ZipFile(self.f) as ar:
+            return len(list(self._iter_infos(ar)))
+
+    @contextmanager
+    def iter_pages(self):
+        with zipfile.ZipFile(self.f) as ar:
+            yield self._iter_members(ar)
+
+    def _iter_infos(self, ar):
+        for info in ar.infolist():
+            if info.filename.endswith('/') or is_hidden(info.filename):
+                continue
+            yield info
+
+    def _iter_members(self, ar):
+        for info in self._iter_infos(ar):
+            with ar.open(info) as member:
+                yield os.path.normpath(info.filename), spooled_page(member)
+
 
 class CbrBookExtractor(BookExtractor):
+    """ Streams pages out of a single ``unrar p`` process.
+
+    unrar needs a path, so the upload is handed over by name when it has
+    one and copied to disk in fixed-size chunks otherwise. Members are
+    listed with ``unrar lt`` first, then the concatenated output of
+    ``unrar p`` is split by member size in archive order, so a solid archive
+    is decompressed once and never more than one page is held at a time.
+    The listing is kept, so counting the pages first does not list the
+    archive again.
+
+    """
+    _members = None
+
     def extract(self, tmp):
+        with self.archive_path() as path:
+            subprocess.check_call(['unrar', 'x', '-inul', '-p-', path, tmp])
+
+    def count_pages(self):
+        return len([x for x in self.members() if x[2]])
+
+    @contextmanager
+    def iter_pages(self):
+        with self.archive_path() as path:
+            members = self.members(path)
+            proc = subprocess.Popen(
+                ['unrar', 'p', '-inul', '-p-', path], stdout=subprocess.PIPE)
+            try:
+                yield self._iter_process(proc, members)
+            finally:
+                proc.stdout.close()
+                proc.kill()
+                proc.wait()
+
+    def _iter_process(self, proc, members):
+        """ Pages of the ``unrar p`` process ``proc``, which must succeed.
+
+        unrar prints a member that fails its CRC check anyway, and only
+        reports the failure in its exit status.
+        """
+        for x in self._iter_stream(proc.stdout, members):
+            yield x
+        while proc.stdout.read(64 * 1024):
+            pass
+        if proc.wait() != 0:
+            raise ValueError(
+                'unrar failed with exit status {}.'.format(proc.returncode))
+
+    def _iter_stream(self, stream, members):
+        for name, size, is_page in members:
+            page = spooled_page(LimitedReader(stream, size))
+            if file_size(page) != size:
+                page.close()
+                raise ValueError('Truncated RAR member {!r}.'.format(name))
+            if not is_page:
+                page.close()
+                continue
+            yield os.path.normpath(name), page
+
+    def members(self, path=None):
+        """ ``(name, size, is_page)`` of every file in archive order.
+        """
+        if self._members is not None:
+            return self._members
+        if path is None:
+            with self.archive_path() as path:
+                return self.members(path)
+        listing = subprocess.check_output(['unrar', 'lt', '-p-', path])
+        self._members = [
+            (name, size, not is_hidden(name))
+            for name, size in parse_unrar_listing(
+                listing.decode('utf-8', 'replace'))
+        ]
+        return self._members
+
+    @contextmanager
+    def archive_path(self):
+        name = getattr(self.f, 'name', None)
+        if isinstance(name, str) and os.path.isfile(name):
+            yield name
+            return
+        proc_path = self._proc_path()
+        if proc_path:
+            yield proc_path
+            return
         with NamedTemporaryFile() as f:
-            for line in self.f:
-                f.write(line)
+            self.f.seek(0)
+            copyfileobj(self.f, f)
             f.flush()
-            subprocess.check_call(['unrar', 'x', f.name, tmp])
+            yield f.name
+
+    def _proc_path(self):
+        """ Path of an anonymous temporary file through ``/proc``.
+        """
+        try:
+            path = '/proc/{}/fd/{}'.format(os.getpid(), self.f.fileno())
+        except (AttributeError, OSError, ValueError):
+            return None
+        return path if os.path.isfile(path) else None
+
+
+class LimitedReader(object):
+    """ Read at most ``size`` bytes from ``f``.
+    """
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        chunk = self.f.read(size) if size else b''
+        self.remaining -= len(chunk)
+        return chunk
+
+    def close(self):
+        self.f.close()
+
+
+def parse_unrar_listing(listing):
+    """ ``(name, size)`` of every file in ``unrar lt`` output.
+    """
+    files = []
+    entry = {}
+    for line in listing.splitlines() + ['']:
+        key, sep, value = line.strip().partition(': ')
+        if sep and key in ('Name', 'Type', 'Size'):
+            entry[key] = value
+        elif not line.strip() and entry:
+            if 'Name' in entry and entry.get('Type', 'File') == 'File':
+                files.append((entry['Name'], int(entry.get('Size', 0))))
+            entry = {}
+    return files
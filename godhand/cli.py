@@ -1,16 +1,37 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from datetime import datetime
+from datetime import timedelta
 from itertools import islice
 from subprocess import check_call
 import argparse
 import json
 import logging
+import math
+import os
+import socket
 import sys
+import tempfile
+import time
 
 import couchdb.client
 import couchdb.http
 
+from . import benchmark
+from .auth.models import AntiForgeryToken
 from .config import GodhandConfiguration
+from .imaging import ImageProcessor
+from .imaging import use_forkserver
+from .models import IngestJob
+from .models import IngestMetrics
 from .models import Series
 from .models import Volume
+from .models import init_views
+from .models.volume import COVER_MIN_HEIGHT
+from .models.volume import COVER_MIN_WIDTH
+from .sandbox import Limits
+from .utils import batched
 from .utils import wait_for_couchdb
 
 LOG = logging.getLogger(__file__)
@@ -27,12 +48,63 @@ def replace_uri_prefixes(uri):
 
 
 def main():
+    use_forkserver()
     ap = argparse.ArgumentParser('godhand-cli')
     ap.add_argument('--log-level', default='DEBUG')
     s = ap.add_subparsers(dest='cmd')
 
     s.add_parser('api')
-    s.add_parser('worker')
+    p = s.add_parser('worker')
+    p.add_argument('--couchdb-url', default=None)
+    p.add_argument('--poll-interval', type=float, default=5.0)
+    p.add_argument(
+        '--once', action='store_true',
+        help='Exit when there are no more queued uploads.')
+
+    p = s.add_parser('reprocess-images')
+    p.add_argument('--couchdb-url', default=None)
+    p.add_argument('--min-width', type=int, default=COVER_MIN_WIDTH)
+    p.add_argument('--min-height', type=int, default=COVER_MIN_HEIGHT)
+    p.add_argument(
+        '--workers', type=int, default=None,
+        help='Volumes processed concurrently (default: one per core).')
+    p.add_argument(
+        '--checkpoint', default=None,
+        help='Progress file used to resume an interrupted run.')
+    p.add_argument(
+        '--restart', action='store_true',
+        help='Ignore the checkpoint and start from the first volume.')
+
+    p = s.add_parser('benchmark')
+    p.add_argument('--couchdb-url', default=None)
+    p.add_argument(
+        '--formats', type=str_list, default=benchmark.DEFAULT_FORMATS)
+    p.add_argument(
+        '--page-counts', type=int_list,
+        default=benchmark.DEFAULT_PAGE_COUNTS)
+    p.add_argument(
+        '--page-sizes', type=size_list, default=benchmark.DEFAULT_PAGE_SIZES,
+        help='Comma-separated WIDTHxHEIGHT.')
+    p.add_argument('--page-format', default='jpeg')
+    p.add_argument('--repeat', type=int, default=1)
+    p.add_argument(
+        '--output', default='-', help='Results file (default: stdout).')
+
+    p = s.add_parser('ingest-stats')
+    p.add_argument('--couchdb-url', default=None)
+    p.add_argument(
+        '--days', type=float, default=7,
+        help='Only ingests finished in the last DAYS (0 for all).')
+    p.add_argument(
+        '--limit', type=int, default=None,
+        help='Only the LIMIT most recent ingests.')
+    p.add_argument(
+        '--group-by', type=str_list, default=[],
+        help='Comma-separated ingest settings, e.g. upload_workers.')
+    p.add_argument('--json', action='store_true')
+
+    p = s.add_parser('purge-oauth-tokens')
+    p.add_argument('--couchdb-url', default=None)
 
     s.add_parser('dbpedia-dump')
 
@@ -53,6 +125,24 @@ def main():
         check_call(['pserve', 'app.ini'])
     elif args.cmd == 'upload':
         upload(args.couchdb_url)
+    elif args.cmd == 'worker':
+        worker(args.couchdb_url, args.poll_interval, args.once)
+    elif args.cmd == 'reprocess-images':
+        reprocess_images(
+            args.couchdb_url, args.min_width, args.min_height, args.workers,
+            args.checkpoint, args.restart)
+    elif args.cmd == 'benchmark':
+        run_benchmark(
+            args.couchdb_url, benchmark.iter_cases(
+                args.formats, args.page_counts, args.page_sizes,
+                args.page_format),
+            args.repeat, args.output)
+    elif args.cmd == 'purge-oauth-tokens':
+        purge_oauth_tokens(args.couchdb_url)
+    elif args.cmd == 'ingest-stats':
+        ingest_stats(
+            args.couchdb_url, args.days, args.limit, args.group_by,
+            args.json)
 
 
 def upload(couchdb_url=None, lines=None):
@@ -70,6 +160,328 @@ def upload(couchdb_url=None, lines=None):
     Volume.by_series.sync(db)
 
 
+def worker(couchdb_url=None, poll_interval=5.0, once=False):
+    """ Process queued uploads until interrupted.
+
+    Run as many of these as there are cores to spare; workers coordinate
+    through the job documents in CouchDB.
+    """
+    cfg = GodhandConfiguration.from_env(couchdb_url=couchdb_url)
+    db = get_db(cfg)
+    init_views(db)
+    images = ImageProcessor(cfg.image_workers, Limits.from_config(cfg))
+    worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    LOG.info('worker {} started'.format(worker_id))
+    while True:
+        job = IngestJob.claim_next(db, worker_id)
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        LOG.info('processing IngestJob<{}> {}'.format(job.id, job.filename))
+        job.run(db, cfg, images)
+        LOG.info('IngestJob<{}> {}: {} pages'.format(
+            job.id, job.status, job.pages_done))
+
+
+def reprocess_images(
+        couchdb_url=None, min_width=COVER_MIN_WIDTH,
+        min_height=COVER_MIN_HEIGHT, workers=None, checkpoint=None,
+        restart=False):
+    """ Rebuild the covers of every volume.
+
+    Volumes whose covers already have the requested dimensions are skipped.
+    Finished volume ids are written to ``checkpoint`` as they complete, so an
+    interrupted run resumes where it stopped.
+    """
+    cfg = GodhandConfiguration.from_env(couchdb_url=couchdb_url)
+    db = get_db(cfg)
+    init_views(db)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if checkpoint is None:
+        checkpoint = os.path.join(cfg.tmp_dir, 'reprocess-images.json')
+    params = {
+        'min_width': min_width,
+        'min_height': min_height,
+        'cover_widths': sorted(cfg.cover_widths),
+    }
+    progress = ReprocessCheckpoint(checkpoint, params, restart=restart)
+    volume_ids = [x for x in Volume.iter_ids(db) if x not in progress.done]
+    LOG.info('reprocessing {} volumes, {} already done'.format(
+        len(volume_ids), len(progress.done)))
+    images = ImageProcessor(cfg.image_workers, Limits.from_config(cfg))
+    meter = Throughput(len(volume_ids))
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            ids = iter(volume_ids)
+            while True:
+                for volume_id in islice(ids, 2 * workers - len(pending)):
+                    pending[executor.submit(
+                        Volume.reprocess_by_id, db, volume_id, min_width,
+                        min_height, images, cfg.cover_widths)] = volume_id
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    volume_id = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        LOG.exception('Volume<{}> failed.'.format(volume_id))
+                        failed += 1
+                        continue
+                    progress.add(volume_id)
+                    meter.add(result)
+                    if meter.due():
+                        LOG.info(meter.report())
+    finally:
+        progress.save()
+        images.shutdown()
+    LOG.info(meter.report())
+    if failed:
+        LOG.warning(
+            '{} volumes failed; run again to retry them.'.format(failed))
+    return failed
+
+
+class ReprocessCheckpoint(object):
+    """ Ids of volumes already reprocessed with ``params``.
+
+    The file is rewritten atomically every ``interval`` seconds. A checkpoint
+    written with different ``params`` is discarded.
+    """
+    interval = 5.0
+
+    def __init__(self, path, params, restart=False):
+        self.path = path
+        self.params = params
+        self.done = set()
+        self._saved = time.time()
+        if not restart:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if data.get('params') == self.params:
+            self.done = set(data['done'])
+
+    def add(self, volume_id):
+        self.done.add(volume_id)
+        if time.time() - self._saved > self.interval:
+            self.save()
+
+    def save(self):
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'params': self.params, 'done': sorted(self.done)}, f)
+        os.replace(tmp, self.path)
+        self._saved = time.time()
+
+
+class Throughput(object):
+    """ Count finished volumes and estimate the time remaining.
+    """
+    interval = 10.0
+
+    def __init__(self, total):
+        self.total = total
+        self.counts = {}
+        self.started = self._reported = time.time()
+
+    @property
+    def finished(self):
+        return sum(self.counts.values())
+
+    def add(self, result):
+        self.counts[result] = self.counts.get(result, 0) + 1
+
+    def due(self):
+        if time.time() - self._reported > self.interval:
+            self._reported = time.time()
+            return True
+        return False
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        rate = self.finished / elapsed
+        remaining = self.total - self.finished
+        eta = remaining / rate if remaining else 0
+        counts = ', '.join(
+            '{} {}'.format(v, k) for k, v in sorted(self.counts.items()))
+        return '{}/{} volumes ({}) in {:.0f}s: {:.2f} volumes/s, ETA {:.0f}s'\
+            .format(self.finished, self.total, counts, elapsed, rate, eta)
+
+
+def run_benchmark(couchdb_url=None, cases=None, repeat=1, output='-'):
+    """ Run the ingest benchmark in a scratch database.
+
+    Ingest settings come from the environment, like for the api.
+    """
+    if cases is None:
+        cases = benchmark.iter_cases()
+    cfg = GodhandConfiguration.from_env(couchdb_url=couchdb_url)
+    db = get_db(cfg, 'godhand-benchmark')
+    init_views(db)
+    images = ImageProcessor(cfg.image_workers, Limits.from_config(cfg))
+    try:
+        results = benchmark.run(
+            db, cases, images, repeat=repeat,
+            single_revision=cfg.single_revision_ingest,
+            upload_workers=cfg.upload_workers,
+            upload_max_inflight_bytes=cfg.upload_max_inflight_bytes,
+            cover_widths=cfg.cover_widths,
+            dedupe=cfg.dedupe_pages,
+            sandbox=Limits.from_config(cfg),
+        )
+    finally:
+        images.shutdown()
+        couchdb.client.Server(cfg.couchdb_url).delete('godhand-benchmark')
+    for case in results['cases']:
+        LOG.info(
+            '{format} {pages} x {page_size}: {pages_per_second:.1f} pages/s, '
+            '{peak_rss_bytes} bytes RSS, {temp_disk_bytes} bytes temp'
+            .format(**case))
+    if output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    else:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+def purge_oauth_tokens(couchdb_url=None, batch_size=500):
+    """ Delete the OAuth anti-forgery tokens stored by earlier versions.
+    """
+    cfg = GodhandConfiguration.from_env(couchdb_url=couchdb_url)
+    db = get_db(cfg, 'auth')
+    prefix = AntiForgeryToken.PREFIX
+    rows = db.view(
+        '_all_docs', startkey=prefix, endkey=prefix + '\ufff0')
+    purged = 0
+    for batch in batched(rows, batch_size):
+        db.update([
+            {'_id': x.id, '_rev': x.value['rev'], '_deleted': True}
+            for x in batch
+        ])
+        purged += len(batch)
+    LOG.info('purged {} anti-forgery tokens'.format(purged))
+    return purged
+
+
+def ingest_stats(
+        couchdb_url=None, days=7, limit=None, group_by=(), as_json=False,
+        out=None):
+    """ Summarize the metrics recorded for recent ingests.
+
+    Ingests are grouped by the ``group_by`` settings they ran with, and for
+    each group the share of time, median and 95th percentile of every stage
+    is reported.
+    """
+    out = out or sys.stdout
+    cfg = GodhandConfiguration.from_env(couchdb_url=couchdb_url)
+    db = get_db(cfg)
+    init_views(db)
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    summary = summarize_ingests(
+        IngestMetrics.query(db, since=since, limit=limit), group_by)
+    if as_json:
+        json.dump(summary, out, indent=2, sort_keys=True)
+    else:
+        for line in format_ingest_stats(summary):
+            out.write(line + '\n')
+    return summary
+
+
+def summarize_ingests(records, group_by=()):
+    groups = {}
+    for x in records:
+        key = tuple(x.settings.get(k) for k in group_by)
+        groups.setdefault(json.dumps(key), []).append(x)
+    summary = []
+    for key, group in sorted(groups.items()):
+        done = [x for x in group if x.status == 'done']
+        stage_names = sorted(set().union(*(x.stages for x in group)))
+        total = sum(x.seconds for x in group) or 1e-6
+        stages = {}
+        for name in stage_names:
+            seconds = [x.stages.get(name, {}).get('seconds', 0.0)
+                       for x in group]
+            nbytes = sum(x.stages.get(name, {}).get('bytes', 0)
+                         for x in group)
+            stages[name] = {
+                'share': sum(seconds) / total,
+                'p50_seconds': percentile(seconds, 50),
+                'p95_seconds': percentile(seconds, 95),
+                'bytes_per_second': nbytes / max(sum(seconds), 1e-6),
+            }
+        summary.append({
+            'settings': dict(zip(group_by, json.loads(key))),
+            'ingests': len(group),
+            'failed': len(group) - len(done),
+            'pages_per_second': percentile([
+                x.pages / max(x.seconds, 1e-6) for x in done], 50),
+            'p50_seconds': percentile([x.seconds for x in group], 50),
+            'p95_peak_rss_bytes': percentile(
+                [x.peak_rss_bytes for x in group], 95),
+            'stages': stages,
+        })
+    return summary
+
+
+def format_ingest_stats(summary):
+    if not summary:
+        yield 'no ingests recorded'
+    for group in summary:
+        settings = ', '.join(
+            '{}={}'.format(k, v) for k, v in sorted(group['settings'].items()))
+        yield (
+            '{ingests} ingests ({failed} failed){group}: '
+            '{p50_seconds:.2f}s median, {pages_per_second:.1f} pages/s, '
+            '{rss:.0f} MiB p95 peak RSS'.format(
+                group=' [{}]'.format(settings) if settings else '',
+                ingests=group['ingests'], failed=group['failed'],
+                p50_seconds=group['p50_seconds'],
+                pages_per_second=group['pages_per_second'],
+                rss=group['p95_peak_rss_bytes'] / 1024 ** 2))
+        for name, stage in sorted(
+                group['stages'].items(), key=lambda x: -x[1]['share']):
+            yield (
+                '  {name:<8} {share:>5.1%}  p50 {p50_seconds:7.3f}s  '
+                'p95 {p95_seconds:7.3f}s  {mbps:8.1f} MiB/s'.format(
+                    name=name, mbps=stage['bytes_per_second'] / 1024 ** 2,
+                    **stage))
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile, 0 for no values.
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def str_list(value):
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+def int_list(value):
+    return [int(x) for x in str_list(value)]
+
+
+def size_list(value):
+    return [tuple(int(y) for y in x.split('x')) for x in str_list(value)]
+
+
 def iterdocs(lines):
     for n_line, line in enumerate(lines):
         if n_line and (n_line % 100) == 0:
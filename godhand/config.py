@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import colander as co
 
@@ -21,7 +22,23 @@ class GodhandConfiguration(object):
 
     def __init__(self, couchdb_url,
                  google_client_appname, google_client_id, google_client_secret,
-                 auth_secret, root_email, disable_auth, token_secret):
+                 auth_secret, root_email, disable_auth, token_secret,
+                 queue_uploads=False, single_revision_ingest=True,
+                 upload_workers=4, upload_max_inflight_bytes=64 * 1024 ** 2,
+                 image_workers=None, cover_widths=(160, 320, 640),
+                 tmp_dir=None, rendition_cache_max_bytes=1024 ** 3,
+                 dedupe_pages=True, max_upload_size=1024 ** 3,
+                 sandbox_extraction=True, extract_max_memory=1024 ** 3,
+                 extract_max_cpu_seconds=300, extract_max_members=10000,
+                 extract_max_page_bytes=128 * 1024 ** 2,
+                 extract_max_bytes=4 * 1024 ** 3,
+                 max_image_pixels=89478485, ingest_metrics=True,
+                 offload_prefix=None, offload_header='X-Accel-Redirect',
+                 signed_url_ttl=0, group_cache_ttl=30,
+                 group_cache_follow_changes=True, bearer_token_ttl=0,
+                 google_token_uri='https://www.googleapis.com/oauth2/v4/token',
+                 google_certs_uri='https://www.googleapis.com/oauth2/v1/certs',
+                 google_connect_timeout=3.05, google_read_timeout=10):
         self.disable_auth = disable_auth
         self.couchdb_url = couchdb_url
         self.auth_secret = auth_secret
@@ -30,6 +47,34 @@ class GodhandConfiguration(object):
         self.google_client_secret = google_client_secret
         self.root_email = root_email
         self.token_secret = token_secret
+        self.queue_uploads = queue_uploads
+        self.single_revision_ingest = single_revision_ingest
+        self.upload_workers = upload_workers
+        self.upload_max_inflight_bytes = upload_max_inflight_bytes
+        self.image_workers = image_workers
+        self.cover_widths = cover_widths
+        self.tmp_dir = tmp_dir or tempfile.gettempdir()
+        self.rendition_cache_max_bytes = rendition_cache_max_bytes
+        self.dedupe_pages = dedupe_pages
+        self.max_upload_size = max_upload_size
+        self.sandbox_extraction = sandbox_extraction
+        self.extract_max_memory = extract_max_memory
+        self.extract_max_cpu_seconds = extract_max_cpu_seconds
+        self.extract_max_members = extract_max_members
+        self.extract_max_page_bytes = extract_max_page_bytes
+        self.extract_max_bytes = extract_max_bytes
+        self.max_image_pixels = max_image_pixels
+        self.ingest_metrics = ingest_metrics
+        self.offload_prefix = offload_prefix
+        self.offload_header = offload_header
+        self.signed_url_ttl = signed_url_ttl
+        self.group_cache_ttl = group_cache_ttl
+        self.group_cache_follow_changes = group_cache_follow_changes
+        self.bearer_token_ttl = bearer_token_ttl
+        self.google_token_uri = google_token_uri
+        self.google_certs_uri = google_certs_uri
+        self.google_connect_timeout = google_connect_timeout
+        self.google_read_timeout = google_read_timeout
 
     def __repr__(self):
         attributes = ['{}={!r}'.format(k, getattr(self, k)) for k in (
@@ -44,6 +89,21 @@ def is_path(node, appstruct):
         raise co.Invalid(node, 'Path does not exist.')
 
 
+class IntegerList(co.String):
+    """ Comma separated integers, e.g. ``160,320,640``.
+    """
+    def deserialize(self, node, cstruct):
+        if isinstance(cstruct, (list, tuple)):
+            cstruct = ','.join(map(str, cstruct))
+        appstruct = super(IntegerList, self).deserialize(node, cstruct)
+        if appstruct is co.null:
+            return appstruct
+        try:
+            return [int(x) for x in appstruct.split(',') if x.strip()]
+        except ValueError:
+            raise co.Invalid(node, 'Expected comma separated integers.')
+
+
 class GodhandConfigurationSchema(co.MappingSchema):
     couchdb_url = co.SchemaNode(co.String(), validator=co.url)
     disable_auth = co.SchemaNode(co.Boolean(), missing=False)
@@ -53,3 +113,53 @@ class GodhandConfigurationSchema(co.MappingSchema):
     auth_secret = co.SchemaNode(co.String())
     token_secret = co.SchemaNode(co.String())
     root_email = co.SchemaNode(co.String())
+    queue_uploads = co.SchemaNode(co.Boolean(), missing=False)
+    single_revision_ingest = co.SchemaNode(co.Boolean(), missing=True)
+    upload_workers = co.SchemaNode(
+        co.Integer(), missing=4, validator=co.Range(min=1))
+    upload_max_inflight_bytes = co.SchemaNode(
+        co.Integer(), missing=64 * 1024 ** 2, validator=co.Range(min=1))
+    image_workers = co.SchemaNode(
+        co.Integer(), missing=None, validator=co.Range(min=0))
+    cover_widths = co.SchemaNode(IntegerList(), missing=[160, 320, 640])
+    tmp_dir = co.SchemaNode(co.String(), missing=None)
+    rendition_cache_max_bytes = co.SchemaNode(
+        co.Integer(), missing=1024 ** 3, validator=co.Range(min=0))
+    dedupe_pages = co.SchemaNode(co.Boolean(), missing=True)
+    max_upload_size = co.SchemaNode(
+        co.Integer(), missing=1024 ** 3, validator=co.Range(min=0))
+    sandbox_extraction = co.SchemaNode(co.Boolean(), missing=True)
+    extract_max_memory = co.SchemaNode(
+        co.Integer(), missing=1024 ** 3, validator=co.Range(min=0))
+    extract_max_cpu_seconds = co.SchemaNode(
+        co.Integer(), missing=300, validator=co.Range(min=0))
+    extract_max_members = co.SchemaNode(
+        co.Integer(), missing=10000, validator=co.Range(min=1))
+    extract_max_page_bytes = co.SchemaNode(
+        co.Integer(), missing=128 * 1024 ** 2, validator=co.Range(min=1))
+    extract_max_bytes = co.SchemaNode(
+        co.Integer(), missing=4 * 1024 ** 3, validator=co.Range(min=1))
+    max_image_pixels = co.SchemaNode(
+        co.Integer(), missing=89478485, validator=co.Range(min=1))
+    ingest_metrics = co.SchemaNode(co.Boolean(), missing=True)
+    offload_prefix = co.SchemaNode(co.String(), missing=None)
+    offload_header = co.SchemaNode(
+        co.String(), missing='X-Accel-Redirect',
+        validator=co.OneOf(['X-Accel-Redirect', 'X-Sendfile']))
+    signed_url_ttl = co.SchemaNode(
+        co.Integer(), missing=0, validator=co.Range(min=0))
+    group_cache_ttl = co.SchemaNode(
+        co.Integer(), missing=30, validator=co.Range(min=0))
+    group_cache_follow_changes = co.SchemaNode(co.Boolean(), missing=True)
+    bearer_token_ttl = co.SchemaNode(
+        co.Integer(), missing=0, validator=co.Range(min=0))
+    google_token_uri = co.SchemaNode(
+        co.String(), missing='https://www.googleapis.com/oauth2/v4/token',
+        validator=co.url)
+    google_certs_uri = co.SchemaNode(
+        co.String(), missing='https://www.googleapis.com/oauth2/v1/certs',
+        validator=co.url)
+    google_connect_timeout = co.SchemaNode(
+        co.Float(), missing=3.05, validator=co.Range(min=0))
+    google_read_timeout = co.SchemaNode(
+        co.Float(), missing=10, validator=co.Range(min=0))
@@ -0,0 +1,103 @@
+""" godhand.fakevolumes
+
+Generated book archives, for the tests and the ingest benchmark.
+
+"""
+from tempfile import NamedTemporaryFile
+import contextlib
+import os
+import tarfile
+import zipfile
+
+from PIL import Image
+
+
+class CbtFile(object):
+    """ A generated book archive.
+
+    By default pages are small flat PNGs of three different sizes. Passing
+    ``page_size`` makes every page a noisy image of that size instead, which
+    compresses about as badly as a scanned page; ``page_format`` is any
+    format Pillow can write.
+
+    """
+    ext = '.cbt'
+
+    def __init__(self, n_pages=15, page_size=None, page_format='png'):
+        self.n_pages = n_pages
+        self.page_size = page_size
+        self.page_format = page_format
+
+    @property
+    def pages(self):
+        if self.page_size:
+            widths = (self.page_size[0],)
+            heights = (self.page_size[1],)
+        else:
+            widths = (256, 128, 64)
+            heights = (128, 128, 128)
+        ext = 'jpg' if self.page_format == 'jpeg' else self.page_format
+        pages = []
+        for n in range(self.n_pages):
+            width = widths[n % len(widths)]
+            height = heights[n % len(heights)]
+            pages.append({
+                'filename': 'base/path/page-{:x}.{}'.format(n, ext),
+                'width': width,
+                'height': height,
+                'orientation':
+                    'vertical' if width < height else 'horizontal',
+                'black_pixel': (n % width, n % height),
+            })
+        return pages
+
+    @property
+    def expected_pages(self):
+        return [
+            dict(
+                width=x['width'],
+                height=x['height'],
+                orientation=x['orientation'],
+                filename=os.path.join('original', x['filename']),
+            )
+            for x in self.pages]
+
+    def render(self, page):
+        size = (page['width'], page['height'])
+        if self.page_size:
+            im = Image.effect_noise(size, 64).convert('RGB')
+        else:
+            im = Image.new('RGB', size)
+        im.putpixel(page['black_pixel'], (0xfe, 0xfe, 0xfe))
+        return im
+
+    @contextlib.contextmanager
+    def packaged(self):
+        with NamedTemporaryFile() as f:
+            with tarfile.open(fileobj=f, mode='w') as ar:
+                for o in self.pages:
+                    with NamedTemporaryFile() as mf:
+                        self.render(o).save(mf, self.page_format)
+                        mf.flush()
+                        ar.add(mf.name, o['filename'])
+            f.flush()
+            f.seek(0)
+            yield f
+
+
+class CbzFile(CbtFile):
+    ext = '.cbz'
+
+    @contextlib.contextmanager
+    def packaged(self):
+        with NamedTemporaryFile() as f:
+            with zipfile.ZipFile(f, mode='w') as ar:
+                for o in self.pages:
+                    with NamedTemporaryFile() as mf:
+                        self.render(o).save(mf, self.page_format)
+                        mf.flush()
+                        ar.write(mf.name, o['filename'])
+                ar.writestr('derp.db', 'abcedfg')
+            f.flush()
+            f.seek(0)
+            yield f
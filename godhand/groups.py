@@ -0,0 +1,109 @@
+""" godhand.groups
+
+Per-process cache of the groups :func:`godhand.groupfinder` resolves for a
+user, so authorizing a request needs no database work in the steady state.
+
+Entries expire after ``ttl`` seconds. Subscription writes in this process
+invalidate the subscriber's entry right away. Writes made by other processes
+are picked up by following the CouchDB ``_changes`` feed.
+
+"""
+from threading import Lock
+from threading import Thread
+import logging
+import time
+
+from .models import Subscription
+from .utils import owner_group
+from .utils import subscription_group
+
+LOG = logging.getLogger('godhand')
+
+
+def find_groups(db, userid):
+    subscriptions = Subscription.query(db, subscriber_id=userid)
+    return [
+        owner_group(userid)
+    ] + [
+        subscription_group(x.publisher_id) for x in subscriptions
+    ]
+
+
+class GroupCache(object):
+    """ user id -> groups, for at most ``ttl`` seconds; ``ttl=0`` disables
+    caching.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._groups = {}
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(self, userid, load):
+        """ The cached groups of ``userid``, or ``load()`` if there are none.
+        """
+        if not self.ttl:
+            return load()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._groups.get(userid)
+            generation = self._generation
+        if entry is not None and entry[0] > now:
+            return list(entry[1])
+        groups = load()
+        with self._lock:
+            # don't cache what may have been invalidated while loading
+            if generation == self._generation:
+                self._groups[userid] = (now + self.ttl, list(groups))
+        return groups
+
+    def invalidate(self, *userids):
+        with self._lock:
+            self._generation += 1
+            for userid in userids:
+                self._groups.pop(userid, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._groups.clear()
+
+
+class ChangesFollower(Thread):
+    """ Invalidate ``cache`` for every subscription changed in ``db``.
+
+    Subscriptions are stored as ``subscription:<publisher>:<subscriber>``,
+    so the subscriber is read off the id and no documents are fetched. After
+    an error the whole cache is cleared, as changes may have been missed.
+    """
+    timeout = 60
+    retry_interval = 5
+
+    def __init__(self, db, cache):
+        super(ChangesFollower, self).__init__(daemon=True)
+        self.db = db
+        self.cache = cache
+
+    def run(self):
+        since = 'now'
+        while True:
+            try:
+                changes = self.db.changes(
+                    feed='longpoll', since=since,
+                    timeout=self.timeout * 1000)
+            except Exception:
+                LOG.exception('Could not follow changes of groups.')
+                self.cache.clear()
+                time.sleep(self.retry_interval)
+                continue
+            since = changes['last_seq']
+            self.handle(changes['results'])
+
+    def handle(self, results):
+        userids = [
+            x['id'].split(':', 2)[2] for x in results
+            if x['id'].startswith('subscription:') and
+            x['id'].count(':') >= 2
+        ]
+        if userids:
+            self.cache.invalidate(*userids)
@@ -0,0 +1,214 @@
+""" godhand.imaging
+
+Pillow work runs here, on a process pool, so decoding and resizing never
+hold the GIL of a request thread. Functions submitted to the pool take and
+return plain bytes so they pickle cheaply.
+
+"""
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+import multiprocessing
+import os
+
+
+def image_size(data):
+    """ Return ``(width, height)`` of an encoded image or ``None``.
+    """
+    from PIL import Image
+    try:
+        with Image.open(BytesIO(data)) as im:
+            return im.size
+    except OSError:
+        return None
+
+
+def cover_size(width, height, min_width, min_height):
+    if height >= width:
+        return min_width, int(height * min_width / width)
+    return int(width * min_height / height), min_height
+
+
+def resize(data, min_width, min_height):
+    """ Scale an image down to cover ``min_width`` x ``min_height``.
+
+    :returns: JPEG bytes.
+    """
+    return covers(data, min_width, min_height)['cover.jpg']
+
+
+def covers(data, min_width, min_height, widths=()):
+    """ Build every cover of a page from a single decode.
+
+    ``cover.jpg`` covers ``min_width`` x ``min_height``; ``covers/{w}.jpg`` is
+    ``w`` pixels wide for every ``w`` in ``widths``. JPEG pages are decoded in
+    draft mode at the smallest scale that still fits the largest cover.
+
+    :returns: ``{attachment name: JPEG bytes}``
+    """
+    from PIL import Image
+    with Image.open(BytesIO(data)) as im:
+        width, height = im.size
+        sizes = {
+            'cover.jpg': cover_size(width, height, min_width, min_height),
+        }
+        for w in widths:
+            scaled = min(w, width)
+            sizes[cover_name(w)] = (
+                scaled, max(1, int(height * scaled / width)))
+        im.draft('RGB', max(sizes.values(), key=lambda x: x[0] * x[1]))
+        im = im.convert('RGB')
+        return {
+            name: _jpeg(im.resize(size, Image.BILINEAR))
+            for name, size in sizes.items()
+        }
+
+
+RENDITION_FORMATS = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp',
+}
+
+
+def can_encode(fmt):
+    """ Whether Pillow was built with an encoder for ``fmt``, e.g. ``webp``
+    needs libwebp.
+    """
+    from PIL import Image
+    Image.init()
+    return fmt.upper() in Image.SAVE
+
+
+def rendition(data, width=None, fmt='jpeg'):
+    """ Re-encode a page as ``fmt``, scaled down to ``width`` if narrower.
+
+    :returns: encoded bytes.
+    """
+    from PIL import Image
+    with Image.open(BytesIO(data)) as im:
+        if width and width < im.size[0]:
+            size = (width, max(1, int(im.size[1] * width / im.size[0])))
+            im.draft('RGB', size)
+            im = im.resize(size, Image.BILINEAR)
+        if fmt == 'jpeg':
+            im = im.convert('RGB')
+        f = BytesIO()
+        im.save(f, fmt.upper())
+        return f.getvalue()
+
+
+def cover_name(width):
+    return 'covers/{}.jpg'.format(width)
+
+
+def closest_width(widths, width):
+    """ Smallest of ``widths`` that is at least ``width``, else the largest.
+    """
+    larger = [x for x in widths if x >= width]
+    return min(larger) if larger else max(widths)
+
+
+def _jpeg(im):
+    f = BytesIO()
+    im.save(f, 'JPEG')
+    return f.getvalue()
+
+
+class ImageProcessor(object):
+    """ Run imaging functions on a process pool.
+
+    With ``workers=0`` everything runs in the calling thread, which is what
+    the tests use. ``workers=None`` starts one process per core.
+
+    Pool processes apply ``limits`` (see :class:`godhand.sandbox.Limits`)
+    before their first task, so a decompression bomb fails its task instead
+    of exhausting the host. A pool whose worker died is replaced.
+
+    Entry points call :func:`use_forkserver` first. Workers are then
+    started by a fork server rather than forked from the caller. By the
+    time the first task is submitted, the caller is usually an API process
+    running several threads, and a child forked from it could inherit
+    locks held by those threads.
+    """
+    def __init__(self, workers=None, limits=None):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.workers = workers
+        self.limits = limits
+        self._executor = None
+        if workers:
+            self._executor = self._pool()
+
+    def submit(self, fn, *args):
+        if self._executor:
+            try:
+                return self._executor.submit(_limited, self.limits, fn, *args)
+            except BrokenProcessPool:
+                self._executor = self._pool()
+                return self._executor.submit(_limited, self.limits, fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    def run(self, fn, *args):
+        return self.result(self.submit(fn, *args))
+
+    def result(self, future):
+        """ The result of a :meth:`submit` future.
+
+        A worker killed while running the task, e.g. by one of the
+        ``limits``, fails the task with
+        :class:`godhand.sandbox.LimitExceeded`.
+        """
+        from .sandbox import LimitExceeded
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            raise LimitExceeded('An image worker was killed.')
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown()
+
+
+def use_forkserver():
+    """ Start new processes from a fork server, unless the start method is
+    already chosen.
+
+    ``ProcessPoolExecutor`` only takes a start method of its own from
+    Python 3.7, so it is set for the whole process.
+    """
+    if multiprocessing.get_start_method(allow_none=True) is None:
+        multiprocessing.set_start_method('forkserver')
+
+
+_limits_applied = False
+
+
+def _limited(limits, fn, *args):
+    from PIL import Image
+    from .sandbox import LimitExceeded
+    global _limits_applied
+    if limits is None:
+        return fn(*args)
+    if not _limits_applied:
+        limits.apply(cpu=False)
+        _limits_applied = True
+    try:
+        return fn(*args)
+    except (MemoryError, Image.DecompressionBombWarning,
+            # only raised by Pillow>=5.0
+            getattr(Image, 'DecompressionBombError',
+                    Image.DecompressionBombWarning)) as e:
+        raise LimitExceeded(str(e) or e.__class__.__name__)
+
+
+INLINE = ImageProcessor(workers=0)
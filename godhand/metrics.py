@@ -0,0 +1,121 @@
+""" godhand.metrics
+
+Measuring where the time and memory of an ingest go.
+
+The stages of :meth:`godhand.models.Volume.from_archieve` are pipelined, so
+:class:`StageTimer` charges time exclusively: entering a stage pauses the
+one it was entered from, and every second of the ingest is counted once.
+:class:`ResourceSampler` samples memory and temp-disk use in a background
+thread.
+
+"""
+from contextlib import contextmanager
+from threading import Event
+from threading import Thread
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+
+class StageTimer(object):
+    """ Wall time and bytes processed per named stage.
+    """
+    def __init__(self):
+        self.stages = {}
+        self._stack = []
+        self._mark = None
+
+    @contextmanager
+    def stage(self, name, nbytes=0):
+        now = time.time()
+        if self._stack:
+            self._charge(now)
+        self._stack.append(name)
+        self._mark = now
+        self.add_bytes(name, nbytes)
+        try:
+            yield
+        finally:
+            self._charge(time.time())
+            self._stack.pop()
+
+    def timed(self, name, iterable):
+        """ Charge the time spent producing each item of ``iterable`` to
+        ``name``.
+        """
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    x = next(it)
+                except StopIteration:
+                    return
+            yield x
+
+    def add_bytes(self, name, nbytes):
+        self._get(name)['bytes'] += nbytes
+
+    def _get(self, name):
+        return self.stages.setdefault(name, {'seconds': 0.0, 'bytes': 0})
+
+    def _charge(self, now):
+        self._get(self._stack[-1])['seconds'] += now - self._mark
+        self._mark = now
+
+
+class ResourceSampler(object):
+    """ Track peak RSS and temp-disk use while the context is active.
+
+    RSS is the sum of this process and its children, e.g. image workers.
+    Both figures cover everything running on the machine at the same time,
+    including concurrent ingests.
+    """
+    def __init__(self, tmp_dir=None, interval=0.02):
+        self.tmp_dir = tmp_dir or tempfile.gettempdir()
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._disk_start = None
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._disk_start = self.disk_used()
+        self.sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.rss())
+        self.peak_disk = max(
+            self.peak_disk, self.disk_used() - self._disk_start)
+
+    def rss(self):
+        pids = [os.getpid()] + [
+            x.pid for x in multiprocessing.active_children()]
+        total = 0
+        for pid in pids:
+            try:
+                with open('/proc/{}/statm'.format(pid)) as f:
+                    total += int(f.read().split()[1]) * resource.getpagesize()
+            except (IOError, ValueError):
+                if pid == os.getpid():
+                    # no procfs: fall back to the lifetime peak of the process
+                    return resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss * 1024
+        return total
+
+    def disk_used(self):
+        st = os.statvfs(self.tmp_dir)
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
@@ -1,14 +1,20 @@
 from .auth import AntiForgeryToken  # noqa
 from .bookmark import Bookmark
+from .ingest import IngestJob
+from .metrics import IngestMetrics
 from .series import Series
 from .subscription import Subscription
+from .upload import UploadSession
 from .user import UserSettings
 from .volume import Volume
 
 
 def init_views(db):
     Bookmark.sync(db)
+    IngestJob.sync(db)
+    IngestMetrics.sync(db)
     Series.sync(db)
     Subscription.sync(db)
+    UploadSession.sync(db)
     UserSettings.owner_by_subscriber.sync(db)
     Volume.sync(db)
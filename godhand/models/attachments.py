@@ -0,0 +1,436 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from threading import Condition
+from threading import Lock
+from uuid import uuid4
+import json
+import logging
+import mimetypes
+import random
+import time
+
+import couchdb.http
+import requests
+
+from ..utils import batched
+
+LOG = logging.getLogger('godhand')
+
+
+class PooledUploader(object):
+    """ Run writes on a bounded thread pool.
+
+    :meth:`submit` blocks while more than ``max_inflight_bytes`` are waiting
+    to be written, so the producer cannot run far ahead of CouchDB.
+
+    """
+    def __init__(self, db, workers=4, max_inflight_bytes=64 * 1024 ** 2):
+        self.db = db
+        self.workers = workers
+        self.max_inflight_bytes = max_inflight_bytes
+        self._inflight = 0
+        self._inflight_cond = Condition()
+        self._futures = []
+        self._executor = None
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.time()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._executor.shutdown(wait=True)
+
+    def submit(self, f, size, fn, *args):
+        """ Queue ``fn(f, *args)``; ``f`` is closed once it returns.
+        """
+        with self._inflight_cond:
+            while self._inflight and \
+                    self._inflight + size > self.max_inflight_bytes:
+                self._inflight_cond.wait()
+            self._inflight += size
+        self._futures.append(self._executor.submit(
+            self._run, f, size, fn, *args))
+
+    def wait(self):
+        """ Wait for all queued writes and re-raise the first failure.
+
+        Returns the seconds since the pool started.
+        """
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        return max(time.time() - self._started, 1e-6)
+
+    def _run(self, f, size, fn, *args):
+        try:
+            fn(f, *args)
+        finally:
+            f.close()
+            with self._inflight_cond:
+                self._inflight -= size
+                self._inflight_cond.notify_all()
+
+
+class AttachmentUploader(PooledUploader):
+    """ Upload attachments of a single document from a bounded thread pool.
+
+    Pages are handed over with :meth:`put` as soon as they are probed, so
+    reading the archive overlaps with the CouchDB writes. :meth:`put` blocks
+    while more than ``max_inflight_bytes`` are waiting to be written.
+
+    Every attachment write bumps the document revision, so concurrent writes
+    race for ``_rev``. A worker that loses the race re-reads the current
+    revision and retries after a short randomised back-off.
+
+    """
+    max_retries = 20
+    backoff = 0.01
+
+    def __init__(self, db, doc, workers=4, max_inflight_bytes=64 * 1024 ** 2):
+        super(AttachmentUploader, self).__init__(
+            db, workers, max_inflight_bytes)
+        self.doc_id = doc['_id']
+        self.pages = 0
+        self.bytes = 0
+        self.conflicts = 0
+        self._rev = doc['_rev']
+        self._rev_lock = Lock()
+
+    @property
+    def rev(self):
+        with self._rev_lock:
+            return self._rev
+
+    def put(self, f, filename, size, on_done=None):
+        """ Queue ``f`` to be written as attachment ``filename``.
+
+        ``f`` must be seekable and is closed once written.
+        """
+        self.submit(f, size, self._put, filename, size, on_done)
+
+    def join(self):
+        """ Wait for all queued writes and re-raise the first failure.
+        """
+        elapsed = self.wait()
+        LOG.info(
+            'Uploaded {} pages ({} bytes) to {} in {:.2f}s: {:.1f} pages/s, '
+            '{} conflicts, {} workers'.format(
+                self.pages, self.bytes, self.doc_id, elapsed,
+                self.pages / elapsed, self.conflicts, self.workers))
+        return self.rev
+
+    def commit(self, fields):
+        """ Wait for every attachment, then store ``fields`` on the document.
+        """
+        self.join()
+        doc = self.db[self.doc_id]
+        doc.update(fields)
+        self.db.save(doc)
+        return doc['_rev']
+
+    def abort(self):
+        doc = self.db.get(self.doc_id)
+        if doc is not None:
+            self.db.delete(doc)
+
+    def _put(self, f, filename, size, on_done):
+        for attempt in range(self.max_retries):
+            doc = {'_id': self.doc_id, '_rev': self.rev}
+            f.seek(0)
+            try:
+                self.db.put_attachment(doc, f, filename=filename)
+            except couchdb.http.ResourceConflict:
+                self._refresh_rev()
+                time.sleep(random.uniform(0, self.backoff * attempt))
+                continue
+            self._update_rev(doc['_rev'])
+            break
+        else:
+            raise couchdb.http.ResourceConflict(
+                'Could not write {} to {} after {} attempts'.format(
+                    filename, self.doc_id, self.max_retries))
+        with self._rev_lock:
+            self.pages += 1
+            self.bytes += size
+        if on_done:
+            on_done(filename)
+
+    def _refresh_rev(self):
+        _, headers, _ = self.db.resource.head(self.doc_id)
+        with self._rev_lock:
+            self.conflicts += 1
+        self._update_rev(headers['etag'].strip('"'))
+
+    def _update_rev(self, rev):
+        with self._rev_lock:
+            if rev_number(rev) > rev_number(self._rev):
+                self._rev = rev
+
+
+class BlobUploader(PooledUploader):
+    """ Write content-addressed blobs from a bounded thread pool.
+
+    A blob is a document holding a single attachment, with an id derived from
+    the hash of its content. Blobs that already exist are not written again.
+
+    A blob can be deleted once nothing refers to it, which may happen while
+    an ingest that is about to use it is still running. So each blob is
+    first leased by storing the ``lease`` document passed to :meth:`put`,
+    which must count as a reference. Then an existing blob has its revision
+    bumped instead of being skipped outright. A delete that read the blob
+    before the lease existed fails on the revision, and a blob deleted
+    before that is written again. Leases are dropped by
+    :meth:`release_leases` once the documents using the blobs are stored.
+
+    """
+    max_retries = 20
+    backoff = 0.01
+
+    def __init__(self, db, workers=4, max_inflight_bytes=64 * 1024 ** 2):
+        super(BlobUploader, self).__init__(db, workers, max_inflight_bytes)
+        self.written = 0
+        self.skipped = 0
+        self.bytes = 0
+        self._leases = []
+        self._lock = Lock()
+
+    def put(self, f, doc_id, filename, size, content_type=None, lease=None):
+        """ Queue ``f`` to be written as ``filename`` of blob ``doc_id``.
+
+        ``f`` is closed once written or skipped.
+        """
+        self.submit(
+            f, size, self._put, doc_id, filename, size, content_type, lease)
+
+    def join(self):
+        """ Wait for all queued writes and re-raise the first failure.
+        """
+        elapsed = self.wait()
+        LOG.info(
+            'Wrote {} blobs ({} bytes), skipped {} existing in {:.2f}s'.format(
+                self.written, self.bytes, self.skipped, elapsed))
+
+    def release_leases(self):
+        with self._lock:
+            leases, self._leases = self._leases, []
+        for batch in batched(leases, 500):
+            self.db.update([dict(x, _deleted=True) for x in batch])
+
+    def _put(self, f, doc_id, filename, size, content_type, lease):
+        if lease is not None:
+            self._lease(lease)
+        written = self._store(f, doc_id, filename, content_type)
+        with self._lock:
+            if written:
+                self.written += 1
+                self.bytes += size
+            else:
+                self.skipped += 1
+
+    def _lease(self, lease):
+        lease = dict(lease)
+        try:
+            self.db.save(lease)
+        except couchdb.http.ResourceConflict:
+            # the same page occurs twice in the volume, already leased
+            return
+        with self._lock:
+            self._leases.append({'_id': lease['_id'], '_rev': lease['_rev']})
+
+    def _store(self, f, doc_id, filename, content_type):
+        """ Write the blob, or bump the revision of the existing one.
+
+        Returns whether the blob was written.
+        """
+        for attempt in range(self.max_retries):
+            doc = self.db.get(doc_id)
+            try:
+                if doc is None:
+                    f.seek(0)
+                    self.db.put_attachment(
+                        {'_id': doc_id, '_rev': None}, f, filename=filename,
+                        content_type=content_type)
+                    return True
+                self.db.save(doc)
+                return False
+            except couchdb.http.ResourceConflict:
+                time.sleep(random.uniform(0, self.backoff * attempt))
+        raise couchdb.http.ResourceConflict(
+            'Could not store blob {} after {} attempts'.format(
+                doc_id, self.max_retries))
+
+
+def rev_number(rev):
+    return int(rev.split('-', 1)[0])
+
+
+class MultipartWriter(object):
+    """ Commit a new document and all of its attachments as one revision.
+
+    Attachments are staged in a single temporary file on disk and streamed
+    to CouchDB as a ``multipart/related`` PUT by :meth:`commit`, so memory
+    use stays bounded by the copy buffer however large the volume is.
+
+    The interface matches :class:`AttachmentUploader`.
+
+    """
+    def __init__(self, db, doc):
+        self.db = db
+        self.doc = doc
+        self.doc_id = doc['_id']
+        self.pages = 0
+        self.bytes = 0
+        self._attachments = []
+        self._stage = None
+
+    def __enter__(self):
+        self._stage = TemporaryFile()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stage.close()
+
+    def put(self, f, filename, size, on_done=None):
+        try:
+            offset = self._stage.tell()
+            copyfileobj(f, self._stage)
+            length = self._stage.tell() - offset
+        finally:
+            f.close()
+        self._attachments.append((filename, offset, length))
+        self.pages += 1
+        self.bytes += length
+        if on_done:
+            on_done(filename)
+
+    def commit(self, fields):
+        started = time.time()
+        rev = put_multipart(
+            self.db, dict(self.doc, **fields), self._stage,
+            self._attachments)
+        elapsed = max(time.time() - started, 1e-6)
+        LOG.info(
+            'Committed {} with {} attachments ({} bytes) in {:.2f}s'.format(
+                self.doc_id, self.pages, self.bytes, elapsed))
+        return rev
+
+    def abort(self):
+        pass
+
+
+def put_multipart(db, doc, stage, attachments):
+    """ Write ``doc`` and its attachments in a single request.
+
+    ``attachments`` is a list of ``(filename, offset, length)`` of data
+    staged in ``stage``. Returns the new revision.
+
+    :raises couchdb.http.ResourceConflict: if ``doc`` is out of date.
+    """
+    doc = dict(doc)
+    doc['_attachments'] = OrderedDict(
+        (filename, {
+            'follows': True,
+            'content_type': guess_content_type(filename),
+            'length': length,
+        })
+        for filename, _, length in attachments
+    )
+    body = MultipartStream(doc, stage, attachments)
+    r = requests.put(
+        '{}/{}'.format(db.resource.url, doc['_id']),
+        data=body,
+        headers={'Content-Type': body.content_type},
+        auth=db.resource.credentials,
+    )
+    if r.status_code == 409:
+        raise couchdb.http.ResourceConflict(r.text)
+    r.raise_for_status()
+    return r.json()['rev']
+
+
+class MultipartStream(object):
+    """ File-like ``multipart/related`` body for a document with attachments.
+
+    Attachment parts are read lazily from ``stage`` in the order given by
+    ``attachments``, a list of ``(filename, offset, length)``.
+
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, doc, stage, attachments):
+        boundary = uuid4().hex
+        self.content_type = 'multipart/related; boundary="{}"'.format(
+            boundary)
+        delimiter = '\r\n--{}\r\n\r\n'.format(boundary).encode()
+        head = (
+            '--{}\r\nContent-Type: application/json\r\n\r\n'.format(
+                boundary).encode() +
+            json.dumps(doc).encode()
+        )
+        self._segments = [head]
+        for _, offset, length in attachments:
+            self._segments.append(delimiter)
+            self._segments.append((stage, offset, length))
+        self._segments.append('\r\n--{}--'.format(boundary).encode())
+        self._length = sum(
+            len(x) if isinstance(x, bytes) else x[2] for x in self._segments)
+        self._segments.reverse()
+        self._current = b''
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        while size > 0:
+            if not self._current:
+                if not self._segments:
+                    break
+                self._current = self._next_segment()
+                continue
+            chunk, self._current = self._read_current(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _next_segment(self):
+        segment = self._segments.pop()
+        if isinstance(segment, bytes):
+            return segment
+        f, offset, length = segment
+        return _FileSlice(f, offset, length)
+
+    def _read_current(self, size):
+        if isinstance(self._current, bytes):
+            return self._current[:size], self._current[size:]
+        chunk = self._current.read(min(size, self.chunk_size))
+        return chunk, self._current if self._current.remaining else b''
+
+
+class _FileSlice(object):
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.remaining = length
+
+    def __bool__(self):
+        return True
+
+    def read(self, size):
+        self.f.seek(self.offset)
+        chunk = self.f.read(min(size, self.remaining))
+        if len(chunk) == 0 and self.remaining:
+            raise IOError('Staged attachment is truncated.')
+        self.offset += len(chunk)
+        self.remaining -= len(chunk)
+        return chunk
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -0,0 +1,78 @@
+from couchdb.mapping import ViewField
+import couchdb.http
+
+from .utils import GodhandDocument
+
+
+class PageBlob(GodhandDocument):
+    """ A page stored once, under the sha256 of its content.
+
+    Volume pages with a ``sha256`` refer to the ``page`` attachment of the
+    blob instead of carrying the page themselves, so the same page uploaded
+    to several volumes is stored once. Blobs are reference counted by the
+    ``refs`` view and deleted by :meth:`release` when no volume uses them.
+    An ingest that is still running holds a :meth:`lease` on each of its
+    blobs, which counts as a reference.
+
+    """
+    ATTACHMENT = 'page'
+
+    refs = ViewField('page-blob-refs', '''
+    function(doc) {
+        if (doc['@class'] === 'Volume') {
+            doc.pages.forEach(function(x) {
+                if (x.sha256) {
+                    emit(x.sha256, null);
+                }
+            });
+        }
+        if (doc['@class'] === 'PageBlobLease') {
+            emit(doc.sha256, null);
+        }
+    }
+    ''', '_count', wrapper=lambda x: x)
+
+    @classmethod
+    def sync(cls, db):
+        cls.refs.sync(db)
+
+    @staticmethod
+    def key(sha256):
+        return 'blob:sha256:{}'.format(sha256)
+
+    @staticmethod
+    def lease(holder, sha256):
+        """ Document reserving the blob of ``sha256`` for ``holder``.
+        """
+        return {
+            '_id': 'blob-lease:{}:{}'.format(holder, sha256),
+            '@class': 'PageBlobLease',
+            'holder': holder,
+            'sha256': sha256,
+        }
+
+    @classmethod
+    def open(cls, db, sha256):
+        return db.get_attachment(cls.key(sha256), cls.ATTACHMENT)
+
+    @classmethod
+    def count_refs(cls, db, sha256):
+        return sum(x['value'] for x in cls.refs(db, key=sha256))
+
+    @classmethod
+    def release(cls, db, sha256s):
+        """ Delete the blobs of ``sha256s`` that no volume refers to anymore.
+
+        The blob is read before its references are counted. An ingest that
+        leases it after the count also bumps its revision, so the delete
+        then fails on the revision instead of removing the blob.
+        """
+        for sha256 in set(sha256s):
+            doc = db.get(cls.key(sha256))
+            if doc is None or cls.count_refs(db, sha256):
+                continue
+            try:
+                db.delete(doc)
+            except (couchdb.http.ResourceConflict,
+                    couchdb.http.ResourceNotFound):
+                pass
@@ -0,0 +1,240 @@
+from datetime import datetime
+from datetime import timedelta
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from threading import Event
+from threading import Lock
+from threading import Thread
+import logging
+import time
+
+from couchdb.mapping import DateTimeField
+from couchdb.mapping import IntegerField
+from couchdb.mapping import TextField
+from couchdb.mapping import ViewField
+import couchdb.http
+
+from ..sandbox import Limits
+from .series import Series
+from .utils import GodhandDocument
+from .volume import Volume
+
+LOG = logging.getLogger('godhand')
+
+
+class JobLost(Exception):
+    """ Another worker claimed the job while this one was running it.
+    """
+
+
+class IngestJob(GodhandDocument):
+    """ A queued volume upload.
+
+    The uploaded archive is stored as the ``archive`` attachment until a
+    ``godhand-cli worker`` claims the job, ingests it with
+    :meth:`Volume.from_archieve` and adds the volume to the series.
+
+    A running job whose worker stops updating it for ``lease`` is considered
+    abandoned and may be claimed again. While it runs, the job is touched
+    every ``heartbeat_interval`` as well as on progress, so stages without
+    progress such as hashing and extracting do not outlive the lease.
+
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    lease = timedelta(minutes=10)
+    progress_interval = 2.0
+    heartbeat_interval = 60.0
+
+    class_ = TextField('@class', default='IngestJob')
+    owner_id = TextField()
+    series_id = TextField()
+    filename = TextField()
+    status = TextField(default=QUEUED)
+    pages_done = IntegerField(default=0)
+    pages_total = IntegerField()
+    volume_id = TextField()
+    error = TextField()
+    worker_id = TextField()
+    created = DateTimeField(default=datetime.utcnow)
+    updated = DateTimeField(default=datetime.utcnow)
+
+    @classmethod
+    def sync(cls, db):
+        cls.by_status_updated.sync(db)
+
+    @classmethod
+    def create(cls, db, owner_id, series_id, filename, fd):
+        """ Store the archive, then queue the job.
+
+        Until the job fields are written the document holds nothing but the
+        archive, so no worker can claim a job whose archive is missing.
+        """
+        doc = {'_id': cls.generate_id(), '_rev': None}
+        db.put_attachment(
+            doc, fd, filename='archive',
+            content_type='application/octet-stream')
+        job = cls(owner_id=owner_id, series_id=series_id, filename=filename)
+        job._data.update(db[doc['_id']])
+        job.store(db)
+        cls.sync(db)
+        return job
+
+    by_status_updated = ViewField('ingest-jobs-by-status-updated', '''
+    function(doc) {
+        if (doc['@class'] === 'IngestJob') {
+            emit([doc.status, doc.updated], {_id: doc.id});
+        }
+    }
+    ''')
+
+    @classmethod
+    def iter_claimable(cls, db, now=None):
+        now = now or datetime.utcnow()
+        for x in cls.by_status_updated(
+                db, startkey=[cls.QUEUED], endkey=[cls.QUEUED, {}],
+                include_docs=True):
+            yield x
+        stale = DateTimeField()._to_json(now - cls.lease)
+        for x in cls.by_status_updated(
+                db, startkey=[cls.RUNNING], endkey=[cls.RUNNING, stale],
+                include_docs=True):
+            yield x
+
+    @classmethod
+    def claim_next(cls, db, worker_id):
+        """ Mark the oldest claimable job as ours and return it.
+
+        Two workers claiming the same job race on its revision; the loser
+        moves on to the next job.
+        """
+        for job in cls.iter_claimable(db):
+            job.status = cls.RUNNING
+            job.worker_id = worker_id
+            job.updated = datetime.utcnow()
+            try:
+                job.store(db)
+            except couchdb.http.ResourceConflict:
+                continue
+            cls.sync(db)
+            return job
+        return None
+
+    def run(self, db, cfg, images):
+        """ Ingest the archive and record the outcome on the job.
+
+        If another worker reclaims the job meanwhile, the ingest stops and
+        the job is left to that worker.
+        """
+        last_update = [0]
+        lock = Lock()
+        lost = Event()
+        done = Event()
+
+        def touch():
+            with lock:
+                if lost.is_set():
+                    raise JobLost()
+                try:
+                    self.touch(db)
+                except couchdb.http.ResourceConflict:
+                    lost.set()
+                    raise JobLost()
+
+        def heartbeat():
+            while not done.wait(self.heartbeat_interval):
+                try:
+                    touch()
+                except JobLost:
+                    return
+                except Exception:
+                    LOG.exception('IngestJob<{}> heartbeat failed.'.format(
+                        self.id))
+
+        def progress(pages_done, pages_total):
+            self.pages_done = pages_done
+            self.pages_total = pages_total
+            if lost.is_set():
+                raise JobLost()
+            if time.time() - last_update[0] > self.progress_interval:
+                last_update[0] = time.time()
+                touch()
+
+        beat = Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            with TemporaryFile() as fd:
+                archive = db.get_attachment(self.id, 'archive')
+                if archive is None:
+                    raise ValueError('The uploaded archive is missing.')
+                try:
+                    copyfileobj(archive, fd)
+                finally:
+                    archive.close()
+                fd.seek(0)
+                volume = Volume.from_archieve(
+                    db,
+                    owner_id=self.owner_id,
+                    filename=self.filename,
+                    fd=fd,
+                    single_revision=cfg.single_revision_ingest,
+                    upload_workers=cfg.upload_workers,
+                    upload_max_inflight_bytes=cfg.upload_max_inflight_bytes,
+                    progress=progress,
+                    images=images,
+                    cover_widths=cfg.cover_widths,
+                    dedupe=cfg.dedupe_pages,
+                    sandbox=Limits.from_config(cfg),
+                    metrics=cfg.ingest_metrics,
+                )
+            if lost.is_set():
+                volume.delete(db)
+                raise JobLost()
+            Series.load(db, self.series_id).add_volume(
+                db, owner_id=self.owner_id, volume=volume)
+        except JobLost:
+            return self._lost()
+        except Exception as e:
+            LOG.exception('IngestJob<{}> failed.'.format(self.id))
+            self.status = self.FAILED
+            self.error = str(e) or e.__class__.__name__
+        else:
+            self.status = self.DONE
+            self.volume_id = volume.id
+            self.pages_total = self.pages_done = len(volume.pages)
+        finally:
+            done.set()
+            beat.join()
+        try:
+            self.touch(db)
+            if 'archive' in self._data.get('_attachments', {}):
+                db.delete_attachment(self._data, 'archive')
+        except couchdb.http.ResourceConflict:
+            return self._lost()
+        self.sync(db)
+        return self
+
+    def _lost(self):
+        LOG.warning('IngestJob<{}> was lost to another worker.'.format(
+            self.id))
+        return self
+
+    def touch(self, db):
+        self.updated = datetime.utcnow()
+        self.store(db)
+
+    def as_dict(self, request):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'series_id': self.series_id,
+            'pages_done': self.pages_done,
+            'pages_total': self.pages_total,
+            'volume_id': self.volume_id,
+            'error': self.error,
+            'url': request.route_url('ingest job', job=self.id),
+        }
@@ -0,0 +1,84 @@
+from datetime import datetime
+
+from couchdb.mapping import DateTimeField
+from couchdb.mapping import DictField
+from couchdb.mapping import FloatField
+from couchdb.mapping import IntegerField
+from couchdb.mapping import TextField
+from couchdb.mapping import ViewField
+
+from .utils import GodhandDocument
+
+
+class IngestMetrics(GodhandDocument):
+    """ Where the time of one :meth:`Volume.from_archieve` went.
+
+    ``stages`` maps stage names (``hash``, ``extract``, ``probe``,
+    ``upload``, ``covers``, ``sync``) to the wall time charged to them and
+    the bytes they handled. ``settings`` are the ingest parameters the
+    volume was created with, so runs can be compared when tuning.
+
+    """
+    class_ = TextField('@class', default='IngestMetrics')
+    volume_id = TextField()
+    owner_id = TextField()
+    filename = TextField()
+    status = TextField()
+    error = TextField()
+    started = DateTimeField()
+    finished = DateTimeField(default=datetime.utcnow)
+    seconds = FloatField()
+    pages = IntegerField()
+    archive_bytes = IntegerField()
+    peak_rss_bytes = IntegerField()
+    temp_disk_bytes = IntegerField()
+    stages = DictField()
+    settings = DictField()
+
+    by_finished = ViewField('ingest-metrics-by-finished', '''
+    function(doc) {
+        if (doc['@class'] === 'IngestMetrics') {
+            emit(doc.finished, {_id: doc.id});
+        }
+    }
+    ''')
+
+    @classmethod
+    def sync(cls, db):
+        cls.by_finished.sync(db)
+
+    @staticmethod
+    def key(volume_id):
+        return 'ingest-metrics:{}'.format(volume_id)
+
+    @classmethod
+    def for_volume(cls, db, volume_id):
+        return cls.load(db, cls.key(volume_id))
+
+    @classmethod
+    def query(cls, db, since=None, limit=None):
+        """ Metrics of the ingests finished after ``since``, newest first.
+        """
+        kws = {'descending': True, 'include_docs': True}
+        if since is not None:
+            kws['startkey'] = {}
+            kws['endkey'] = DateTimeField()._to_json(since)
+        if limit is not None:
+            kws['limit'] = limit
+        return list(cls.by_finished(db, **kws))
+
+    def as_dict(self):
+        return {
+            'volume_id': self.volume_id,
+            'filename': self.filename,
+            'status': self.status,
+            'error': self.error,
+            'finished': self.finished.isoformat(),
+            'seconds': self.seconds,
+            'pages': self.pages,
+            'archive_bytes': self.archive_bytes,
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'temp_disk_bytes': self.temp_disk_bytes,
+            'stages': dict(self.stages),
+            'settings': dict(self.settings),
+        }
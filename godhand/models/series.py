@@ -98,9 +98,14 @@ class Series(GodhandDocument):
         instance = self.retrieve_owner_instance(db, owner_id)
         volume.set_volume_collection(db, instance)
 
-    def get_cover(self, db):
-        from .volume import Volume
-        volume = Volume.first(db, self.id)
+    def get_cover(self, db, width=None):
+        volume = self.cover_volume(db)
         if volume:
-            return volume.get_cover(db)
+            return volume.get_cover(db, width)
         return None
+
+    def cover_volume(self, db):
+        """ The volume whose cover is the cover of the series.
+        """
+        from .volume import Volume
+        return Volume.first(db, self.id)
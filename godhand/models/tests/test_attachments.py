@@ -0,0 +1,134 @@
+from io import BytesIO
+
+import couchdb.http
+import mock
+
+
+class TestAttachmentUploader(object):
+    def setup(self):
+        from ..attachments import AttachmentUploader
+        self.cls = AttachmentUploader
+        self.db = mock.Mock()
+        self.revs = iter('{}-abc'.format(n) for n in range(2, 100))
+
+        def put_attachment(doc, f, filename):
+            assert f.read() == filename.encode()
+            doc['_rev'] = next(self.revs)
+
+        self.db.put_attachment.side_effect = put_attachment
+
+    def test_put(self):
+        with self.cls(self.db, {'_id': 'doc', '_rev': '1-abc'}) as up:
+            for n in range(10):
+                filename = 'page-{}'.format(n)
+                up.put(BytesIO(filename.encode()), filename, 6)
+            up.join()
+        assert 10 == up.pages
+        assert 60 == up.bytes
+        assert '11-abc' == up.rev
+
+    def test_conflict(self):
+        put_attachment = self.db.put_attachment.side_effect
+        conflicts = [couchdb.http.ResourceConflict('conflict')]
+
+        def conflicting(doc, f, filename):
+            if conflicts:
+                raise conflicts.pop()
+            return put_attachment(doc, f, filename)
+
+        self.db.put_attachment.side_effect = conflicting
+        self.db.resource.head.return_value = (200, {'etag': '"5-def"'}, None)
+        with self.cls(self.db, {'_id': 'doc', '_rev': '1-abc'}) as up:
+            up.put(BytesIO(b'page'), 'page', 4)
+            up.join()
+        assert 1 == up.conflicts
+        assert 1 == up.pages
+        self.db.resource.head.assert_called_once_with('doc')
+
+    def test_failure(self):
+        self.db.put_attachment.side_effect = ValueError('boom')
+        try:
+            with self.cls(self.db, {'_id': 'doc', '_rev': '1-abc'}) as up:
+                up.put(BytesIO(b'page'), 'page', 4)
+                up.join()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised.')
+
+
+class TestBlobUploader(object):
+    def setup(self):
+        from ..attachments import BlobUploader
+        self.cls = BlobUploader
+        self.db = mock.MagicMock()
+        self.stored = {'blob-a': {'_id': 'blob-a', '_rev': '1-a'}}
+        self.db.get.side_effect = lambda x: self.stored.get(x)
+
+    def test_put(self):
+        with self.cls(self.db) as up:
+            up.put(BytesIO(b'a'), 'blob-a', 'page', 1)
+            up.put(BytesIO(b'bb'), 'blob-b', 'page', 2, 'image/png')
+            up.join()
+        assert (1, 1, 2) == (up.written, up.skipped, up.bytes)
+        self.db.put_attachment.assert_called_once_with(
+            {'_id': 'blob-b', '_rev': None}, mock.ANY, filename='page',
+            content_type='image/png')
+        # existing blobs get a new revision
+        self.db.save.assert_called_once_with(self.stored['blob-a'])
+
+    def test_created_concurrently(self):
+        def created(doc, *args, **kws):
+            self.stored['blob-b'] = {'_id': 'blob-b', '_rev': '1-b'}
+            raise couchdb.http.ResourceConflict('conflict')
+        self.db.put_attachment.side_effect = created
+        with self.cls(self.db) as up:
+            up.put(BytesIO(b'bb'), 'blob-b', 'page', 2)
+            up.join()
+        assert (0, 1) == (up.written, up.skipped)
+        self.db.save.assert_called_once_with(self.stored['blob-b'])
+
+    def test_leases(self):
+        def save(doc):
+            doc['_rev'] = '1-x'
+        self.db.save.side_effect = save
+        with self.cls(self.db) as up:
+            up.put(BytesIO(b'a'), 'blob-a', 'page', 1, lease={'_id': 'l-a'})
+            up.join()
+        # the lease is stored before the blob is touched
+        assert [
+            mock.call({'_id': 'l-a', '_rev': '1-x'}),
+            mock.call(self.stored['blob-a']),
+        ] == self.db.save.call_args_list
+        up.release_leases()
+        self.db.update.assert_called_once_with(
+            [{'_id': 'l-a', '_rev': '1-x', '_deleted': True}])
+
+
+class TestMultipartStream(object):
+    def setup(self):
+        from ..attachments import MultipartStream
+        self.cls = MultipartStream
+
+    def parse(self, stream, size):
+        from email.parser import BytesParser
+        chunks = []
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        body = b''.join(chunks)
+        assert len(stream) == len(body)
+        message = BytesParser().parsebytes(
+            'Content-Type: {}\r\n\r\n'.format(stream.content_type).encode() +
+            body)
+        return [x.get_payload(decode=True) for x in message.get_payload()]
+
+    def test_read(self):
+        stage = BytesIO(b'aaaabbbbbbcc')
+        attachments = [('a', 0, 4), ('b', 4, 6), ('c', 10, 2)]
+        for size in (1, 3, 1024):
+            stream = self.cls({'_id': 'doc'}, stage, attachments)
+            expected = [b'{"_id": "doc"}', b'aaaa', b'bbbbbb', b'cc']
+            assert expected == self.parse(stream, size)
@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from datetime import datetime
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+
+from couchdb.mapping import DateTimeField
+from couchdb.mapping import IntegerField
+from couchdb.mapping import TextField
+from couchdb.mapping import ViewField
+
+from ..utils import file_size
+from .attachments import put_multipart
+from .utils import GodhandDocument
+
+
+class UploadSession(GodhandDocument):
+    """ A volume archive uploaded in chunks over several requests.
+
+    Chunks are stored as :class:`UploadChunk` documents keyed by their byte
+    offset, so a client can resend any chunk and ask which ranges arrived.
+    :meth:`assembled` joins them back into one archive once the upload is
+    complete. The session document itself is only written when the upload
+    starts, so chunks can be sent in parallel.
+
+    """
+    class_ = TextField('@class', default='UploadSession')
+    owner_id = TextField()
+    series_id = TextField()
+    filename = TextField()
+    size = IntegerField()
+    created = DateTimeField(default=datetime.utcnow)
+
+    @classmethod
+    def sync(cls, db):
+        UploadChunk.by_session.sync(db)
+
+    @classmethod
+    def create(cls, db, owner_id, series_id, filename, size=None):
+        session = cls(
+            id=cls.generate_id(),
+            owner_id=owner_id,
+            series_id=series_id,
+            filename=filename,
+            size=size,
+        )
+        session.store(db)
+        return session
+
+    def put_chunk(self, db, offset, f):
+        """ Store ``f`` as the chunk starting at ``offset``, replacing any
+        chunk already stored there.
+
+        The chunk and its data are written in one request, so a chunk is
+        never listed without its data.
+        """
+        length = file_size(f)
+        doc = {
+            '_id': UploadChunk.key(self.id, offset),
+            '@class': 'UploadChunk',
+            'session_id': self.id,
+            'offset': offset,
+            'length': length,
+            'uploaded': DateTimeField()._to_json(datetime.utcnow()),
+        }
+        existing = db.get(doc['_id'])
+        if existing is not None:
+            doc['_rev'] = existing['_rev']
+        put_multipart(
+            db, doc, f, [(UploadChunk.ATTACHMENT, 0, length)])
+        self.sync(db)
+
+    def chunks(self, db):
+        """ ``(offset, length)`` of every stored chunk, by offset.
+        """
+        return [
+            (x['key'][1], x['value'])
+            for x in UploadChunk.by_session(
+                db, startkey=[self.id], endkey=[self.id, {}])
+        ]
+
+    @staticmethod
+    def received(chunks):
+        """ Number of contiguous bytes stored from the start of the file.
+        """
+        end = 0
+        for offset, length in chunks:
+            if offset > end:
+                break
+            end = max(end, offset + length)
+        return end
+
+    @contextmanager
+    def assembled(self, db):
+        """ Yield the complete archive as a temporary file.
+
+        :raises ValueError: if chunks are missing or overlap.
+        """
+        with TemporaryFile() as fd:
+            for offset, length in self.chunks(db):
+                if offset != fd.tell():
+                    raise ValueError(
+                        'Expected a chunk at offset {}, got {}.'.format(
+                            fd.tell(), offset))
+                chunk = db.get_attachment(
+                    UploadChunk.key(self.id, offset), UploadChunk.ATTACHMENT)
+                try:
+                    copyfileobj(chunk, fd)
+                finally:
+                    chunk.close()
+            if self.size is not None and fd.tell() != self.size:
+                raise ValueError('Expected {} bytes, got {}.'.format(
+                    self.size, fd.tell()))
+            if fd.tell() == 0:
+                raise ValueError('No chunks were uploaded.')
+            fd.seek(0)
+            yield fd
+
+    def delete(self, db):
+        for offset, _ in self.chunks(db):
+            chunk = db.get(UploadChunk.key(self.id, offset))
+            if chunk is not None:
+                db.delete(chunk)
+        db.delete(self)
+        self.sync(db)
+
+    def as_dict(self, request):
+        chunks = self.chunks(request.registry['godhand:db'])
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'series_id': self.series_id,
+            'size': self.size,
+            'received': self.received(chunks),
+            'chunks': [
+                {'offset': offset, 'length': length}
+                for offset, length in chunks
+            ],
+            'url': request.route_url('upload', upload=self.id),
+        }
+
+
+class UploadChunk(GodhandDocument):
+    ATTACHMENT = 'data'
+
+    class_ = TextField('@class', default='UploadChunk')
+    session_id = TextField()
+    offset = IntegerField()
+    length = IntegerField()
+    uploaded = DateTimeField()
+
+    by_session = ViewField('upload-chunks-by-session', '''
+    function(doc) {
+        if (doc['@class'] === 'UploadChunk') {
+            emit([doc.session_id, doc.offset], doc.length);
+        }
+    }
+    ''', wrapper=lambda x: x)
+
+    @staticmethod
+    def key(session_id, offset):
+        return '{}:chunk:{:016d}'.format(session_id, offset)
@@ -9,3 +9,22 @@ class GodhandDocument(Document):
     @classmethod
     def generate_id(cls):
         return uuid4().hex
+
+
+class DocumentMap(object):
+    """ Documents loaded while handling one request, by class and id.
+
+    ACL factories, colander types and views all load documents through
+    ``request.godhand_docs``, so each is fetched from CouchDB at most once
+    per request and every part of the request sees the same instance.
+    Missing documents are remembered as ``None``.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._docs = {}
+
+    def load(self, cls, doc_id):
+        key = (cls, doc_id)
+        if key not in self._docs:
+            self._docs[key] = cls.load(self.db, doc_id)
+        return self._docs[key]
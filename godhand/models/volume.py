@@ -1,4 +1,7 @@
+from collections import deque
 from contextlib import contextmanager
+from datetime import datetime
+from io import BytesIO
 from tempfile import SpooledTemporaryFile
 from uuid import uuid4
 import logging
@@ -12,30 +15,86 @@ from couchdb.mapping import ListField
 from couchdb.mapping import Mapping
 from couchdb.mapping import TextField
 from couchdb.mapping import ViewField
+import couchdb.http
+import requests
 
 from .. import bookextractor
+from .. import imaging
+from ..metrics import ResourceSampler
+from ..metrics import StageTimer
+from ..sandbox import SandboxedExtractor
+from ..utils import content_hash
+from ..utils import file_size
+from .attachments import AttachmentUploader
+from .attachments import BlobUploader
+from .attachments import MultipartWriter
+from .attachments import guess_content_type
+from .blob import PageBlob
+from .metrics import IngestMetrics
 from .series import Series
 
 LOG = logging.getLogger('godhand')
+COVER_MIN_WIDTH = 320
+COVER_MIN_HEIGHT = 300
+METRICS_INTERVAL = 0.1
 
 
 @contextmanager
-def resized_image(filename, min_width=320, min_height=300):
-    from PIL import Image
-    with Image.open(filename) as im:
-        width, height = im.size
-        if height >= width:
-            new_height = int(height * min_width / width)
-            new_width = min_width
-        else:
-            new_height = min_height
-            new_width = int(width * min_height / height)
-        im = im.resize((new_width, new_height))
-        with SpooledTemporaryFile() as f:
-            im.save(f, 'JPEG')
-            f.flush()
-            f.seek(0)
-            yield f
+def resized_image(
+        f, min_width=COVER_MIN_WIDTH, min_height=COVER_MIN_HEIGHT,
+        images=imaging.INLINE):
+    """ Yield a JPEG cover for the image in ``f`` (a file or filename).
+    """
+    if isinstance(f, str):
+        with open(f, 'rb') as fd:
+            data = fd.read()
+    else:
+        data = f.read()
+    with SpooledTemporaryFile() as out:
+        out.write(images.run(imaging.resize, data, min_width, min_height))
+        out.flush()
+        out.seek(0)
+        yield out
+
+
+def record_metrics(db, metrics):
+    """ Store ``metrics``; a failure is logged, never raised.
+    """
+    try:
+        metrics.store(db)
+        IngestMetrics.sync(db)
+    except Exception:
+        LOG.exception('Could not store metrics of Volume<{}>.'.format(
+            metrics.volume_id))
+
+
+def iter_probed_pages(page_iter, images):
+    """ Probe pages on ``images`` and yield ``(relpath, f, width, height)``.
+
+    Up to twice as many pages as there are image workers are probed at once;
+    pages come out in archive order and unreadable images are dropped.
+    """
+    window = max(1, 2 * images.workers)
+    pending = deque()
+    for relpath, f in page_iter:
+        future = images.submit(imaging.image_size, f.read())
+        f.seek(0)
+        pending.append((relpath, f, future))
+        if len(pending) >= window:
+            for x in _finish_probe(images, pending.popleft()):
+                yield x
+    while pending:
+        for x in _finish_probe(images, pending.popleft()):
+            yield x
+
+
+def _finish_probe(images, item):
+    relpath, f, future = item
+    size = images.result(future)
+    if size is None:
+        f.close()
+        return
+    yield (relpath, f) + tuple(size)
 
 
 class Volume(Document):
@@ -45,23 +104,76 @@ class Volume(Document):
     language = TextField()
     series_id = TextField()
     owner_id = TextField()
+    archive_sha256 = TextField()
+    cover_min_width = IntegerField()
+    cover_min_height = IntegerField()
+    cover_widths = ListField(IntegerField())
     pages = ListField(DictField(Mapping.build(
         filename=TextField(),
         width=IntegerField(),
         height=IntegerField(),
         filesize=IntegerField(),
         orientation=TextField(),
+        sha256=TextField(),
     )))
 
     @classmethod
     def sync(cls, db):
         cls.by_series_language.sync(db)
         cls.filesize_sum_by_owner_id.sync(db)
+        cls.by_owner_archive.sync(db)
+        PageBlob.sync(db)
 
     @classmethod
-    def from_archieve(cls, db, owner_id, filename, fd):
-        from PIL import Image
-        ext = bookextractor.from_filename(filename)(fd)
+    def from_archieve(
+            cls, db, owner_id, filename, fd, single_revision=True,
+            upload_workers=4, upload_max_inflight_bytes=64 * 1024 ** 2,
+            progress=None, images=imaging.INLINE, cover_widths=(),
+            dedupe=True, sandbox=None, metrics=True):
+        """ Create a volume from a book archive.
+
+        With ``single_revision`` the volume and every attachment are committed
+        in one multipart write. Otherwise the document is created first and
+        pages are uploaded as separate attachments by ``upload_workers``.
+
+        ``progress`` is called with ``(pages_done, pages_total)`` after every
+        page; ``pages_total`` is ``None`` if the archive cannot tell upfront.
+
+        Pages are probed and covers are resized on ``images``. Besides
+        ``cover.jpg``, a cover is pre-built for each of ``cover_widths``.
+
+        With ``dedupe`` pages are stored as :class:`PageBlob` and only the
+        covers are attached to the volume; pages that are already stored are
+        not written again.
+
+        If ``owner_id`` already has a volume made from an identical archive,
+        that volume is returned and nothing is extracted or written.
+
+        With ``sandbox`` limits the archive is extracted by a
+        :class:`godhand.sandbox.SandboxedExtractor`.
+
+        With ``metrics`` the time spent in each stage, the bytes it handled
+        and the peak memory use are stored as :class:`IngestMetrics`, whether
+        the ingest succeeds or not.
+
+        """
+        timer = StageTimer()
+        started = datetime.utcnow()
+        archive_bytes = file_size(fd)
+        # Hashed in a pass of its own rather than while extracting: a
+        # re-upload must be recognised before any page is extracted, and a
+        # sandboxed extraction reads the archive in another process.
+        with timer.stage('hash', archive_bytes):
+            archive_sha256 = content_hash(fd)
+        existing = cls.find_by_archive(db, owner_id, archive_sha256)
+        if existing is not None:
+            LOG.info('{} is already Volume<{}>.'.format(filename, existing.id))
+            return existing
+
+        if sandbox is None:
+            ext = bookextractor.from_filename(filename)(fd)
+        else:
+            ext = SandboxedExtractor(fd, filename, sandbox)
         doc = cls(
             id=uuid4().hex,
             filename=filename,
@@ -69,53 +181,156 @@ class Volume(Document):
             pages=[],
             owner_id=owner_id,
         )
-        doc.store(db)
-
-        doc = db[doc.id]
+        if single_revision:
+            writer = MultipartWriter(db, doc._data)
+        else:
+            doc.store(db)
+            writer = AttachmentUploader(
+                db, db[doc.id],
+                workers=upload_workers,
+                max_inflight_bytes=upload_max_inflight_bytes,
+            )
+
+        blobs = BlobUploader(
+            db, workers=upload_workers,
+            max_inflight_bytes=upload_max_inflight_bytes)
+        sampler = ResourceSampler(interval=METRICS_INTERVAL)
+        pages = []
+        error = None
         try:
-            all_pages = []
-
-            pages = []
-            with ext.iter_pages() as page_iter:
-                for relpath, path in page_iter:
-                    path_key = os.path.join('original', relpath)
-                    try:
-                        with Image.open(path) as im:
-                            width, height = im.size
-                    except OSError:
-                        continue
-                    all_pages.append(path)
-                    pages.append({
-                        'filename': path_key,
-                        'filesize': os.stat(path).st_size,
-                        'width': width,
-                        'height': height,
-                        'orientation':
-                            'vertical' if width < height else 'horizontal',
+            cover_page = None
+            pages_total = ext.count_pages()
+            with sampler, writer, blobs:
+                with ext.iter_pages() as page_iter:
+                    probed = timer.timed('probe', iter_probed_pages(
+                        timer.timed('extract', page_iter), images))
+                    for relpath, f, width, height in probed:
+                        path_key = os.path.join('original', relpath)
+                        filesize = file_size(f)
+                        timer.add_bytes('extract', filesize)
+                        timer.add_bytes('probe', filesize)
+                        pages.append({
+                            'filename': path_key,
+                            'filesize': filesize,
+                            'width': width,
+                            'height': height,
+                            'orientation':
+                                'vertical' if width < height else 'horizontal',
+                        })
+                        if cover_page is None or path_key < cover_page[0]:
+                            if cover_page is not None:
+                                cover_page[1].close()
+                            cover_page = (
+                                path_key, bookextractor.spooled_page(f))
+                            f.seek(0)
+                        if dedupe:
+                            with timer.stage('hash', filesize):
+                                pages[-1]['sha256'] = sha256 = content_hash(f)
+                            with timer.stage('upload', filesize):
+                                blobs.put(
+                                    f, PageBlob.key(sha256),
+                                    PageBlob.ATTACHMENT, filesize,
+                                    guess_content_type(relpath),
+                                    lease=PageBlob.lease(doc.id, sha256))
+                        else:
+                            with timer.stage('upload', filesize):
+                                writer.put(f, path_key, filesize)
+                        if progress:
+                            progress(len(pages), pages_total)
+
+                if cover_page is None:
+                    raise ValueError(
+                        'No pages found in {!r}.'.format(filename))
+                with cover_page[1] as f, timer.stage('covers'):
+                    covers = images.run(
+                        imaging.covers, f.read(),
+                        COVER_MIN_WIDTH, COVER_MIN_HEIGHT, cover_widths)
+                with timer.stage('upload'):
+                    for name, data in sorted(covers.items()):
+                        timer.add_bytes('upload', len(data))
+                        writer.put(BytesIO(data), name, len(data))
+                    blobs.join()
+                    pages.sort(key=lambda x: x['filename'])
+                    writer.commit({
+                        'pages': pages,
+                        # only a complete volume may be found by archive
+                        'archive_sha256': archive_sha256,
+                        'cover_min_width': COVER_MIN_WIDTH,
+                        'cover_min_height': COVER_MIN_HEIGHT,
+                        'cover_widths': sorted(cover_widths),
                     })
-                    with open(path, 'rb') as f:
-                        db.put_attachment(doc, f, filename=path_key)
-
-                pages.sort(key=lambda x: x['filename'])
-
-                with resized_image(sorted(all_pages)[0]) as f:
-                    db.put_attachment(doc, f, filename='cover.jpg')
-
-            doc = db[doc.id]
-            doc['pages'] = pages
-            db.save(doc)
             return cls.load(db, doc.id)
-        except Exception:
-            doc = cls.load(db, doc.id)
-            db.delete(doc)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            writer.abort()
+            blobs.release_leases()
+            PageBlob.release(
+                db, [x['sha256'] for x in pages if 'sha256' in x])
             raise
         finally:
-            cls.sync(db)
+            try:
+                blobs.release_leases()
+            except Exception:
+                LOG.exception(
+                    'Could not release the blobs leased by Volume<{}>.'.format(
+                        doc.id))
+            with timer.stage('sync'):
+                cls.sync(db)
+            if metrics:
+                record_metrics(db, IngestMetrics(
+                    id=IngestMetrics.key(doc.id),
+                    volume_id=doc.id,
+                    owner_id=owner_id,
+                    filename=filename,
+                    status='failed' if error else 'done',
+                    error=error,
+                    started=started,
+                    seconds=(datetime.utcnow() - started).total_seconds(),
+                    pages=len(pages),
+                    archive_bytes=archive_bytes,
+                    peak_rss_bytes=sampler.peak_rss,
+                    temp_disk_bytes=sampler.peak_disk,
+                    stages=timer.stages,
+                    settings={
+                        'single_revision': single_revision,
+                        'upload_workers': upload_workers,
+                        'upload_max_inflight_bytes': upload_max_inflight_bytes,
+                        'image_workers': images.workers,
+                        'cover_widths': sorted(cover_widths),
+                        'dedupe': dedupe,
+                        'sandbox': sandbox is not None,
+                    },
+                ))
+
+    @classmethod
+    def reprocess_all_images(
+            cls, db, min_width, min_height, images=imaging.INLINE,
+            cover_widths=()):
+        for volume_id in cls.iter_ids(db):
+            cls.reprocess_by_id(
+                db, volume_id, min_width, min_height, images, cover_widths)
 
     @classmethod
-    def reprocess_all_images(cls, db, min_width, min_height):
-        for volume in cls.query(db):
-            volume.reprocess_images(db, min_width, min_height)
+    def reprocess_by_id(
+            cls, db, volume_id, min_width, min_height, images=imaging.INLINE,
+            cover_widths=()):
+        """ Rebuild the covers of a volume unless they are already current.
+
+        :returns: ``'done'``, ``'skipped'`` or ``'missing'``.
+        """
+        volume = cls.load(db, volume_id)
+        if volume is None:
+            return 'missing'
+        if volume.cover_matches(min_width, min_height, cover_widths):
+            return 'skipped'
+        volume.reprocess_images(
+            db, min_width, min_height, images, cover_widths)
+        return 'done'
+
+    @classmethod
+    def iter_ids(cls, db):
+        for x in cls.by_series_language(db, include_docs=False):
+            yield x.id
 
     def set_volume_collection(self, db, collection):
         self.series_id = collection.id
@@ -133,16 +348,33 @@ class Volume(Document):
         except IndexError:
             return None
 
-    def reprocess_images(self, db, min_width, min_height):
-        cover = db.get_attachment(self, self.pages[0]['filename'])
+    def reprocess_images(
+            self, db, min_width, min_height, images=imaging.INLINE,
+            cover_widths=()):
+        cover = self.get_file(db, self.pages[0]['filename'])
         if cover is None:
             LOG.warn('Could not get cover for Volume<{}>.'.format(self.id))
             return
         try:
-            with resized_image(cover, min_width, min_height) as f:
-                db.put_attachment(self, f, filename='cover.jpg')
+            covers = images.run(
+                imaging.covers, cover.read(), min_width, min_height,
+                cover_widths)
         finally:
-            cover.close
+            cover.close()
+        for name, data in sorted(covers.items()):
+            db.put_attachment(self, BytesIO(data), filename=name)
+        doc = db[self.id]
+        doc['cover_min_width'] = min_width
+        doc['cover_min_height'] = min_height
+        doc['cover_widths'] = sorted(cover_widths)
+        db.save(doc)
+
+    def cover_matches(self, min_width, min_height, cover_widths):
+        return (
+            self.cover_min_width == min_width and
+            self.cover_min_height == min_height and
+            list(self.cover_widths) == sorted(cover_widths)
+        )
 
     def update_meta(self, db, language=None, volume_number=None):
         if language:
@@ -153,21 +385,95 @@ class Volume(Document):
         self.sync(db)
         return self
 
+    def get_file(self, db, filename):
+        """ Open a page or other attachment of the volume.
+        """
+        return db.get_attachment(*self.file_location(filename))
+
+    def get_file_range(self, db, filename, start, stop):
+        """ Open bytes ``start`` to ``stop`` of a page or other attachment.
+
+        The range is read by CouchDB. If it sends the whole attachment
+        anyway, e.g. for a compressed attachment, the bytes before ``start``
+        are skipped.
+
+        The request is streamed past couchdb-python's session. That session
+        caches small GET responses by URL alone, so a cached 206 would later
+        be served as the whole attachment.
+        """
+        doc_id, name = self.file_location(filename)
+        r = requests.get(
+            couchdb.http.urljoin(db.resource.url, doc_id, name),
+            headers={
+                'Range': 'bytes={}-{}'.format(start, stop - 1),
+                'Accept-Encoding': 'identity',
+            },
+            auth=db.resource.credentials,
+            stream=True,
+        )
+        if r.status_code == 404:
+            r.close()
+            return None
+        r.raise_for_status()
+        data = r.raw
+        if r.status_code != 206:
+            skipped = bookextractor.LimitedReader(data, start)
+            while skipped.read(64 * 1024):
+                pass
+        return bookextractor.LimitedReader(data, stop - start)
+
+    def file_location(self, filename):
+        """ ``(doc_id, attachment)`` a page or other attachment is stored as.
+        """
+        for page in self.pages:
+            if page.filename == filename and page.sha256:
+                return PageBlob.key(page.sha256), PageBlob.ATTACHMENT
+        return self.id, filename
+
+    def file_length(self, filename):
+        """ Size of a page or other attachment, without reading it.
+        """
+        for page in self.pages:
+            if page.filename == filename and page.filesize is not None:
+                return page.filesize
+        stub = self._data.get('_attachments', {}).get(filename)
+        return stub['length'] if stub else None
+
+    def file_digest(self, filename):
+        """ Digest of a page or other attachment, without reading it.
+
+        ``None`` if the volume has no such file.
+        """
+        for page in self.pages:
+            if page.filename == filename and page.sha256:
+                return 'sha256-{}'.format(page.sha256)
+        stub = self._data.get('_attachments', {}).get(filename)
+        return stub['digest'] if stub else None
+
     def delete_file(self, db, filename):
         from .series import Series
+        blobs = [
+            x.sha256 for x in self.pages
+            if x.filename == filename and x.sha256]
         self.pages = filter(lambda x: x.filename != filename, self.pages)
         self.store(db)
         series = Series.load(db, self.series_id)
         series.update_volume_meta(db, self)
         Series.by_attribute.sync(db)
 
-        db.delete_attachment(self, filename)
+        if blobs:
+            PageBlob.release(db, blobs)
+        else:
+            db.delete_attachment(self, filename)
         self.sync(db)
 
     def delete(self, db):
         db.delete(self)
         self.sync(db)
+        PageBlob.release(db, [x.sha256 for x in self.pages if x.sha256])
 
+        if self.series_id is None:
+            return
         if self.query(db, series_id=self.series_id).total_rows == 0:
             Series.delete_by_id(db, self.series_id)
 
@@ -198,6 +504,20 @@ class Volume(Document):
             kws['total'] = total
         return cls.by_series_language(db, **kws)
 
+    by_owner_archive = ViewField('volumes-by-owner-archive', '''
+    function(doc) {
+        if (doc['@class'] === 'Volume' && doc.archive_sha256) {
+            emit([doc.owner_id, doc.archive_sha256], {_id: doc.id});
+        }
+    }
+    ''')
+
+    @classmethod
+    def find_by_archive(cls, db, owner_id, archive_sha256):
+        rows = cls.by_owner_archive(
+            db, key=[owner_id, archive_sha256], include_docs=True).rows
+        return rows[0] if rows else None
+
     @classmethod
     def first(cls, db, series_id):
         try:
@@ -249,8 +569,16 @@ class Volume(Document):
             return page0['filename'], None
         return page0['filename'], page1['filename']
 
-    def get_cover(self, db):
-        return db.get_attachment(self.id, 'cover.jpg')
+    def get_cover(self, db, width=None):
+        """ Get the pre-built cover closest to ``width`` pixels wide.
+        """
+        return db.get_attachment(self.id, self.cover_filename(width))
+
+    def cover_filename(self, width=None):
+        if width and self.cover_widths:
+            return imaging.cover_name(
+                imaging.closest_width(self.cover_widths, width))
+        return 'cover.jpg'
 
     def as_dict(self, short=False):
         d = {
@@ -0,0 +1,116 @@
+""" godhand.renditions
+
+Page renditions (resized / re-encoded pages) are generated on demand and
+kept in a size-bounded LRU directory on local disk.
+
+"""
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import logging
+import os
+import tempfile
+
+LOG = logging.getLogger('godhand')
+
+
+def rendition_key(volume_id, filename, width, fmt):
+    return hashlib.sha256('\0'.join(map(str, (
+        volume_id, filename, width, fmt))).encode('utf-8')).hexdigest()
+
+
+class RenditionCache(object):
+    """ Size-bounded LRU cache of renditions in ``path``.
+
+    The LRU order survives restarts through file access times. Several
+    processes may share ``path``; a file evicted by another process is
+    simply a miss.
+
+    """
+    log_every = 100
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_served = 0
+        self._lock = Lock()
+        self._index = OrderedDict()
+        self._size = 0
+        os.makedirs(path, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_atime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._size += size
+
+    def get(self, key):
+        """ Open the cached rendition for ``key`` or return ``None``.
+        """
+        path = os.path.join(self.path, key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._index.pop(key, 0)
+                self._count(hit=False)
+            return None
+        os.utime(path)
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            self.bytes_served += self._index.get(key, 0)
+            self._count(hit=True)
+        return f
+
+    def put(self, key, data):
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.path, key))
+        with self._lock:
+            self._size -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._size += len(data)
+            evicted = self._evict()
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        evicted = []
+        while self._size > self.max_bytes and len(self._index) > 1:
+            name, size = self._index.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
+
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        lookups = self.hits + self.misses
+        if lookups % self.log_every == 0:
+            LOG.info(
+                'Rendition cache: {} hits, {} misses ({:.0%} hit rate), '
+                '{} evictions, {} bytes served from {} ({} / {} bytes '
+                'used)'.format(
+                    self.hits, self.misses, self.hits / lookups,
+                    self.evictions, self.bytes_served, self.path,
+                    self._size, self.max_bytes))
@@ -0,0 +1,209 @@
+""" godhand.sandbox
+
+Archive extraction in a resource-limited child process.
+
+:class:`SandboxedExtractor` has the interface of a
+:class:`godhand.bookextractor.BookExtractor`, but the archive is opened by
+``python -m godhand.sandbox`` with limits on address space, CPU time and
+file size. Pages are streamed back over a pipe as ``(name, size, bytes)``
+frames, and the parent enforces the member count and output size limits,
+killing the child as soon as one is exceeded. A decompression bomb can only
+exhaust the child.
+
+"""
+from contextlib import contextmanager
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+import os
+import resource
+import struct
+import subprocess
+import sys
+import warnings
+
+from . import bookextractor
+from .utils import file_size
+
+HEADER = struct.Struct('>HQ')
+
+
+class ExtractionError(ValueError):
+    pass
+
+
+class LimitExceeded(ExtractionError):
+    pass
+
+
+class Limits(object):
+    """ Resource limits for extraction and image processing.
+    """
+    def __init__(
+            self, max_memory=1024 ** 3, max_cpu_seconds=300,
+            max_members=10000, max_page_bytes=128 * 1024 ** 2,
+            max_output_bytes=4 * 1024 ** 3, max_image_pixels=89478485):
+        self.max_memory = max_memory
+        self.max_cpu_seconds = max_cpu_seconds
+        self.max_members = max_members
+        self.max_page_bytes = max_page_bytes
+        self.max_output_bytes = max_output_bytes
+        self.max_image_pixels = max_image_pixels
+
+    @classmethod
+    def from_config(cls, cfg):
+        """ Limits configured in ``cfg`` or ``None`` if sandboxing is off.
+        """
+        if not cfg.sandbox_extraction:
+            return None
+        return cls(
+            max_memory=cfg.extract_max_memory,
+            max_cpu_seconds=cfg.extract_max_cpu_seconds,
+            max_members=cfg.extract_max_members,
+            max_page_bytes=cfg.extract_max_page_bytes,
+            max_output_bytes=cfg.extract_max_bytes,
+            max_image_pixels=cfg.max_image_pixels,
+        )
+
+    def as_args(self):
+        return [str(x) for x in (
+            self.max_memory, self.max_cpu_seconds, self.max_members,
+            self.max_page_bytes, self.max_output_bytes,
+            self.max_image_pixels)]
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(*map(int, args))
+
+    def apply(self, cpu=True):
+        """ Limit the current process.
+
+        Long-lived workers pass ``cpu=False``: the CPU limit counts the whole
+        life of a process, not a single task.
+        """
+        from PIL import Image
+        _setrlimit(resource.RLIMIT_AS, self.max_memory)
+        _setrlimit(resource.RLIMIT_FSIZE, self.max_page_bytes + 1)
+        if cpu:
+            _setrlimit(resource.RLIMIT_CPU, self.max_cpu_seconds)
+        Image.MAX_IMAGE_PIXELS = self.max_image_pixels
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+
+def _setrlimit(limit, value):
+    if value:
+        hard = resource.getrlimit(limit)[1]
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, hard))
+
+
+class SandboxedExtractor(object):
+    """ Iterate over the pages of ``f`` extracted by a limited child process.
+    """
+    def __init__(self, f, filename, limits):
+        bookextractor.from_filename(filename)
+        self.f = f
+        self.filename = filename
+        self.limits = limits
+
+    def count_pages(self):
+        """ Counted in this process: listing the members of an archive
+        decodes no page data.
+        """
+        self.f.seek(0)
+        try:
+            return bookextractor.from_filename(self.filename)(
+                self.f).count_pages()
+        finally:
+            self.f.seek(0)
+
+    @contextmanager
+    def iter_pages(self):
+        with self._archive() as archive, TemporaryFile() as stderr:
+            proc = subprocess.Popen(
+                [sys.executable, '-m', 'godhand.sandbox', self.filename] +
+                self.limits.as_args(),
+                stdin=archive, stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                yield self._iter_frames(proc, stderr)
+            finally:
+                proc.stdout.close()
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+
+    @contextmanager
+    def _archive(self):
+        try:
+            self.f.fileno()
+        except (AttributeError, OSError, ValueError):
+            with TemporaryFile() as f:
+                copyfileobj(self.f, f)
+                f.seek(0)
+                yield f
+        else:
+            self.f.seek(0)
+            yield self.f
+
+    def _iter_frames(self, proc, stderr):
+        members = 0
+        output = 0
+        while True:
+            header = proc.stdout.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise self._failed(proc, stderr)
+            name_size, size = HEADER.unpack(header)
+            if name_size == 0:
+                break
+            members += 1
+            output += size
+            if members > self.limits.max_members:
+                raise LimitExceeded('More than {} files in {}.'.format(
+                    self.limits.max_members, self.filename))
+            if size > self.limits.max_page_bytes:
+                raise LimitExceeded('A file in {} is over {} bytes.'.format(
+                    self.filename, self.limits.max_page_bytes))
+            if output > self.limits.max_output_bytes:
+                raise LimitExceeded('{} extracts to over {} bytes.'.format(
+                    self.filename, self.limits.max_output_bytes))
+            name = proc.stdout.read(name_size).decode('utf-8')
+            page = bookextractor.spooled_page(
+                bookextractor.LimitedReader(proc.stdout, size))
+            if file_size(page) != size:
+                page.close()
+                raise self._failed(proc, stderr)
+            yield name, page
+        if proc.wait() != 0:
+            raise self._failed(proc, stderr)
+
+    def _failed(self, proc, stderr):
+        proc.stdout.close()
+        returncode = proc.wait()
+        stderr.seek(0)
+        lines = stderr.read().decode('utf-8', 'replace').strip().splitlines()
+        return ExtractionError('Could not extract {}: {}'.format(
+            self.filename,
+            lines[-1] if lines else 'exit status {}'.format(returncode)))
+
+
+def main(argv=None):
+    """ Write the pages of the archive on stdin to stdout as frames.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    filename, limits = argv[0], Limits.from_args(argv[1:])
+    limits.apply()
+    out = sys.stdout.buffer
+    ext = bookextractor.from_filename(filename)(os.fdopen(0, 'rb'))
+    with ext.iter_pages() as pages:
+        for relpath, f in pages:
+            with f:
+                name = relpath.encode('utf-8')
+                out.write(HEADER.pack(len(name), file_size(f)))
+                out.write(name)
+                copyfileobj(f, out)
+    out.write(HEADER.pack(0, 0))
+    out.flush()
+
+
+if __name__ == '__main__':
+    main()
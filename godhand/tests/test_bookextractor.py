@@ -0,0 +1,148 @@
+from tempfile import TemporaryFile
+import zipfile
+
+from PIL import Image
+
+from godhand.tests.fakevolumes import CbtFile
+from godhand.tests.fakevolumes import CbzFile
+
+
+class BookExtractorTest(object):
+    def setup(self):
+        from godhand.bookextractor import from_filename
+        self.fut = from_filename
+
+    def iter_sizes(self, f):
+        ext = self.fut('volume' + self.example_volume.ext)(f)
+        with ext.iter_pages() as pages:
+            for relpath, page in pages:
+                with page:
+                    if relpath.endswith('.png'):
+                        with Image.open(page) as im:
+                            yield relpath, im.size
+                    else:
+                        yield relpath, None
+
+    def test_iter_pages(self):
+        expected = sorted(
+            (x['filename'], (x['width'], x['height']))
+            for x in self.example_volume.pages)
+        with self.example_volume.packaged() as f:
+            response = sorted(filter(lambda x: x[1], self.iter_sizes(f)))
+        assert expected == response
+
+
+class TestCbtBookExtractor(BookExtractorTest):
+    example_volume = CbtFile()
+
+    def test_unseekable(self):
+        """ Pages should be readable from a forward-only stream.
+        """
+        class ForwardOnly(object):
+            def __init__(self, f):
+                self.read = f.read
+
+        expected = len(self.example_volume.pages)
+        with self.example_volume.packaged() as f:
+            response = len(list(self.iter_sizes(ForwardOnly(f))))
+        assert expected == response
+
+
+class TestCbzBookExtractor(BookExtractorTest):
+    example_volume = CbzFile()
+
+    def test_skips_non_images(self):
+        with self.example_volume.packaged() as f:
+            response = dict(self.iter_sizes(f))
+        assert response.pop('derp.db') is None
+        assert len(self.example_volume.pages) == len(response)
+
+    def test_skips_directories(self):
+        with TemporaryFile() as f:
+            with zipfile.ZipFile(f, mode='w') as ar:
+                ar.writestr(zipfile.ZipInfo('chapter-1/'), b'')
+                ar.writestr('chapter-1/derp.db', b'abcedfg')
+            f.seek(0)
+            ext = self.fut('volume.cbz')(f)
+            assert 1 == ext.count_pages()
+            f.seek(0)
+            assert ['chapter-1/derp.db'] == list(dict(self.iter_sizes(f)))
+
+
+class TestCbrBookExtractor(object):
+    listing = '''
+UNRAR 5.30 freeware      Copyright (c) 1993-2015 Alexander Roshal
+
+Archive: volume.cbr
+Details: RAR 4
+
+        Name: base/page-1.png
+        Type: File
+        Size: 3
+ Packed size: 3
+       Ratio: 100%
+
+        Name: base/.DS_Store
+        Type: File
+        Size: 2
+
+        Name: base
+        Type: Directory
+'''
+
+    def test_parse_listing(self):
+        from godhand.bookextractor import parse_unrar_listing
+        expected = [('base/page-1.png', 3), ('base/.DS_Store', 2)]
+        assert expected == parse_unrar_listing(self.listing)
+
+    def test_iter_stream(self):
+        """ Members are split off the ``unrar p`` stream by size.
+        """
+        from io import BytesIO
+        from godhand.bookextractor import CbrBookExtractor
+        members = [('a.png', 3, True), ('.b', 2, False), ('c.png', 1, True)]
+        pages = CbrBookExtractor(None)._iter_stream(
+            BytesIO(b'aaabbc'), members)
+        assert [('a.png', b'aaa'), ('c.png', b'c')] == [
+            (relpath, f.read()) for relpath, f in pages]
+
+    def test_truncated(self):
+        from io import BytesIO
+        from godhand.bookextractor import CbrBookExtractor
+        pages = CbrBookExtractor(None)._iter_stream(
+            BytesIO(b'aa'), [('a.png', 3, True)])
+        try:
+            list(pages)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised.')
+
+    def test_bad_exit_status(self):
+        """ A member that fails its CRC check has the right size, but unrar
+        exits with an error.
+        """
+        from io import BytesIO
+        import mock
+        from godhand.bookextractor import CbrBookExtractor
+        proc = mock.Mock(stdout=BytesIO(b'aaa'), returncode=3)
+        proc.wait.return_value = 3
+        pages = CbrBookExtractor(None)._iter_process(
+            proc, [('a.png', 3, True)])
+        try:
+            list(pages)
+        except ValueError as e:
+            assert 'exit status 3' in str(e)
+        else:
+            raise AssertionError('ValueError not raised.')
+
+    def test_members_listed_once(self):
+        import mock
+        from godhand.bookextractor import CbrBookExtractor
+        ext = CbrBookExtractor(None)
+        with mock.patch('godhand.bookextractor.subprocess') as subprocess:
+            subprocess.check_output.return_value = self.listing.encode()
+            assert 2 == len(ext.members('volume.cbr'))
+            assert 1 == ext.count_pages()
+        subprocess.check_output.assert_called_once_with(
+            ['unrar', 'lt', '-p-', 'volume.cbr'])
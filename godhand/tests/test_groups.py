@@ -0,0 +1,53 @@
+import mock
+
+
+class TestGroupCache(object):
+    def setup(self):
+        from godhand.groups import GroupCache
+        self.cache = GroupCache(ttl=30)
+        self.load = mock.Mock(return_value=['a'])
+
+    def test_cached(self):
+        assert ['a'] == self.cache.get('user', self.load)
+        assert ['a'] == self.cache.get('user', self.load)
+        assert 1 == self.load.call_count
+
+    def test_expired(self):
+        self.cache.get('user', self.load)
+        with mock.patch('time.monotonic', return_value=10 ** 9):
+            self.cache.get('user', self.load)
+        assert 2 == self.load.call_count
+
+    def test_invalidate(self):
+        self.cache.get('user', self.load)
+        self.cache.get('other', self.load)
+        self.cache.invalidate('user')
+        self.cache.get('user', self.load)
+        self.cache.get('other', self.load)
+        assert 3 == self.load.call_count
+
+    def test_invalidated_while_loading(self):
+        def load():
+            self.cache.invalidate('user')
+            return ['stale']
+        self.cache.get('user', load)
+        assert ['a'] == self.cache.get('user', self.load)
+
+    def test_disabled(self):
+        from godhand.groups import GroupCache
+        cache = GroupCache(ttl=0)
+        cache.get('user', self.load)
+        cache.get('user', self.load)
+        assert 2 == self.load.call_count
+
+
+class TestChangesFollower(object):
+    def test_handle(self):
+        from godhand.groups import ChangesFollower
+        cache = mock.Mock()
+        follower = ChangesFollower(db=None, cache=cache)
+        follower.handle([
+            {'id': 'subscription:pub@example.com:sub@example.com'},
+            {'id': 'volume-id'},
+        ])
+        cache.invalidate.assert_called_once_with('sub@example.com')
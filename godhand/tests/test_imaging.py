@@ -0,0 +1,91 @@
+from io import BytesIO
+
+from PIL import Image
+
+
+def gen_image(width, height):
+    f = BytesIO()
+    Image.new('RGB', (width, height)).save(f, 'png')
+    return f.getvalue()
+
+
+class TestImageProcessor(object):
+    workers = 0
+
+    def setup(self):
+        from godhand.imaging import ImageProcessor
+        self.instance = ImageProcessor(self.workers)
+
+    def teardown(self):
+        self.instance.shutdown()
+
+    def test_image_size(self):
+        from godhand.imaging import image_size
+        assert (64, 32) == self.instance.run(image_size, gen_image(64, 32))
+        assert self.instance.run(image_size, b'not an image') is None
+
+    def test_resize(self):
+        from godhand.imaging import resize
+        data = self.instance.run(resize, gen_image(640, 1280), 320, 300)
+        assert (320, 640) == Image.open(BytesIO(data)).size
+
+
+class TestImageProcessorPool(TestImageProcessor):
+    workers = 1
+
+    def test_not_forked(self):
+        """ Run in a fresh interpreter, as the start method can only be chosen
+        once per process.
+        """
+        import subprocess
+        import sys
+        script = (
+            'import os\n'
+            'from godhand.imaging import ImageProcessor, use_forkserver\n'
+            'use_forkserver()\n'
+            'images = ImageProcessor(1)\n'
+            'print(os.getpid() != images.run(os.getppid))\n'
+            'images.shutdown()\n'
+        )
+        assert b'True' == subprocess.check_output(
+            [sys.executable, '-c', script]).strip()
+
+
+class TestCovers(object):
+    def setup(self):
+        from godhand.imaging import covers
+        self.fut = covers
+
+    def sizes(self, covers):
+        return {
+            k: Image.open(BytesIO(v)).size for k, v in covers.items()}
+
+    def test_png(self):
+        expected = {
+            'cover.jpg': (320, 640),
+            'covers/160.jpg': (160, 320),
+            'covers/320.jpg': (320, 640),
+            'covers/1280.jpg': (640, 1280),
+        }
+        response = self.fut(gen_image(640, 1280), 320, 300, (160, 320, 1280))
+        assert expected == self.sizes(response)
+
+    def test_jpeg_draft(self):
+        f = BytesIO()
+        Image.new('RGB', (3200, 4800)).save(f, 'JPEG')
+        expected = {'cover.jpg': (320, 480), 'covers/100.jpg': (100, 150)}
+        response = self.fut(f.getvalue(), 320, 300, (100,))
+        assert expected == self.sizes(response)
+
+
+class TestClosestWidth(object):
+    def setup(self):
+        from godhand.imaging import closest_width
+        self.fut = closest_width
+
+    def test_closest(self):
+        widths = [160, 320, 640]
+        assert 160 == self.fut(widths, 1)
+        assert 320 == self.fut(widths, 161)
+        assert 320 == self.fut(widths, 320)
+        assert 640 == self.fut(widths, 2000)
@@ -0,0 +1,44 @@
+from shutil import rmtree
+from tempfile import mkdtemp
+
+
+class TestRenditionCache(object):
+    def setup(self):
+        from godhand.renditions import RenditionCache
+        self.cls = RenditionCache
+        self.path = mkdtemp()
+
+    def teardown(self):
+        rmtree(self.path)
+
+    def read(self, cache, key):
+        f = cache.get(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def test_get_put(self):
+        cache = self.cls(self.path, 1024)
+        assert self.read(cache, 'a') is None
+        cache.put('a', b'abc')
+        assert b'abc' == self.read(cache, 'a')
+        assert (1, 1) == (cache.hits, cache.misses)
+
+    def test_evict_lru(self):
+        cache = self.cls(self.path, 10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        self.read(cache, 'a')
+        cache.put('c', b'cccc')
+        assert 1 == cache.evictions
+        assert self.read(cache, 'b') is None
+        assert b'aaaa' == self.read(cache, 'a')
+        assert b'cccc' == self.read(cache, 'c')
+
+    def test_reload(self):
+        self.cls(self.path, 10).put('a', b'aaaa')
+        cache = self.cls(self.path, 10)
+        cache.put('b', b'bbbbbbb')
+        assert self.read(cache, 'a') is None
+        assert b'bbbbbbb' == self.read(cache, 'b')
@@ -0,0 +1,126 @@
+from tempfile import TemporaryFile
+import zipfile
+
+from godhand.tests.fakevolumes import CbtFile
+from godhand.tests.fakevolumes import CbzFile
+
+
+class TestSandboxedExtractor(object):
+    def setup(self):
+        from godhand.sandbox import Limits
+        from godhand.sandbox import SandboxedExtractor
+        self.cls = SandboxedExtractor
+        self.limits = Limits
+
+    def extract(self, volume, **limits):
+        with volume.packaged() as f:
+            ext = self.cls(f, 'volume' + volume.ext, self.limits(**limits))
+            with ext.iter_pages() as pages:
+                return sorted(
+                    (relpath, len(page.read())) for relpath, page in pages)
+
+    def test_iter_pages(self):
+        for volume in (CbtFile(), CbzFile()):
+            response = self.extract(volume)
+            assert sorted(x['filename'] for x in volume.pages) == [
+                x[0] for x in response if x[0].endswith('.png')]
+
+    def test_count_pages(self):
+        from godhand.bookextractor import CbzBookExtractor
+        with CbzFile().packaged() as f:
+            expected = CbzBookExtractor(f).count_pages()
+            ext = self.cls(f, 'volume.cbz', self.limits())
+            assert expected and expected == ext.count_pages()
+
+    def test_decompression_bomb(self):
+        from godhand.sandbox import ExtractionError
+        with TemporaryFile() as f:
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as ar:
+                ar.writestr('bomb.png', b'\0' * 16 * 1024 ** 2)
+            f.seek(0)
+            ext = self.cls(
+                f, 'volume.cbz', self.limits(max_page_bytes=1024 ** 2))
+            try:
+                with ext.iter_pages() as pages:
+                    list(pages)
+            except ExtractionError as e:
+                assert 'volume.cbz' in str(e)
+            else:
+                raise AssertionError('ExtractionError not raised.')
+
+    def test_pixel_bomb(self):
+        from io import BytesIO
+        from PIL import Image
+        from godhand.imaging import ImageProcessor
+        from godhand.imaging import image_size
+        from godhand.sandbox import LimitExceeded
+        page = BytesIO()
+        Image.new('1', (4000, 4000)).save(page, 'PNG')
+        images = ImageProcessor(1, self.limits(max_image_pixels=1000 ** 2))
+        try:
+            images.run(image_size, page.getvalue())
+        except LimitExceeded:
+            pass
+        else:
+            raise AssertionError('LimitExceeded not raised.')
+        finally:
+            images.shutdown()
+
+    def test_killed_image_worker(self):
+        import os
+        from godhand.imaging import ImageProcessor
+        from godhand.sandbox import LimitExceeded
+        images = ImageProcessor(1, self.limits())
+        try:
+            images.run(os.abort)
+        except LimitExceeded:
+            pass
+        else:
+            raise AssertionError('LimitExceeded not raised.')
+        finally:
+            images.shutdown()
+
+    def test_limited_image_error(self):
+        """ Other errors of a limited task are passed on unchanged.
+        """
+        from godhand.imaging import ImageProcessor
+        from godhand.imaging import rendition
+        images = ImageProcessor(1, self.limits())
+        try:
+            images.run(rendition, b'not an image')
+        except OSError:
+            pass
+        else:
+            raise AssertionError('OSError not raised.')
+        finally:
+            images.shutdown()
+
+    def test_max_members(self):
+        from godhand.sandbox import LimitExceeded
+        try:
+            self.extract(CbtFile(), max_members=3)
+        except LimitExceeded:
+            pass
+        else:
+            raise AssertionError('LimitExceeded not raised.')
+
+    def test_max_output_bytes(self):
+        from godhand.sandbox import LimitExceeded
+        try:
+            self.extract(CbzFile(), max_output_bytes=1024)
+        except LimitExceeded:
+            pass
+        else:
+            raise AssertionError('LimitExceeded not raised.')
+
+    def test_corrupt(self):
+        from io import BytesIO
+        from godhand.sandbox import ExtractionError
+        ext = self.cls(BytesIO(b'not a zip'), 'volume.cbz', self.limits())
+        try:
+            with ext.iter_pages() as pages:
+                list(pages)
+        except ExtractionError as e:
+            assert 'volume.cbz' in str(e)
+        else:
+            raise AssertionError('ExtractionError not raised.')
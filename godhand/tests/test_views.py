@@ -1,15 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from io import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
+import json
 import os
+import time
 import unittest
+import zipfile
 
+from PIL import Image
 from webtest import TestApp
 import couchdb.client
 import couchdb.http
 import mock
 
+from godhand.models import Subscription
+from godhand.models import Volume
 from godhand.tests.fakevolumes import CbtFile
+from godhand.tests.utils import couchdb_requests
+from godhand.tests.utils import doc_requests
 from godhand.tests.utils import get_couchdb_url
+from godhand.tests.utils import GoogleStandIn
 
 
 class ApiTest(unittest.TestCase):
@@ -21,9 +35,11 @@ class ApiTest(unittest.TestCase):
     couchdb_url = get_couchdb_url()
 
     disable_auth = False
+    settings = {}
 
     def setUp(self):
         from godhand import main
+        self.google = self.use_fixture(GoogleStandIn())
         self.api = TestApp(main(
             {},
             couchdb_url=self.couchdb_url,
@@ -34,6 +50,8 @@ class ApiTest(unittest.TestCase):
             auth_secret='my-auth-secret',
             token_secret='my-token-secret',
             root_email=self.root_email,
+            image_workers=0,
+            **dict(self.google.settings, **self.settings)
         ))
         self.db = couchdb.client.Server(self.couchdb_url)['godhand']
         self.authdb = couchdb.client.Server(self.couchdb_url)['auth']
@@ -46,6 +64,7 @@ class ApiTest(unittest.TestCase):
             GODHAND_AUTH_SECRET='my-auth-secret',
             GODHAND_TOKEN_SECRET='my-token-secret',
             GODHAND_ROOT_EMAIL=self.root_email,
+            GODHAND_IMAGE_WORKERS='0',
         )
 
     def use_fixture(self, fix):
@@ -74,33 +93,25 @@ class ApiTest(unittest.TestCase):
             query['redirect_uri'], ['http://localhost/oauth2-callback'])
         state = query['state'][0]
         assert state
-        with mock.patch('godhand.auth.views.client') as client:
-            with mock.patch('godhand.auth.views.requests') as requests:
-                requests.post.return_value.status_code = 200
-                requests.post.return_value.json.return_value = {
-                    'id_token': 'myidtoken',
-                }
-                client.verify_id_token.return_value = {
-                    'email_verified': True, 'email': email,
-                }
-
-                response = self.api.get(
-                    '/oauth2-callback',
-                    params={'state': state, 'code': 'mycode'},
-                )
-                assert response.headers['location'] == 'http://success'
-
-                requests.post.assert_called_once_with(
-                    'https://www.googleapis.com/oauth2/v4/token',
-                    data={
-                        'code': 'mycode',
-                        'state': state,
-                        'client_id': self.client_id,
-                        'client_secret': self.client_secret,
-                        'redirect_uri': 'http://localhost/oauth2-callback',
-                        'grant_type': 'authorization_code',
-                    },
-                )
+        with mock.patch('godhand.auth.google.crypt') as crypt:
+            crypt.verify_signed_jwt_with_certs.return_value = {
+                'email_verified': True, 'email': email,
+            }
+            response = self.api.get(
+                '/oauth2-callback',
+                params={'state': state, 'code': 'mycode'},
+            )
+            assert response.headers['location'] == 'http://success'
+            crypt.verify_signed_jwt_with_certs.assert_called_once_with(
+                'myidtoken', {}, self.client_id)
+        self.assertEquals({
+            'code': 'mycode',
+            'state': state,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'redirect_uri': 'http://localhost/oauth2-callback',
+            'grant_type': 'authorization_code',
+        }, self.google.token_requests[-1])
 
 
 class TestLoggedOut(ApiTest):
@@ -134,6 +145,18 @@ class TestLoggedOut(ApiTest):
                 'user_id': 'another.dude@gmail.com',
             }, status=403)
 
+    def test_purge_oauth_tokens(self):
+        from godhand.cli import purge_oauth_tokens
+        for n in range(3):
+            self.authdb.save({'_id': 'token:{}'.format(n)})
+        self.authdb.save({'_id': 'other'})
+        with mock.patch.dict(os.environ, self.cli_env):
+            self.assertEquals(3, purge_oauth_tokens(
+                self.couchdb_url, batch_size=2))
+        self.assertEquals(['other'], [
+            x.id for x in self.authdb.view('_all_docs')
+            if not x.id.startswith('_design/')])
+
 
 class UserLoggedInTest(ApiTest):
     user_id = 'write@company.com'
@@ -301,6 +324,279 @@ class TestSingleSeries(SingleSeriesTest):
         # no body
         self.api.post('/series/{}/volumes'.format(self.series_id), status=400)
 
+    def test_upload_duplicate(self):
+        with CbtFile().packaged() as f:
+            body = f.read()
+        volume_ids = [self.api.post(
+            '/series/{}/volumes'.format(self.series_id),
+            upload_files=[('volume', 'volume-007.cbt', body)],
+            content_type='multipart/form-data',
+        ).json_body['id'] for _ in range(2)]
+        self.assertEquals(volume_ids[0], volume_ids[1])
+        response = self.api.get('/series/{}'.format(
+            '{}:{}'.format(self.series_id, self.user_id))).json_body
+        self.assertEquals(1, len(response['volumes']))
+
+    def test_incomplete_volume_not_found_by_archive(self):
+        from godhand.utils import content_hash
+        found = []
+        with CbtFile().packaged() as f:
+            sha256 = content_hash(f)
+
+            def progress(pages_done, pages_total):
+                found.append(Volume.find_by_archive(
+                    self.db, self.user_id, sha256))
+
+            volume = Volume.from_archieve(
+                self.db, self.user_id, 'volume-007.cbt', f,
+                single_revision=False, progress=progress)
+        self.assertTrue(found)
+        self.assertEquals([None] * len(found), found)
+        self.assertEquals(volume.id, Volume.find_by_archive(
+            self.db, self.user_id, sha256).id)
+
+
+class TestQueuedUpload(SingleSeriesTest):
+    settings = {'queue_uploads': 'true'}
+
+    def test_upload_to_series(self):
+        from godhand.cli import worker
+        volume = CbtFile()
+        with volume.packaged() as f:
+            response = self.api.post(
+                '/series/{}/volumes'.format(self.series_id),
+                upload_files=[('volume', 'volume-007.cbt', f.read())],
+                content_type='multipart/form-data',
+                status=202,
+            ).json_body
+        job_id = response['id']
+        expected = {
+            'id': job_id,
+            'status': 'queued',
+            'filename': 'volume-007.cbt',
+            'series_id': self.series_id,
+            'pages_done': 0,
+            'pages_total': None,
+            'volume_id': None,
+            'error': None,
+            'url': 'http://localhost/jobs/{}'.format(job_id),
+        }
+        self.assertEquals(expected, response)
+        self.assertEquals(
+            expected, self.api.get('/jobs/{}'.format(job_id)).json_body)
+
+        with mock.patch.dict(os.environ, self.cli_env):
+            worker(self.couchdb_url, once=True)
+
+        response = self.api.get('/jobs/{}'.format(job_id)).json_body
+        volume_id = response.pop('volume_id')
+        expected = dict(
+            expected,
+            status='done',
+            pages_done=len(volume.expected_pages),
+            pages_total=len(volume.expected_pages),
+        )
+        del expected['volume_id']
+        self.assertEquals(expected, response)
+
+        response = self.api.get('/volumes/{}'.format(volume_id)).json_body
+        self.assertEquals(volume.expected_pages, [
+            {k: v for k, v in x.items() if k != 'url'}
+            for x in response['pages']])
+        # forbidden
+        self.oauth2_login('derp@herp.com')
+        self.api.get('/jobs/{}'.format(job_id), status=403)
+
+    def test_missing_archive(self):
+        from godhand.cli import worker
+        volume = CbtFile()
+        with volume.packaged() as f:
+            job_id = self.api.post(
+                '/series/{}/volumes'.format(self.series_id),
+                upload_files=[('volume', 'volume-007.cbt', f.read())],
+                content_type='multipart/form-data',
+                status=202,
+            ).json_body['id']
+        self.db.delete_attachment(self.db[job_id], 'archive')
+
+        with mock.patch.dict(os.environ, self.cli_env):
+            worker(self.couchdb_url, once=True)
+
+        response = self.api.get('/jobs/{}'.format(job_id)).json_body
+        self.assertEquals(
+            ('failed', 'The uploaded archive is missing.'),
+            (response['status'], response['error']))
+
+    def queue_and_work(self, from_archieve):
+        from godhand.cli import worker
+        volume = CbtFile()
+        with volume.packaged() as f:
+            job_id = self.api.post(
+                '/series/{}/volumes'.format(self.series_id),
+                upload_files=[('volume', 'volume-007.cbt', f.read())],
+                content_type='multipart/form-data',
+                status=202,
+            ).json_body['id']
+        original = Volume.from_archieve
+
+        def wrapped(db, **kw):
+            return from_archieve(job_id, original, db, **kw)
+
+        with mock.patch.dict(os.environ, self.cli_env), \
+                mock.patch.object(Volume, 'from_archieve', wrapped):
+            worker(self.couchdb_url, once=True)
+        return job_id
+
+    def reclaim(self, job_id):
+        doc = self.db[job_id]
+        doc['worker_id'] = 'elsewhere'
+        self.db.save(doc)
+
+    def test_heartbeat(self):
+        from godhand.models import IngestJob
+        touched = []
+
+        def from_archieve(job_id, original, db, **kw):
+            before = self.db[job_id]['updated']
+            deadline = time.time() + 5
+            while self.db[job_id]['updated'] == before:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.01)
+            touched.append(True)
+            return original(db, **kw)
+
+        with mock.patch.object(IngestJob, 'heartbeat_interval', 0.01):
+            job_id = self.queue_and_work(from_archieve)
+        self.assertEquals([True], touched)
+        self.assertEquals('done', self.db[job_id]['status'])
+
+    def test_lost_during_ingest(self):
+        def from_archieve(job_id, original, db, **kw):
+            self.reclaim(job_id)
+            return original(db, **kw)
+
+        job_id = self.queue_and_work(from_archieve)
+        doc = self.db[job_id]
+        self.assertEquals(
+            ('running', 'elsewhere'), (doc['status'], doc['worker_id']))
+        self.assertIn('archive', doc['_attachments'])
+        self.assertEquals([], self.api.get(
+            '/series/{}'.format(self.series_id)).json_body['volumes'])
+
+    def test_lost_after_ingest(self):
+        def from_archieve(job_id, original, db, **kw):
+            volume = original(db, **kw)
+            self.reclaim(job_id)
+            return volume
+
+        job_id = self.queue_and_work(from_archieve)
+        doc = self.db[job_id]
+        self.assertEquals(
+            ('running', 'elsewhere'), (doc['status'], doc['worker_id']))
+
+
+class TestChunkedUpload(SingleSeriesTest):
+    def test_upload(self):
+        volume = CbtFile()
+        with volume.packaged() as f:
+            body = f.read()
+        response = self.api.post_json(
+            '/series/{}/uploads'.format(self.series_id),
+            {'filename': 'volume-007.cbt', 'size': len(body)},
+        ).json_body
+        upload_id = response.pop('id')
+        expected = {
+            'filename': 'volume-007.cbt',
+            'series_id': self.series_id,
+            'size': len(body),
+            'received': 0,
+            'chunks': [],
+            'url': 'http://localhost/uploads/{}'.format(upload_id),
+        }
+        self.assertEquals(expected, response)
+        url = '/uploads/{}'.format(upload_id)
+        half = len(body) // 2
+
+        self.api.put(
+            url + '/chunks/{}'.format(half), body[half:],
+            content_type='application/octet-stream')
+        response = self.api.get(url).json_body
+        self.assertEquals(0, response['received'])
+        # incomplete
+        self.api.post(url, status=400)
+        # past the end
+        self.api.put(
+            url + '/chunks/{}'.format(len(body)), b'abc',
+            content_type='application/octet-stream', status=413)
+
+        response = self.api.put(
+            url + '/chunks/0', body[:half],
+            content_type='application/octet-stream').json_body
+        self.assertEquals(len(body), response['received'])
+        self.assertEquals([
+            {'offset': 0, 'length': half},
+            {'offset': half, 'length': len(body) - half},
+        ], response['chunks'])
+
+        response = self.api.post(url).json_body
+        self.assertEquals('volume-007.cbt', response['filename'])
+        self.assertEquals(volume.expected_pages, response['pages'])
+        self.api.get(url, status=404)
+
+    def test_parallel_chunks(self):
+        volume = CbtFile()
+        with volume.packaged() as f:
+            body = f.read()
+        url = self.api.post_json(
+            '/series/{}/uploads'.format(self.series_id),
+            {'filename': 'volume-007.cbt', 'size': len(body)},
+        ).json_body['url']
+        size = len(body) // 8 + 1
+
+        def put_chunk(offset):
+            self.api.put(
+                '{}/chunks/{}'.format(url, offset), body[offset:offset + size],
+                content_type='application/octet-stream')
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(put_chunk, range(0, len(body), size)))
+        self.assertEquals(len(body), self.api.get(url).json_body['received'])
+        response = self.api.post(url).json_body
+        self.assertEquals(volume.expected_pages, response['pages'])
+
+
+class TestUploadLimit(SingleSeriesTest):
+    settings = {'max_upload_size': '1024'}
+
+    def test_upload_too_large(self):
+        with CbtFile().packaged() as f:
+            self.api.post(
+                '/series/{}/volumes'.format(self.series_id),
+                upload_files=[('volume', 'volume-007.cbt', f.read())],
+                content_type='multipart/form-data',
+                status=413,
+            )
+        response = self.api.get('/series/{}'.format(self.series_id))
+        self.assertEquals([], response.json_body['volumes'])
+
+
+class TestDecompressionBomb(SingleSeriesTest):
+    settings = {'extract_max_page_bytes': str(1024 ** 2)}
+
+    def test_upload_bomb(self):
+        f = BytesIO()
+        with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as ar:
+            ar.writestr('bomb.png', b'\0' * 16 * 1024 ** 2)
+        response = self.api.post(
+            '/series/{}/volumes'.format(self.series_id),
+            upload_files=[('volume', 'volume-007.cbz', f.getvalue())],
+            content_type='multipart/form-data',
+            status=400,
+        )
+        self.assertIn('Could not extract volume-007.cbz', response.text)
+        response = self.api.get('/series/{}'.format(self.series_id))
+        self.assertEquals([], response.json_body['volumes'])
+
 
 class SingleVolumeTest(SingleSeriesTest):
     def setUp(self):
@@ -404,6 +700,12 @@ class TestSingleVolume(SingleVolumeTest):
         self.assertEquals(expected, response)
         response = self.api.get('/volumes/{}/cover.jpg'.format(self.volume_id))
         self.assertEquals('image/jpeg', response.content_type)
+        for w, expected in ((100, 160), (161, 256), (1000, 256)):
+            response = self.api.get(
+                '/volumes/{}/cover.jpg'.format(self.volume_id),
+                params={'w': w})
+            self.assertEquals(
+                expected, Image.open(BytesIO(response.body)).size[0])
         # forbidden
         self.oauth2_login('derp@herp.com')
         self.api.get('/volumes/{}'.format(self.volume_id), status=403)
@@ -414,6 +716,101 @@ class TestSingleVolume(SingleVolumeTest):
         self.api.get(
             '/volumes/{}/cover.jpg'.format(self.volume_id), status=403)
 
+    def test_conditional_get(self):
+        page = self.expected_volume['pages'][0]
+        response = self.api.get(page['url'])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        etag = response.headers['ETag']
+        with mock.patch.object(Volume, 'get_file') as get_file:
+            response = self.api.get(
+                page['url'], headers={'If-None-Match': etag}, status=304)
+        self.assertFalse(get_file.called)
+        self.assertEquals(b'', response.body)
+        response = self.api.get(page['url'], params={'w': 10})
+        self.assertNotEquals(etag, response.headers['ETag'])
+
+        url = '/volumes/{}/cover.jpg'.format(self.volume_id)
+        response = self.api.get(url)
+        self.assertEquals(
+            'private, no-cache', response.headers['Cache-Control'])
+        self.api.get(
+            url, headers={'If-None-Match': response.headers['ETag']},
+            status=304)
+        self.api.get(
+            url, params={'w': 100},
+            headers={'If-None-Match': response.headers['ETag']}, status=200)
+
+    def test_range(self):
+        page = self.expected_volume['pages'][0]
+        body = self.api.get(page['url']).body
+        response = self.api.get(
+            page['url'], headers={'Range': 'bytes=10-19'}, status=206)
+        self.assertEquals(body[10:20], response.body)
+        self.assertEquals(
+            'bytes 10-19/{}'.format(len(body)),
+            response.headers['Content-Range'])
+        response = self.api.get(
+            page['url'], headers={'Range': 'bytes=-5'}, status=206)
+        self.assertEquals(body[-5:], response.body)
+
+        etag = response.headers['ETag']
+        response = self.api.get(page['url'], status=206, headers={
+            'Range': 'bytes=10-', 'If-Range': etag})
+        self.assertEquals(body[10:], response.body)
+        response = self.api.get(page['url'], status=200, headers={
+            'Range': 'bytes=10-', 'If-Range': '"stale"'})
+        self.assertEquals(body, response.body)
+        self.api.get(
+            page['url'], headers={'Range': 'bytes=100000-'}, status=416)
+
+    def test_range_before_full_read(self):
+        page = self.expected_volume['pages'][0]
+        response = self.api.get(
+            page['url'], headers={'Range': 'bytes=0-9'}, status=206)
+        self.assertEquals(10, len(response.body))
+        body = self.api.get(page['url']).body
+        self.assertEquals(
+            self.db[self.volume_id]['pages'][0]['filesize'], len(body))
+        self.assertEquals(response.body, body[:10])
+
+    def test_documents_loaded_once(self):
+        page = self.expected_volume['pages'][0]
+        for url in (
+                '/volumes/{}'.format(self.volume_id),
+                '/volumes/{}/cover.jpg'.format(self.volume_id),
+                page['url']):
+            with couchdb_requests() as requests:
+                self.api.get(url)
+            self.assertEquals(
+                1, len(doc_requests(requests, self.volume_id)), url)
+        with couchdb_requests() as requests:
+            self.api.get('/series/{}'.format(self.user_series_id))
+        self.assertEquals(
+            1, len(doc_requests(requests, self.user_series_id)))
+
+    def test_subscribe(self):
+        subscriber = 'other@gmail.com'
+        url = '/volumes/{}'.format(self.volume_id)
+        self.api.put_json('/subscribers', {
+            'action': 'allow',
+            'user_id': subscriber,
+        })
+        self.oauth2_login(subscriber)
+        self.api.get(url, status=403)
+        self.api.put_json('/subscriptions', {
+            'action': 'allow',
+            'user_id': self.user_id,
+        })
+        self.api.get(url, status=200)
+
+        self.oauth2_login(self.user_id)
+        self.api.put_json('/subscribers', {
+            'action': 'block',
+            'user_id': subscriber,
+        })
+        self.oauth2_login(subscriber)
+        self.api.get(url, status=403)
+
     def test_update_volume(self):
         self.api.put_json('/volumes/{}'.format(self.volume_id), {
             'volume_number': 8,
@@ -466,6 +863,246 @@ class TestSingleVolume(SingleVolumeTest):
             self.assertEquals(expected, response)
 
 
+class TestOffload(SingleVolumeTest):
+    settings = {'offload_prefix': '/_attachments/'}
+
+    def test_offload(self):
+        page = self.expected_volume['pages'][0]
+        sha256 = self.db[self.volume_id]['pages'][0]['sha256']
+        with mock.patch.object(Volume, 'get_file') as get_file:
+            response = self.api.get(page['url'])
+        self.assertFalse(get_file.called)
+        self.assertEquals(b'', response.body)
+        self.assertEquals('image/png', response.content_type)
+        self.assertEquals(
+            '/_attachments/godhand/blob%3Asha256%3A{}/page'.format(sha256),
+            response.headers['X-Accel-Redirect'])
+
+        response = self.api.get(
+            '/volumes/{}/cover.jpg'.format(self.volume_id),
+            params={'w': 100})
+        self.assertEquals(
+            '/_attachments/godhand/{}/covers/160.jpg'.format(self.volume_id),
+            response.headers['X-Accel-Redirect'])
+
+        self.api.get(
+            '/volumes/{}/files/missing.png'.format(self.volume_id),
+            status=404)
+
+        # access is still checked by the api
+        self.oauth2_login('derp@herp.com')
+        response = self.api.get(page['url'], status=403)
+        self.assertNotIn('X-Accel-Redirect', response.headers)
+
+
+class TestSignedUrls(SingleVolumeTest):
+    settings = {'signed_url_ttl': '3600'}
+
+    def test_signed_url(self):
+        page = self.api.get(
+            '/volumes/{}'.format(self.volume_id)).json_body['pages'][0]
+        url = urlparse(page['url'])
+        self.assertTrue(url.path.startswith('/signed/blob:sha256:'))
+        self.assertEquals(page['url'], self.api.get(
+            '/volumes/{}'.format(self.volume_id)).json_body['pages'][0]['url'])
+
+        # no login needed, and the volume is not loaded
+        self.api.reset()
+        with mock.patch.object(Volume, 'load') as load:
+            response = self.api.get(page['url'])
+        self.assertFalse(load.called)
+        self.assertEquals(
+            self.example_volume.expected_pages[0]['width'],
+            Image.open(BytesIO(response.body)).size[0])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.api.get(
+            page['url'], headers={'If-None-Match': response.headers['ETag']},
+            status=304)
+
+        query = parse_qs(url.query)
+        query['signature'] = ['0' * 64]
+        self.api.get(url.path, params=query, status=403)
+        query = parse_qs(url.query)
+        query['expires'] = [str(int(query['expires'][0]) + 3600)]
+        self.api.get(url.path, params=query, status=403)
+        with mock.patch('time.time', return_value=2 ** 40):
+            self.api.get(page['url'], status=403)
+
+
+class TestBearerTokens(SingleVolumeTest):
+    settings = {'bearer_token_ttl': '900'}
+
+    def test_token(self):
+        url = '/volumes/{}'.format(self.volume_id)
+        token = self.api.post('/token').json_body
+        self.assertEquals(('bearer', 900), (
+            token['token_type'], token['expires_in']))
+        headers = {
+            'Authorization': 'Bearer {}'.format(token['access_token'])}
+
+        # authorized without a session or a subscription lookup
+        self.api.reset()
+        with mock.patch.object(Subscription, 'query') as query:
+            self.api.get(url, headers=headers)
+        self.assertFalse(query.called)
+        self.api.get(url, status=403)
+
+        refreshed = self.api.post('/token', headers=headers).json_body
+        self.api.get(url, headers={
+            'Authorization': 'Bearer {}'.format(refreshed['access_token'])})
+
+        for bad in (token['access_token'] + 'x', 'nonsense'):
+            self.api.get(url, status=403, headers={
+                'Authorization': 'Bearer {}'.format(bad)})
+        with mock.patch('time.time', return_value=2 ** 40):
+            self.api.get(url, headers=headers, status=403)
+
+    def test_subscription_groups(self):
+        subscriber = 'other@gmail.com'
+        self.api.put_json('/subscribers', {
+            'action': 'allow',
+            'user_id': subscriber,
+        })
+        self.oauth2_login(subscriber)
+        self.api.put_json('/subscriptions', {
+            'action': 'allow',
+            'user_id': self.user_id,
+        })
+        token = self.api.post('/token').json_body['access_token']
+        self.api.reset()
+        self.api.get('/volumes/{}'.format(self.volume_id), headers={
+            'Authorization': 'Bearer {}'.format(token)})
+
+
+class TestBlobLeases(SingleVolumeTest):
+    def ingest_while_deleting(self, before_lease):
+        """ Ingest the same pages for another user, deleting the first volume
+        while its blobs are being leased.
+        """
+        from godhand.models.attachments import BlobUploader
+        volume = Volume.load(self.db, self.volume_id)
+        lease = BlobUploader._lease
+        pending = [volume]
+
+        def deleting_lease(uploader, doc):
+            if not before_lease:
+                lease(uploader, doc)
+            if pending:
+                pending.pop().delete(self.db)
+            if before_lease:
+                lease(uploader, doc)
+
+        with mock.patch.object(BlobUploader, '_lease', deleting_lease):
+            with self.example_volume.packaged() as f:
+                other = Volume.from_archieve(
+                    self.db, 'other@gmail.com', 'volume-007.cbt', f,
+                    upload_workers=1)
+        self.assertIsNone(self.db.get(self.volume_id))
+        for page in other.pages:
+            data = other.get_file(self.db, page.filename)
+            self.assertEquals(page.filesize, len(data.read()))
+        self.assertEquals([], [
+            x.id for x in self.db.view('_all_docs')
+            if x.id.startswith('blob-lease:')])
+
+    def test_delete_before_lease(self):
+        self.ingest_while_deleting(before_lease=True)
+
+    def test_delete_after_lease(self):
+        self.ingest_while_deleting(before_lease=False)
+
+
+class TestReprocessImages(SingleVolumeTest):
+    def setUp(self):
+        super(TestReprocessImages, self).setUp()
+        self.tmp_dir = mkdtemp()
+        self.addCleanup(rmtree, self.tmp_dir)
+        self.checkpoint = os.path.join(self.tmp_dir, 'checkpoint.json')
+
+    def reprocess(self, **kws):
+        from godhand.cli import reprocess_images
+        with mock.patch.dict(os.environ, self.cli_env):
+            return reprocess_images(
+                self.couchdb_url, workers=2, checkpoint=self.checkpoint,
+                **kws)
+
+    def test_reprocess(self):
+        self.assertEquals(0, self.reprocess(min_width=100, min_height=100))
+        doc = self.db[self.volume_id]
+        self.assertEquals((100, 100), (
+            doc['cover_min_width'], doc['cover_min_height']))
+        with open(self.checkpoint) as f:
+            self.assertEquals([self.volume_id], json.load(f)['done'])
+        response = self.api.get('/volumes/{}/cover.jpg'.format(
+            self.volume_id))
+        self.assertEquals(100, min(Image.open(BytesIO(response.body)).size))
+
+        # resumed runs skip finished volumes, fresh runs skip current covers
+        self.reprocess(min_width=100, min_height=100)
+        self.reprocess(min_width=100, min_height=100, restart=True)
+        self.assertEquals(doc.rev, self.db[self.volume_id].rev)
+
+
+class TestIngestMetrics(SingleVolumeTest):
+    def test_metrics(self):
+        from godhand.models import IngestMetrics
+        metrics = IngestMetrics.for_volume(self.db, self.volume_id)
+        self.assertEquals('done', metrics.status)
+        self.assertEquals(
+            len(self.example_volume.expected_pages), metrics.pages)
+        self.assertEquals(
+            {'hash', 'extract', 'probe', 'upload', 'covers', 'sync'},
+            set(metrics.stages))
+        self.assertEquals(
+            sum(x['filesize'] for x in self.db[self.volume_id]['pages']),
+            metrics.stages['extract']['bytes'])
+        self.assertGreater(metrics.peak_rss_bytes, 0)
+
+    def test_ingest_stats(self):
+        from godhand.cli import ingest_stats
+        out = StringIO()
+        with mock.patch.dict(os.environ, self.cli_env):
+            summary = ingest_stats(
+                self.couchdb_url, group_by=['dedupe'], out=out)
+        self.assertEquals(1, len(summary))
+        self.assertEquals({'dedupe': True}, summary[0]['settings'])
+        self.assertEquals((1, 0), (
+            summary[0]['ingests'], summary[0]['failed']))
+        self.assertIn('extract', out.getvalue())
+
+
+class TestBenchmark(ApiTest):
+    def test_run_benchmark(self):
+        from godhand.benchmark import iter_cases
+        from godhand.cli import run_benchmark
+        tmp_dir = mkdtemp()
+        self.addCleanup(rmtree, tmp_dir)
+        output = os.path.join(tmp_dir, 'benchmark.json')
+        cases = iter_cases(
+            formats=['cbz'], page_counts=[3], page_sizes=[(32, 48)])
+        with mock.patch.dict(os.environ, self.cli_env):
+            results = run_benchmark(
+                self.couchdb_url, cases=cases, repeat=2, output=output)
+        with open(output) as f:
+            self.assertEquals(results, json.load(f))
+        self.assertEquals(2, len(results['cases']))
+        case = results['cases'][0]
+        self.assertEquals({
+            'format', 'pages', 'page_size', 'page_format', 'run',
+            'archive_bytes', 'pages_ingested', 'stages', 'ingest_stages',
+            'pages_per_second', 'peak_rss_bytes', 'temp_disk_bytes',
+        }, set(case))
+        self.assertEquals(
+            ('cbz', 3, [32, 48], 3),
+            (case['format'], case['pages'], case['page_size'],
+             case['pages_ingested']))
+        self.assertEquals(
+            {'extract', 'probe', 'ingest'}, set(case['stages']))
+        self.assertIn('upload', case['ingest_stages'])
+        self.assertNotIn(
+            'godhand-benchmark', couchdb.client.Server(self.couchdb_url))
+
+
 class SeveralVolumesTest(SingleSeriesTest):
     n_volumes = 3
 
@@ -571,6 +1208,22 @@ class TestSeveralVolumes(SeveralVolumesTest):
             filename = page['filename']
             self.api.get('/volumes/{}/files/{}'.format(
                 volume['id'], filename))
+        # renditions
+        page = volume['pages'][0]
+        for cache in ('miss', 'hit'):
+            response = self.api.get(
+                '/volumes/{}/files/{}'.format(volume['id'], page['filename']),
+                params={'w': 32, 'fmt': 'webp'})
+            self.assertEquals(cache, response.headers['X-Rendition-Cache'])
+            self.assertEquals('image/webp', response.content_type)
+            im = Image.open(BytesIO(response.body))
+            self.assertEquals(
+                (32, int(page['height'] * 32 / page['width'])), im.size)
+        # Pillow built without libwebp
+        with mock.patch.dict('PIL.Image.SAVE', clear=True):
+            self.api.get(
+                '/volumes/{}/files/{}'.format(volume['id'], page['filename']),
+                params={'w': 64, 'fmt': 'webp'}, status=400)
         # forbidden
         self.oauth2_login('derp@herp.com')
         volume = self.get_expected_volume(0)
@@ -1,5 +1,16 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from threading import Thread
+from urllib.parse import parse_qs
+from urllib.parse import quote
 from urllib.parse import urlparse
+import json
 import os
+import time
+
+import couchdb.http
+import mock
 
 
 GODHAND_COUCHDB_URL = os.environ.get('TEST_GODHAND_COUCHDB_URL')
@@ -18,3 +29,94 @@ def _get_docker_ip():
         return '127.0.0.1'
     else:
         return urlparse(url).hostname
+
+
+@contextmanager
+def couchdb_requests():
+    """ Record the ``(method, url)`` of every request made to CouchDB.
+    """
+    requests = []
+    request = couchdb.http.Session.request
+
+    def record(session, method, url, *args, **kws):
+        requests.append((method, url))
+        return request(session, method, url, *args, **kws)
+
+    with mock.patch.object(couchdb.http.Session, 'request', record):
+        yield requests
+
+
+def doc_requests(requests, doc_id, method='GET'):
+    """ The requests of ``couchdb_requests`` that read the document
+    ``doc_id`` itself.
+    """
+    return [
+        (m, url) for m, url in requests
+        if m == method and
+        urlparse(url).path.rstrip('/').endswith('/' + quote(doc_id, safe=''))
+    ]
+
+
+class GoogleStandIn(object):
+    """ Local stand-in for Google's token and certificate endpoints.
+
+    ``token_status`` and ``token_body`` are served by ``POST /token``, after
+    ``delay`` seconds. The forms posted are kept in ``token_requests`` and
+    the number of certificate fetches in ``certs_requests``.
+    """
+    def __init__(self):
+        self.token_status = 200
+        self.token_body = {'id_token': 'myidtoken'}
+        self.certs_max_age = 3600
+        self.delay = 0
+        self.token_requests = []
+        self.certs_requests = 0
+        self.server = HTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.settings = {
+            'google_token_uri': self.url + '/token',
+            'google_certs_uri': self.url + '/certs',
+        }
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                stand_in.token_requests.append({
+                    k: v[0] for k, v in parse_qs(body.decode()).items()})
+                time.sleep(stand_in.delay)
+                self.reply(stand_in.token_status, stand_in.token_body)
+
+            def do_GET(self):
+                stand_in.certs_requests += 1
+                self.reply(200, {}, {
+                    'Cache-Control': 'public, max-age={}'.format(
+                        stand_in.certs_max_age)})
+
+            def reply(self, status, body, headers=()):
+                body = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    for k, v in dict(headers).items():
+                        self.send_header(k, v)
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    # the client gave up waiting
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def setUp(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def cleanUp(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,96 @@
+""" godhand.tokens
+
+Stateless bearer tokens.
+
+A token carries the user id, the groups :func:`godhand.groupfinder`
+resolved when it was issued, and an expiry time, signed with
+``token_secret``. Requests sending ``Authorization: Bearer <token>`` are
+authorized from the token alone. Group changes take effect when the client
+refreshes its token through ``POST /token``, so tokens are short-lived.
+
+"""
+import time
+
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.security import Authenticated
+from pyramid.security import Everyone
+from zope.interface import implementer
+
+from . import signing
+
+PREFIX = 'v1'
+
+
+def issue(secret, userid, groups, ttl, now=None):
+    now = time.time() if now is None else now
+    return '{}.{}'.format(PREFIX, signing.dumps(secret, {
+        'sub': userid,
+        'groups': list(groups),
+        'exp': int(now) + ttl,
+    }, now=now))
+
+
+def parse(secret, token, now=None):
+    """ The claims of ``token``, or ``None`` if it is invalid or expired.
+    """
+    now = time.time() if now is None else now
+    prefix, _, value = token.partition('.')
+    if prefix != PREFIX:
+        return None
+    claims = signing.loads(secret, value, None, now=now)
+    if not isinstance(claims, dict) or claims.get('exp', 0) <= now:
+        return None
+    return claims
+
+
+@implementer(IAuthenticationPolicy)
+class BearerTokenAuthenticationPolicy(object):
+    """ Authenticate by bearer token, or by ``fallback`` if there is none.
+
+    A request with a bearer token is never authenticated by ``fallback``,
+    even if the token is invalid, so an expired token is not hidden by a
+    stale cookie. Remembering and forgetting are left to ``fallback``.
+    """
+    def __init__(self, secret, fallback):
+        self.secret = secret
+        self.fallback = fallback
+
+    def claims(self, request):
+        """ ``(has_token, claims)`` of the bearer token of ``request``.
+        """
+        key = 'godhand.bearer_claims'
+        if key not in request.environ:
+            authorization = request.headers.get('Authorization', '')
+            scheme, _, token = authorization.partition(' ')
+            if scheme.lower() != 'bearer':
+                request.environ[key] = (False, None)
+            else:
+                request.environ[key] = (
+                    True, parse(self.secret, token.strip()))
+        return request.environ[key]
+
+    def authenticated_userid(self, request):
+        has_token, claims = self.claims(request)
+        if not has_token:
+            return self.fallback.authenticated_userid(request)
+        return claims['sub'] if claims else None
+
+    def unauthenticated_userid(self, request):
+        has_token, claims = self.claims(request)
+        if not has_token:
+            return self.fallback.unauthenticated_userid(request)
+        return claims['sub'] if claims else None
+
+    def effective_principals(self, request):
+        has_token, claims = self.claims(request)
+        if not has_token:
+            return self.fallback.effective_principals(request)
+        if not claims:
+            return [Everyone]
+        return [Everyone, Authenticated, claims['sub']] + claims['groups']
+
+    def remember(self, request, userid, **kw):
+        return self.fallback.remember(request, userid, **kw)
+
+    def forget(self, request):
+        return self.fallback.forget(request)
@@ -1,5 +1,7 @@
 from itertools import islice
 from urllib.parse import urlparse
+import hashlib
+import os
 import socket
 import time
 
@@ -35,6 +37,26 @@ def batched(gen, batch_size):
             return
 
 
+def file_size(f):
+    """ Size of a seekable file object, leaving it rewound.
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    return size
+
+
+def content_hash(f, chunk_size=64 * 1024):
+    """ Hex sha256 of a seekable file object, leaving it rewound.
+    """
+    h = hashlib.sha256()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        h.update(chunk)
+    f.seek(0)
+    return h.hexdigest()
+
+
 def owner_group(owner_id):
     """ String ACL representation of owner permission.
     """
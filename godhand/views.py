@@ -1,18 +1,36 @@
 from functools import partial
+from urllib.parse import quote
+import time
 
 from cornice import Service
 from pyramid.exceptions import HTTPBadRequest
+from pyramid.exceptions import HTTPForbidden
 from pyramid.exceptions import HTTPNotFound
+from pyramid.httpexceptions import HTTPRequestEntityTooLarge
+from pyramid.httpexceptions import HTTPRequestRangeNotSatisfiable
 from pyramid.security import Allow
 from pyramid.security import Authenticated
 import colander as co
+import couchdb.http
 import pycountry
 
+from . import imaging
+from . import signing
+from . import tokens
+from .groups import find_groups
 from .models import Bookmark
+from .models import IngestJob
 from .models import Series
 from .models import Subscription
+from .models import UploadSession
 from .models import UserSettings
 from .models import Volume
+from .models.attachments import guess_content_type
+from .renditions import rendition_key
+from .sandbox import ExtractionError
+from .sandbox import LimitExceeded
+from .sandbox import Limits
+from .utils import file_size
 from .utils import owner_group
 from .utils import subscription_group
 
@@ -35,15 +53,30 @@ def language_validator(node, cstruct):
 class ValidatedSeries(co.String):
     def deserialize(self, node, cstruct):
         appstruct = super(ValidatedSeries, self).deserialize(node, cstruct)
-        db = node.bindings['request'].registry['godhand:db']
-        return Series.load(db, appstruct)
+        return node.bindings['request'].godhand_docs.load(
+            Series, appstruct)
 
 
 class ValidatedVolume(co.String):
     def deserialize(self, node, cstruct):
         appstruct = super(ValidatedVolume, self).deserialize(node, cstruct)
-        db = node.bindings['request'].registry['godhand:db']
-        return Volume.load(db, appstruct)
+        return node.bindings['request'].godhand_docs.load(
+            Volume, appstruct)
+
+
+class ValidatedUploadSession(co.String):
+    def deserialize(self, node, cstruct):
+        appstruct = super(ValidatedUploadSession, self).deserialize(
+            node, cstruct)
+        return node.bindings['request'].godhand_docs.load(
+            UploadSession, appstruct)
+
+
+class ValidatedIngestJob(co.String):
+    def deserialize(self, node, cstruct):
+        appstruct = super(ValidatedIngestJob, self).deserialize(node, cstruct)
+        return node.bindings['request'].godhand_docs.load(
+            IngestJob, appstruct)
 
 
 class UserPathSchema(co.MappingSchema):
@@ -60,6 +93,17 @@ class VolumePathSchema(co.MappingSchema):
         ValidatedVolume(), location='path', validator=co.NoneOf([None]))
 
 
+class IngestJobPathSchema(co.MappingSchema):
+    job = co.SchemaNode(
+        ValidatedIngestJob(), location='path', validator=co.NoneOf([None]))
+
+
+class UploadPathSchema(co.MappingSchema):
+    upload = co.SchemaNode(
+        ValidatedUploadSession(), location='path',
+        validator=co.NoneOf([None]))
+
+
 class VolumePagePathSchema(VolumePathSchema):
     page = co.SchemaNode(co.Integer(), location='path')
 
@@ -92,11 +136,15 @@ subscriptions = GodhandService(
     description='Manage subscriptions to other users\' volumes.',
     path='/subscriptions',
 )
+token = GodhandService(
+    name='token',
+    path='/token',
+)
 
 
 def series_acl(request):
     series_id = request.matchdict['series']
-    series = Series.load(request.registry['godhand:db'], series_id)
+    series = request.godhand_docs.load(Series, series_id)
     if series:
         if series.owner_id == 'root':
             return [
@@ -125,6 +173,10 @@ series_volumes = SeriesService(
     name="series volumes",
     path="/series/{series}/volumes",
 )
+series_uploads = SeriesService(
+    name="series uploads",
+    path="/series/{series}/uploads",
+)
 
 
 def user_acl(request):
@@ -146,7 +198,7 @@ user_series_collection = UserService(
 
 def volume_acl(request):
     volume_id = request.matchdict['volume']
-    volume = Volume.load(request.registry['godhand:db'], volume_id)
+    volume = request.godhand_docs.load(Volume, volume_id)
     if volume:
         return acl_by_owner(volume.owner_id)
     raise HTTPNotFound('Volume<{}>'.format(volume_id))
@@ -170,12 +222,88 @@ volume_file = VolumeService(
     name='volume file',
     path='/volumes/{volume}/files/{filename:.+}'
 )
+signed_file = Service(
+    name='signed file',
+    path='/signed/{doc}/{attachment:.+}',
+    permission=None,
+)
 volume_bookmark = VolumeService(
     name='volume bookmark',
     path='/volumes/{volume}/bookmark',
 )
 
 
+def ingest_job_acl(request):
+    job_id = request.matchdict['job']
+    job = request.godhand_docs.load(IngestJob, job_id)
+    if job:
+        return acl_by_owner(job.owner_id)
+    raise HTTPNotFound('IngestJob<{}>'.format(job_id))
+
+
+ingest_job = GodhandService(
+    name='ingest job',
+    path='/jobs/{job}',
+    schema=IngestJobPathSchema,
+    acl=ingest_job_acl,
+    permission='read',
+)
+
+
+def upload_acl(request):
+    upload_id = request.matchdict['upload']
+    session = request.godhand_docs.load(UploadSession, upload_id)
+    if session:
+        return acl_by_owner(session.owner_id)
+    raise HTTPNotFound('UploadSession<{}>'.format(upload_id))
+
+
+UploadService = partial(
+    GodhandService,
+    schema=UploadPathSchema,
+    acl=upload_acl,
+    permission='write',
+)
+upload = UploadService(
+    name='upload',
+    path='/uploads/{upload}',
+)
+upload_chunk = UploadService(
+    name='upload chunk',
+    path='/uploads/{upload}/chunks/{offset}',
+)
+
+
+@token.post()
+def create_token(request):
+    """ Issue a bearer token for the logged in user.
+
+    Call this after the OAuth callback to trade the session cookie for a
+    token, and again with the current token before it expires. The token
+    carries the user's subscriptions as of now.
+
+    .. code-block:: js
+
+        {
+            "access_token": "v1.eyJ...",
+            "token_type": "bearer",
+            "expires_in": 900
+        }
+
+    """
+    cfg = request.registry['godhand:cfg']
+    if not cfg.bearer_token_ttl:
+        raise HTTPNotFound('Bearer tokens are disabled.')
+    userid = request.authenticated_userid
+    groups = find_groups(request.registry['godhand:db'], userid)
+    return {
+        'access_token': tokens.issue(
+            cfg.token_secret, userid, groups, cfg.bearer_token_ttl),
+        'token_type': 'bearer',
+        'expires_in': cfg.bearer_token_ttl,
+    }
+
+
 @account.get()
 def get_account_info(request):
     """ Get account information.
@@ -327,18 +455,27 @@ def get_series(request):
     )
 
 
-@series_cover.get()
+class CoverSchema(co.MappingSchema):
+    w = co.SchemaNode(
+        co.Integer(), location="querystring", missing=None,
+        validator=co.Range(min=1))
+
+
+class SeriesCoverSchema(SeriesPathSchema, CoverSchema):
+    pass
+
+
+@series_cover.get(schema=SeriesCoverSchema)
 def get_series_cover(request):
     """ Get cover page as image.
+
+    Pass ``w`` to get the pre-built cover closest to that width.
     """
-    series = request.validated["series"]
-    cover = series.get_cover(request.registry["godhand:db"])
-    if cover is None:
+    db = request.registry["godhand:db"]
+    volume = request.validated["series"].cover_volume(db)
+    if volume is None:
         raise HTTPNotFound()
-    response = request.response
-    response.body_file = cover
-    response.content_type = "images/jpeg"
-    return response
+    return volume_cover_response(request, volume, request.validated["w"])
 
 
 @series_volumes.post(content_type='multipart/form-data', permission='write')
@@ -348,6 +485,24 @@ def upload_volume_to_series(request):
     If a series is read-only, a new one for the user will be created as a
     duplicate.
 
+    If uploads are queued, the archive is stored for a ``godhand-cli worker``
+    and ``202 Accepted`` is returned with the ingest job. Poll its ``url``
+    until ``status`` is ``done`` or ``failed``.
+
+    .. code-block:: js
+
+        {
+            "id": "myjobid",
+            "status": "queued",
+            "filename": "volume-007.cbz",
+            "series_id": "dbr:Berserk",
+            "pages_done": 0,
+            "pages_total": null,
+            "volume_id": null,
+            "error": null,
+            "url": "http://url.to/jobs/myjobid"
+        }
+
     """
     series = request.validated["series"]
     try:
@@ -355,12 +510,40 @@ def upload_volume_to_series(request):
     except KeyError:
         raise HTTPBadRequest("body volume is required")
 
-    volume = Volume.from_archieve(
-        request.registry["godhand:db"],
-        owner_id=request.authenticated_userid,
-        filename=volume_file.filename,
-        fd=volume_file.file,
-    )
+    return ingest_archive(
+        request, series, volume_file.filename, volume_file.file)
+
+
+def ingest_archive(request, series, filename, fd):
+    cfg = request.registry["godhand:cfg"]
+    if cfg.queue_uploads:
+        job = IngestJob.create(
+            request.registry["godhand:db"],
+            owner_id=request.authenticated_userid,
+            series_id=series.id,
+            filename=filename,
+            fd=fd,
+        )
+        request.response.status_code = 202
+        return job.as_dict(request)
+
+    try:
+        volume = Volume.from_archieve(
+            request.registry["godhand:db"],
+            owner_id=request.authenticated_userid,
+            filename=filename,
+            fd=fd,
+            single_revision=cfg.single_revision_ingest,
+            upload_workers=cfg.upload_workers,
+            upload_max_inflight_bytes=cfg.upload_max_inflight_bytes,
+            images=request.registry["godhand:images"],
+            cover_widths=cfg.cover_widths,
+            dedupe=cfg.dedupe_pages,
+            sandbox=Limits.from_config(cfg),
+            metrics=cfg.ingest_metrics,
+        )
+    except ExtractionError as e:
+        raise HTTPBadRequest(str(e))
 
     series.add_volume(
         request.registry["godhand:db"],
@@ -370,6 +553,145 @@ def upload_volume_to_series(request):
     return volume.as_dict()
 
 
+class PostUploadSchema(SeriesPathSchema):
+    filename = co.SchemaNode(co.String(), validator=co.Length(min=1))
+    size = co.SchemaNode(
+        co.Integer(), missing=None, validator=co.Range(min=1))
+
+
+@series_uploads.post(schema=PostUploadSchema, permission='write')
+def create_upload(request):
+    """ Start a resumable upload of a volume to a series.
+
+    ``size`` is the size of the archive in bytes, if known. ``PUT`` chunks
+    of the archive to ``{url}/chunks/{offset}`` in any order, check which
+    bytes arrived with ``GET {url}`` and ``POST {url}`` to ingest the volume
+    once ``received`` equals ``size``.
+
+    .. code-block:: js
+
+        {
+            "id": "myuploadid",
+            "filename": "volume-007.cbz",
+            "series_id": "dbr:Berserk",
+            "size": 629145600,
+            "received": 0,
+            "chunks": [],
+            "url": "http://url.to/uploads/myuploadid"
+        }
+
+    """
+    v = request.validated
+    max_size = request.registry['godhand:cfg'].max_upload_size
+    if v['size'] and 0 < max_size < v['size']:
+        raise HTTPRequestEntityTooLarge(
+            'Upload is larger than {} bytes.'.format(max_size))
+    session = UploadSession.create(
+        request.registry['godhand:db'],
+        owner_id=request.authenticated_userid,
+        series_id=v['series'].id,
+        filename=v['filename'],
+        size=v['size'],
+    )
+    return session.as_dict(request)
+
+
+@upload.get()
+def get_upload(request):
+    """ Get which chunks of an upload have arrived.
+
+    ``received`` counts the bytes stored without gaps from the start, i.e.
+    where to resume.
+
+    .. code-block:: js
+
+        {
+            "id": "myuploadid",
+            "filename": "volume-007.cbz",
+            "series_id": "dbr:Berserk",
+            "size": 629145600,
+            "received": 8388608,
+            "chunks": [
+                {"offset": 0, "length": 4194304},
+                {"offset": 4194304, "length": 4194304}
+            ],
+            "url": "http://url.to/uploads/myuploadid"
+        }
+
+    """
+    return request.validated['upload'].as_dict(request)
+
+
+class PutUploadChunkSchema(UploadPathSchema):
+    offset = co.SchemaNode(
+        co.Integer(), location='path', validator=co.Range(min=0))
+
+
+@upload_chunk.put(schema=PutUploadChunkSchema)
+def put_upload_chunk(request):
+    """ Store the request body as the chunk starting at ``offset``.
+
+    Sending a chunk again replaces it.
+    """
+    v = request.validated
+    session = v['upload']
+    body = request.body_file_seekable
+    max_size = request.registry['godhand:cfg'].max_upload_size
+    end = v['offset'] + file_size(body)
+    if (session.size and end > session.size) or 0 < max_size < end:
+        raise HTTPRequestEntityTooLarge(
+            'Chunk ends past the end of the upload.')
+    session.put_chunk(request.registry['godhand:db'], v['offset'], body)
+    return session.as_dict(request)
+
+
+@upload.post()
+def finish_upload(request):
+    """ Ingest a completed upload, like uploading the archive in one go.
+    """
+    db = request.registry['godhand:db']
+    session = request.validated['upload']
+    series = request.godhand_docs.load(Series, session.series_id)
+    if series is None:
+        raise HTTPNotFound('Series<{}>'.format(session.series_id))
+    try:
+        with session.assembled(db) as fd:
+            response = ingest_archive(request, series, session.filename, fd)
+    except ValueError as e:
+        raise HTTPBadRequest(str(e))
+    session.delete(db)
+    return response
+
+
+@upload.delete()
+def delete_upload(request):
+    """ Abandon an upload and discard its chunks.
+    """
+    request.validated['upload'].delete(request.registry['godhand:db'])
+
+
+@ingest_job.get()
+def get_ingest_job(request):
+    """ Get the progress of a queued upload.
+
+    .. code-block:: js
+
+        {
+            "id": "myjobid",
+            "status": "done",
+            "filename": "volume-007.cbz",
+            "series_id": "dbr:Berserk",
+            "pages_done": 127,
+            "pages_total": 127,
+            "volume_id": "myvolumeid",
+            "error": null,
+            "url": "http://url.to/jobs/myjobid"
+        }
+
+    """
+    return request.validated['job'].as_dict(request)
+
+
 @user_series_collection.get()
 def get_user_series_collection(request):
     """ Get series uploaded by user.
@@ -439,6 +761,7 @@ def update_subscribers(request):
         subscriber_id=v['user_id'],
         publisher_id=request.authenticated_userid
     ).update_publisher_status(db, v['action'])
+    request.registry['godhand:groups'].invalidate(v['user_id'])
 
 
 @subscriptions.get()
@@ -486,12 +809,17 @@ def update_subscriptions(request):
         publisher_id=v['user_id'],
         subscriber_id=request.authenticated_userid
     ).update_subscriber_status(db, v['action'])
+    request.registry['godhand:groups'].invalidate(
+        request.authenticated_userid)
 
 
 @volume.get()
 def get_volume(request):
     """ Get a volume by ID.
 
+    With ``signed_url_ttl`` set, page URLs are signed and expire after at
+    least that many seconds; fetching them needs no login.
+
     .. code-block:: js
 
         {
@@ -509,8 +837,8 @@ def get_volume(request):
     """
     volume = request.validated['volume'].as_dict()
     for page in volume['pages']:
-        page['url'] = request.route_url(
-            'volume file', volume=volume['id'], filename=page['filename'])
+        page['url'] = page_url(
+            request, request.validated['volume'], page['filename'])
 
     next_volume = request.validated['volume'].get_next_volume(
         request.registry['godhand:db'])
@@ -520,6 +848,23 @@ def get_volume(request):
     return volume
 
 
+def page_url(request, volume, filename):
+    cfg = request.registry['godhand:cfg']
+    if not cfg.signed_url_ttl:
+        return request.route_url(
+            'volume file', volume=volume.id, filename=filename)
+    doc_id, name = volume.file_location(filename)
+    digest = volume.file_digest(filename) or ''
+    expires, signature = signing.sign_expiring(
+        cfg.token_secret, cfg.signed_url_ttl, doc_id, name, digest)
+    return request.route_url(
+        'signed file', doc=doc_id, attachment=name, _query={
+            'digest': digest,
+            'expires': expires,
+            'signature': signature,
+        })
+
+
 class PutVolumeSchema(VolumePathSchema):
     volume_number = co.SchemaNode(
         co.Integer(), validator=co.Range(min=0), missing=None)
@@ -544,35 +889,232 @@ def delete_volume(request):
     request.validated['volume'].delete(request.registry['godhand:db'])
 
 
-@volume_cover.get(schema=VolumePathSchema)
+IMMUTABLE = 'private, max-age=31536000, immutable'
+REVALIDATE = 'private, no-cache'
+
+
+class VolumeCoverSchema(VolumePathSchema, CoverSchema):
+    pass
+
+
+@volume_cover.get(schema=VolumeCoverSchema)
 def get_volume_cover(request):
     """ Get a volume page.
+
+    Pass ``w`` to get the pre-built cover closest to that width.
     """
-    cover = request.validated['volume'].get_cover(
-        request.registry['godhand:db'])
+    return volume_cover_response(
+        request, request.validated['volume'], request.validated['w'])
+
+
+def volume_cover_response(request, volume, width):
+    filename = volume.cover_filename(width)
+    digest = volume.file_digest(filename)
+    if not_modified(request, digest, REVALIDATE):
+        return request.response
+    response = request.response
+    response.content_type = 'image/jpeg'
+    if digest is not None and offloaded(
+            request, *volume.file_location(filename)):
+        return response
+    cover = volume.get_cover(request.registry['godhand:db'], width)
     if cover is None:
         raise HTTPNotFound()
-    response = request.response
     response.body_file = cover
-    response.content_type = 'image/jpeg'
     return response
 
 
+def offloaded(request, doc_id, name):
+    """ Let the front-end proxy send an attachment if offloading is set up.
+
+    The response only carries the ``offload_header`` naming the attachment
+    under ``offload_prefix``, an internal proxy location forwarding to the
+    CouchDB database, e.g. for nginx::
+
+        location /_attachments/ {
+            internal;
+            proxy_pass http://couchdb:5984/;
+            proxy_set_header Authorization "Basic ...";
+        }
+
+    Range requests are then answered by the proxy and CouchDB.
+    """
+    cfg = request.registry['godhand:cfg']
+    if not cfg.offload_prefix:
+        return False
+    request.response.headers[cfg.offload_header] = '{}/{}/{}/{}'.format(
+        cfg.offload_prefix.rstrip('/'),
+        quote(request.registry['godhand:db'].name, safe=''),
+        quote(doc_id, safe=''),
+        quote(name))
+    return True
+
+
+def not_modified(request, digest, cache_control, variant=None):
+    """ Set caching headers on the response for a file with ``digest``.
+
+    The ETag is the digest, plus ``variant`` for files derived from it.
+    Returns ``True`` and makes the response a 304 if the client already has
+    this version, so the file does not have to be read at all.
+    """
+    response = request.response
+    response.headers['Cache-Control'] = cache_control
+    if digest is None:
+        return False
+    response.etag = digest if variant is None else '{}-{}'.format(
+        digest, variant)
+    if response.etag in request.if_none_match:
+        response.status = 304
+        return True
+    return False
+
+
 class VolumeFileSchema(VolumePathSchema):
     filename = co.SchemaNode(co.String(), location='path')
 
 
-@volume_file.get(schema=VolumeFileSchema)
+class GetVolumeFileSchema(VolumeFileSchema):
+    w = co.SchemaNode(
+        co.Integer(), location='querystring', missing=None,
+        validator=co.Range(min=1))
+    fmt = co.SchemaNode(
+        co.String(), location='querystring', missing=None,
+        validator=co.OneOf(sorted(imaging.RENDITION_FORMATS)))
+
+
+@volume_file.get(schema=GetVolumeFileSchema)
 def get_volume_file(request):
     """ Get volume file bytes.
+
+    Pass ``w`` and/or ``fmt`` (``jpeg``, ``png`` or ``webp``) to get a
+    rendition scaled down to that width, e.g. ``?w=1080&fmt=webp``.
+    Renditions are generated on first use and cached on disk. A format the
+    server has no encoder for is answered with 400.
+
+    Originals honour a single-range ``Range`` header (and ``If-Range``) and
+    only that part of the file is read from CouchDB.
     """
-    attachment = request.registry['godhand:db'].get_attachment(
-        request.validated['volume'].id,
-        request.validated['filename'],
-    )
+    v = request.validated
+    if v['w'] or v['fmt']:
+        return get_volume_file_rendition(request)
+    volume = v['volume']
+    db = request.registry['godhand:db']
+    if not_modified(request, volume.file_digest(v['filename']), IMMUTABLE):
+        return request.response
+    response = request.response
+    response.accept_ranges = 'bytes'
+    response.content_type = guess_content_type(v['filename'])
+    if volume.file_digest(v['filename']) is not None and offloaded(
+            request, *volume.file_location(v['filename'])):
+        return response
+    length = volume.file_length(v['filename'])
+    byte_range = requested_range(request, length)
+    if byte_range is None:
+        attachment = volume.get_file(db, v['filename'])
+    else:
+        attachment = volume.get_file_range(db, v['filename'], *byte_range)
     if attachment is None:
         raise HTTPNotFound()
+    if byte_range is not None:
+        response.status = 206
+        response.content_range = byte_range + (length,)
+        response.content_length = byte_range[1] - byte_range[0]
+    response.body_file = attachment
+    return response
+
+
+def requested_range(request, length):
+    """ ``(start, stop)`` of the byte range to send, ``None`` for all.
+
+    Multiple ranges and ranges whose ``If-Range`` does not match the
+    response are answered with the whole file.
+    """
+    if request.range is None or length is None:
+        return None
+    if request.response not in request.if_range:
+        return None
+    byte_range = request.range.range_for_length(length)
+    if byte_range is None:
+        raise HTTPRequestRangeNotSatisfiable(
+            headers={'Content-Range': 'bytes */{}'.format(length)})
+    return byte_range
+
+
+def get_volume_file_rendition(request):
+    v = request.validated
+    fmt = v['fmt'] or 'jpeg'
+    if not imaging.can_encode(fmt):
+        raise HTTPBadRequest('Cannot encode {} on this server.'.format(fmt))
+    cache = request.registry['godhand:renditions']
+    key = rendition_key(v['volume'].id, v['filename'], v['w'], fmt)
+    response = request.response
+    if not_modified(
+            request, v['volume'].file_digest(v['filename']), IMMUTABLE,
+            variant='{}.{}'.format(v['w'] or 0, fmt)):
+        return response
+    response.content_type = imaging.RENDITION_FORMATS[fmt]
+    f = cache.get(key)
+    if f is not None:
+        response.headers['X-Rendition-Cache'] = 'hit'
+        response.body_file = f
+        return response
+
+    attachment = v['volume'].get_file(
+        request.registry['godhand:db'], v['filename'])
+    if attachment is None:
+        raise HTTPNotFound()
+    try:
+        data = request.registry['godhand:images'].run(
+            imaging.rendition, attachment.read(), v['w'], fmt)
+    except OSError:
+        raise HTTPBadRequest('{} is not an image.'.format(v['filename']))
+    except LimitExceeded as e:
+        raise HTTPBadRequest(str(e))
+    finally:
+        attachment.close()
+    cache.put(key, data)
+    response.headers['X-Rendition-Cache'] = 'miss'
+    response.body = data
+    return response
+
+
+class SignedFileSchema(co.MappingSchema):
+    doc = co.SchemaNode(co.String(), location='path')
+    attachment = co.SchemaNode(co.String(), location='path')
+    digest = co.SchemaNode(co.String(), location='querystring', missing='')
+    expires = co.SchemaNode(co.Integer(), location='querystring')
+    signature = co.SchemaNode(co.String(), location='querystring')
+
+
+@signed_file.get(schema=SignedFileSchema)
+def get_signed_file(request):
+    """ Get a page by a URL signed by :func:`get_volume`.
+
+    The signature is the only authorization, so the attachment is read
+    without loading the volume or the user's subscriptions.
+    """
+    v = request.validated
+    cfg = request.registry['godhand:cfg']
+    if not signing.verify_expiring(
+            cfg.token_secret, v['expires'], v['signature'],
+            v['doc'], v['attachment'], v['digest']):
+        raise HTTPForbidden('Invalid or expired signature.')
+    max_age = max(0, v['expires'] - int(time.time()))
+    if not_modified(
+            request, v['digest'] or None,
+            'private, max-age={}, immutable'.format(max_age)):
+        return request.response
     response = request.response
+    if offloaded(request, v['doc'], v['attachment']):
+        del response.headers['Content-Type']
+        return response
+    try:
+        _, headers, attachment = request.registry['godhand:db'].resource(
+            v['doc']).get(v['attachment'])
+    except couchdb.http.ResourceNotFound:
+        raise HTTPNotFound()
+    response.content_type = headers.get(
+        'Content-Type', 'application/octet-stream')
     response.body_file = attachment
     return response
 